@@ -3,6 +3,7 @@
 from __future__ import print_function
 
 import sys#, os
+import json
 import os.path as op
 import traceback
 import numpy as n
@@ -13,10 +14,101 @@ except:
   traceback.print_exc()
   sys.exit(-1)
 
-"""Main code path for using command line arguments"""
-def mainCmdLineApp(argv):
+#command line flags, with the optional settings of meshdiff.doDifference() they
+#modify. Flags with a value (--flag=value) have a function to parse the value
+flags = {
+  '--cache':      ('pccache',     True),
+  '--cache-hash': ('pccachehash', True),
+  '--format':     ('pcformat',    lambda v: v if v in meshdiff.pointcloud.formats else None),
+  '--refcache':   ('refcache',    True),
+  '--mesh':       ('meshmode',    lambda v: v if v in ['auto', 'grid', 'delaunay'] else None),
+  '--samples':    ('gridsamples', lambda v: int(v) if v.isdigit() and int(v)>1 else None),
+  '--no-crop':    ('crop',        False),
+  '--no-clean':   ('clean',       False),
+  '--clean-tolerance': ('cleantolerance', lambda v: parsePositive(v)),
+  '--simplify':   ('simplifyerror', lambda v: parsePositive(v)),
+  '--simplify-faces': ('simplifyfaces', lambda v: int(v) if v.isdigit() and int(v)>0 else None),
+  '--compact':    ('compact',     True),
+  '--compact-tolerance': ('compacttolerance', lambda v: parsePositive(v)),
+  '--engine':     ('engine',      lambda v: v if v in meshdiff.engines.backends else None),
+  '--register':   ('register',    True),
+  '--range':      ('deviationrange', lambda v: parsePositive(v)),
+  '--profile':    ('profile',     lambda v: v if op.isdir(op.dirname(op.abspath(v))) else None),
+  '--scratch':    ('scratchdir',  lambda v: v if v=='ram' or op.isdir(v) else None),
+  '--tile':       ('tilesize',    lambda v: parsePositive(v)),
+  '--overlap':    ('tileoverlap', lambda v: parsePositive(v)),
+  '--jobs':       ('jobs',        lambda v: int(v) if v.isdigit() and int(v)>0 else None),
+  '--fast':       ('fast',        lambda v: {'x': 0, 'y': 1}.get(v.lower())),
+  '--follow':     ('follow',      True),
+  '--once':       ('once',        True),
+  '--poll':       ('poll',        lambda v: parsePositive(v)),
+  #this one is not passed as an optional setting, but as string arguments
+  '--decimate':   ('decimation',  lambda v: v.split(':', 1) if ':' in v else None),
+  }
+
+#modes in which the flags can be used (the ones not listed here can be used
+#in all modes). The service runs difference (also tiled) and deviation jobs
+modeFlags = {
+  '--tile':       ['difference', 'service'],
+  '--overlap':    ['difference', 'service'],
+  '--jobs':       ['difference', 'batch', 'watch', 'service'], #in difference mode, only with --tile
+  '--range':      ['deviation', 'service'],
+  '--fast':       ['stream'],
+  '--follow':     ['stream'],
+  '--once':       ['watch'],
+  '--poll':       ['watch'],
+  }
+
+"""parse a positive number, returning None if it is not valid"""
+def parsePositive(v):
+  try:
+    v = float(v)
+  except ValueError:
+    return None
+  return v if v>0 else None
+
+"""separate command line flags from positional arguments. Returns the
+positional arguments and a dictionary of optional settings, or None if
+there is an unknown or incorrect flag, or a flag which cannot be used in
+mode (see modeFlags)"""
+def parseFlags(argv, mode):
+  opts       = {}
+  positional = []
+  for arg in argv:
+    if arg.startswith('--'):
+      name, eq, value = arg.partition('=')
+      if name not in flags or (eq=='')!=(not callable(flags[name][1])):
+        print('Unknown or malformed flag: '+arg)
+        return positional, None
+      if mode not in modeFlags.get(name, [mode]):
+        print('Unknown or malformed flag: %s (it cannot be used in %s mode)' % (arg, mode))
+        return positional, None
+      key, value0 = flags[name]
+      if callable(value0):
+        value = value0(value)
+        if value is None:
+          print('Incorrect value for flag: '+arg)
+          return positional, None
+      else:
+        value = value0
+      opts[key] = value
+    else:
+      positional.append(arg)
+  return positional, opts
+
+"""Main code path for using command line arguments (function is the one doing
+the computations: meshdiff.safeDoDifference, meshdiff.safeDoDeviation or
+streaming.safeDoStreamDifference, and mode is the name of the mode)"""
+def mainCmdLineApp(argv, function=meshdiff.safeDoDifference, mode='difference'):
   ret = None
   try:
+    argv, opts = parseFlags(argv, mode)
+    if opts is not None and 'tilesize' not in opts and ('jobs' in opts or 'tileoverlap' in opts):
+      print('Unknown or malformed flag: --jobs and --overlap can only be used with --tile')
+      opts = None
+    if opts is None:
+      usage(argv)
+      return
     if not len(argv) in [4, 6, 10]:
       print('Incorrect number of arguments! Usage:')
       usage(argv)
@@ -31,9 +123,65 @@ def mainCmdLineApp(argv):
     elif len(argv)==10: #all limits
       strargs = strargs+argv[4:10]
     strargs.append('0.1') #zsub
-    ret = meshdiff.safeDoDifference(strargs)
+    strargs.extend(opts.pop('decimation', ['', '']))
+    if 'tilesize' in opts:
+      import tiled
+      function = tiled.safeDoTiledDifference
+    profile = opts.pop('profile', None)
+    if profile is not None:
+      opts['profile'] = True
+    ret = function(strargs, opts)
     if ret.val:
       print(ret.val)
+    if profile is not None:
+      writeProfile(profile, ret)
+  except:
+    print('Unexpected exception!!!')
+    traceback.print_exc()
+  if ret and (ret.errcode!=None):
+    sys.exit(ret.errcode)
+  sys.exit(-1)
+
+"""write the trace of a profiled run (see profiling.py) to a JSON file"""
+def writeProfile(filename, ret):
+  if ret.profile is None:
+    print('The run could not be profiled')
+    return
+  try:
+    with open(filename, 'w') as f:
+      json.dump(dict(ret.profile, ok=bool(ret.ok), errcode=ret.errcode), f, indent=1)
+    print('Profile written to '+filename)
+  except (IOError, OSError) as e:
+    print('Could not write the profile %s: %s' % (filename, str(e)))
+
+"""Main code path for batch mode"""
+def mainBatchApp(argv):
+  ret = None
+  try:
+    argv, opts = parseFlags(argv, 'batch')
+    if opts is None:
+      usage(argv)
+      return
+    if len(argv)!=5:
+      print('Incorrect number of arguments! Usage:')
+      usage(argv)
+      return
+    import batch
+    manifest, stlin, summary = argv[2:5]
+    nprocs    = opts.pop('jobs', None)
+    extraargs = ['0.1']+opts.pop('decimation', ['', ''])
+    ret = batch.runBatch(manifest, stlin, summary, nprocs, opts, extraargs)
+    if not ret.ok:
+      print(ret.val)
+    else:
+      for job in ret.val:
+        print('%s (%.2f s): %s' % ('OK    ' if job['ok'] else 'FAILED', job['seconds'], job['pcin']))
+        if not job['ok']:
+          print('  '+str(job['message']).replace('\n', '\n  '))
+      nok = sum(job['ok'] for job in ret.val)
+      print('%d jobs OK, %d failed. Summary written to %s' % (nok, len(ret.val)-nok, summary))
+      #exit code: 0 if all jobs were OK
+      ret = meshdiff.RetVal(True, None, -1, 0 if nok==len(ret.val) else 96)
   except:
     print('Unexpected exception!!!')
     traceback.print_exc()
@@ -41,6 +189,69 @@ def mainCmdLineApp(argv):
     sys.exit(ret.errcode)
   sys.exit(-1)
 
+"""Main code path for watch mode"""
+def mainWatchApp(argv):
+  ret = None
+  try:
+    argv, opts = parseFlags(argv, 'watch')
+    if opts is None:
+      usage(argv)
+      return
+    if len(argv)!=5:
+      print('Incorrect number of arguments! Usage:')
+      usage(argv)
+      return
+    import watch
+    directory, rules, outdir = argv[2:5]
+    settings  = {'jobs': opts.pop('jobs', None), 'once': opts.pop('once', False)}
+    if 'poll' in opts:
+      settings['poll'] = settings['settle'] = opts.pop('poll')
+    extraargs = ['0.1']+opts.pop('decimation', ['', ''])
+    ret = watch.watch(directory, rules, outdir, opts, extraargs, settings, log=lambda line: sys.stdout.write(line+'\n'))
+    if not ret.ok:
+      print(ret.val)
+    else:
+      #the results of the files are in their logs
+      ret = meshdiff.RetVal(True, None, -1, 0)
+  except:
+    print('Unexpected exception!!!')
+    traceback.print_exc()
+  if ret and (ret.errcode!=None):
+    sys.exit(ret.errcode)
+  sys.exit(-1)
+
+"""Main code path for service mode"""
+def mainServiceApp(argv):
+  code = -1
+  try:
+    argv, opts = parseFlags(argv, 'service')
+    if opts is None:
+      usage(argv)
+      return
+    if len(argv) not in [2, 3] or (len(argv)==3 and not argv[2].isdigit()):
+      print('Incorrect number of arguments! Usage:')
+      usage(argv)
+      return
+    import service
+    settings = {'workers': opts.pop('jobs', None)}
+    if len(argv)==3:
+      settings['port'] = int(argv[2])
+    if 'decimation' in opts:
+      print('The decimation cannot be set for the service, it is an argument of each job')
+      return
+    server = service.makeServer(settings, opts)
+    print('meshdiff service listening on http://%s:%d/ with %d workers' % (server.server_address[0], server.server_address[1], server.service.workers))
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    server.server_close()
+    code = 0
+  except:
+    print('Unexpected exception!!!')
+    traceback.print_exc()
+  sys.exit(code)
+
 """Main code path for taking arguments from the user with a GUI"""
 def mainGUIApp():
   try:
@@ -54,7 +265,7 @@ def mainGUIApp():
 
 """command line help"""
 def usage(argv):
-  print('%s has four modes of operation, depending on the command line arguments:' % (argv[0]))
+  print('%s has eight modes of operation, depending on the command line arguments:' % (argv[0]))
   print('')
   print('   %s' % (argv[0]))
   print('     with no arguments, this help text is displayed')
@@ -63,7 +274,7 @@ def usage(argv):
   print('     with one argument -gui, arguments are collected using a')
   print('     GUI interface (requires wxPython to be installed)')
   print('')
-  print('   %s pcin stlin stlout [[Xmin Xmax Ymin Ymax] Zmin Zmax]' % (argv[0]))
+  print('   %s [flags] pcin stlin stlout [[Xmin Xmax Ymin Ymax] Zmin Zmax]' % (argv[0]))
   print('     with more than one argument, these are used to do the computations:')
   print('       -pcin:   input  point cloud file')
   print('       -stlin:  input  STL file')
@@ -76,10 +287,154 @@ def usage(argv):
   print('       -[Xmin Xmax Ymin Ymax]: optional arguments representing limits')
   print('                               to the output STL in the XY plane')
   print('                               (points outside the limits are NOT culled)')
+  print('       flags:')
+  print('         --cache:      keep the parsed point cloud in a binary sidecar')
+  print('                       file next to pcin (it is written in the directory')
+  print('                       of pcin), so later runs do not parse pcin again')
+  print('         --cache-hash: with --cache, check the contents of pcin (not only')
+  print('                       its size and modification time) to decide if the')
+  print('                       sidecar file is up to date')
+  print('         --format=FMT: format of pcin: text (coordinates separated by')
+  print('                       semicolons), npy, ply (binary), raw32 or raw64')
+  print('                       (XYZ triplets of little endian floats). By')
+  print('                       default, it is detected from the contents of pcin')
+  print('                       (and the extensions .f32 and .f64 for raw files)')
+  print('                       Binary files are memory-mapped, not parsed')
+  print('         --refcache:   keep the loaded stlin in a cache of STL input')
+  print('                       meshes (%s), so later runs do not' % meshdiff.cache.refdir)
+  print('                       convert the same stlin again')
+  print('         --mesh=MODE:  how to mesh the point cloud: auto (default: use the')
+  print('                       scan lines if they can be detected, otherwise use a')
+  print('                       Delaunay triangulation), grid (use the scan lines)')
+  print('                       or delaunay')
+  print('         --samples=N:  number of samples per scan line (for --mesh=grid;')
+  print('                       missing samples must have non-numeric coordinates')
+  print('                       such as nan)')
+  print('         --no-crop:    with XY limits, apply them with a second boolean')
+  print('                       operation (with a prism) instead of cropping the')
+  print('                       mesh of the point cloud before the difference (the')
+  print('                       STL input mesh is not clipped, only its shells')
+  print('                       outside the limits are dropped)')
+  print('         --no-clean:   do not clean the input meshes (weld duplicate')
+  print('                       vertexes, remove degenerate and duplicate triangles')
+  print('                       and unused vertexes) before the boolean operations')
+  print('         --clean-tolerance=TOL: weld vertexes closer than TOL and fix')
+  print('                       triangles thinner than TOL, keeping the meshes')
+  print('                       closed (default: only identical vertexes and')
+  print('                       triangles with zero area)')
+  print('         --simplify=ERROR: simplify the mesh of pcin (with quadric error')
+  print('                       edge collapses) as long as the error is not higher')
+  print('                       than ERROR. The border of the mesh is not changed')
+  print('         --simplify-faces=N: simplify the mesh of pcin until its upper')
+  print('                       face has N triangles (with --simplify, whatever')
+  print('                       limit is reached first)')
+  print('         --compact:    keep pcin and its mesh in single precision (the')
+  print('                       mesh engines use single precision anyway), to')
+  print('                       use less memory with big point clouds')
+  print('         --compact-tolerance=TOL: with --compact, keep pcin in double')
+  print('                       precision if its rounding error would be higher')
+  print('                       than TOL (default: the rounding error of the')
+  print('                       coordinates of stlin, which are stored in single')
+  print('                       precision)')
+  print('         --engine=NAME: mesh engine for the boolean operations: cork')
+  print('                       (default), openscad or corklib (the cork shared')
+  print('                       library, called without intermediate files)')
+  print('         --register:   align pcin to stlin (with the ICP algorithm) before')
+  print('                       doing anything else. The limits are applied after')
+  print('                       the alignment, in the coordinates of stlin')
+  print('         --profile=FILE: write the wall time, CPU time and peak RSS of')
+  print('                       each stage of the run (and of the external')
+  print('                       programs it launches) to FILE, in JSON format')
+  print('         --scratch=DIR: directory where a private directory for the')
+  print('                       intermediate files is created (default: the system')
+  print('                       temporary directory). Use --scratch=ram to use a')
+  print('                       RAM-backed filesystem (%s), if available' % meshdiff.ramdir)
+  print('         --tile=SIZE:  process the point cloud in square tiles of side SIZE')
+  print('                       in the XY plane, without loading it in memory at')
+  print('                       once. The tiles are processed in parallel, and')
+  print('                       joined in a single solid (if the sides of two')
+  print('                       tiles do not match, they are kept as internal')
+  print('                       walls, with a warning)')
+  print('         --overlap=D:  expansion of the tiles, to mesh the points near')
+  print('                       their sides as without tiles (default: 5% of SIZE)')
+  print('         --jobs=N:     number of processes for the tiles (default: one')
+  print('                       per CPU)')
+  print('         --decimate=MODE:TOL: decimate the point cloud before meshing it.')
+  print('                       MODE is voxel (points are averaged in a grid of')
+  print('                       cells of size TOL) or height (points are averaged')
+  print('                       in cells as big as possible without introducing')
+  print('                       height errors higher than TOL)')
+  print('')
+  print('   %s -deviation [flags] pcin stlin plyout [[Xmin Xmax Ymin Ymax] Zmin Zmax]' % (argv[0]))
+  print('     instead of the difference, compute the signed distances from the')
+  print('     points of pcin (within the limits) to the surface of stlin')
+  print('     (positive outside it), without using the mesh engine:')
+  print('       -plyout: output PLY file with the points, colored by their')
+  print('                deviations (blue: negative, red: positive), and the')
+  print('                deviations as a scalar property')
+  print('       flags: the same as above (except --tile, --overlap and --jobs),')
+  print('              and also:')
+  print('         --range=R:    deviations at which the colors saturate (default:')
+  print('                       the 99th percentile of the absolute deviations)')
+  print('     summary statistics of the deviations are printed at the end')
+  print('')
+  print('   %s -stream [flags] pcin stlin stlout [[Xmin Xmax Ymin Ymax] Zmin Zmax]' % (argv[0]))
+  print('     the same as the difference, but pcin (a text file from a line')
+  print('     scanner, or - for the standard input) is meshed one scan line at a')
+  print('     time while it is read, so the difference starts as soon as it ends')
+  print('     (--register and --decimate cannot be used):')
+  print('       flags: the same as for the difference (except --tile, --overlap')
+  print('              and --jobs), and also:')
+  print('         --samples=N:  the scan lines have N samples (by default, a')
+  print('                       scan line ends when the slow coordinate changes)')
+  print('         --fast=AXIS:  fast axis of the scan lines: x or y (default:')
+  print('                       detected from the first points)')
+  print('         --follow:     pcin is still being written: wait for more data')
+  print('                       at its end, until nothing is written for 10 s')
+  print('')
+  print('   %s -batch [flags] manifest stlin summary' % (argv[0]))
+  print('     compare many point clouds against the same STL input file, loading')
+  print('     it only once and running several jobs in parallel:')
+  print('       -manifest: CSV file with a job in each line:')
+  print('                  pcin,stlout[[,Xmin,Xmax,Ymin,Ymax],Zmin,Zmax]')
+  print('                  (relative paths are relative to the manifest)')
+  print('       -stlin:    input STL file, used for all jobs')
+  print('       -summary:  output file with the results of the jobs (JSON format)')
+  print('       flags: the same as for the difference (except --tile and')
+  print('              --overlap), and also:')
+  print('         --jobs=N:     number of jobs to run in parallel (default: one')
+  print('                       per CPU)')
+  print('')
+  print('   %s -watch [flags] directory rules outdir' % (argv[0]))
+  print('     watch a directory, and compute the difference of each new point')
+  print('     cloud file as soon as it is complete (see watch.py):')
+  print('       -rules:  CSV file with a rule in each line:')
+  print('                pattern,stlin[[,Xmin,Xmax,Ymin,Ymax],Zmin,Zmax]')
+  print('                (the first rule whose pattern matches the name of the')
+  print('                file is used, relative paths are relative to rules)')
+  print('       -outdir: directory for the output STL files and the logs of')
+  print('                the files (and the list of processed files, which are')
+  print('                skipped after a restart unless they change)')
+  print('       flags: the same as for the difference (except --tile and')
+  print('              --overlap), and also:')
+  print('         --jobs=N:     number of jobs to run in parallel (default: one')
+  print('                       per CPU)')
+  print('         --poll=S:     seconds between scans of the directory, and')
+  print('                       without changes for a file to be complete')
+  print('                       (default: 2)')
+  print('         --once:       stop when all complete files have been processed')
+  print('')
+  print('   %s -service [flags] [port]' % (argv[0]))
+  print('     run a service on localhost (default port: 8765), which runs the jobs')
+  print('     sent to it as HTTP requests, keeping the recently used STL input')
+  print('     files loaded in memory (see service.py for the protocol):')
+  print('       flags: the same as for the difference and the deviation (they')
+  print('              are the defaults for all jobs), and also:')
+  print('         --jobs=N:     number of jobs to run at once (default: one per')
+  print('                       CPU)')
   print('')
-  print('ATTENTION: In the directory of the output STL file, several files')
-  print('           names are reserved. They are removed before starting the')
-  print('           process. Please make sure you are not using these file names:')
+  print('The intermediate files are written to a private directory (removed at the')
+  print('end), so several instances can be run at the same time:')
   print('')
   #get list of file names and explanations
   fst = meshdiff.specialFiles.values()
@@ -95,6 +450,17 @@ def main(argv):
     usage(argv)
   elif argv[1].lower() in ['-gui', '-g']:
     mainGUIApp()
+  elif argv[1].lower() in ['-batch', '-b']:
+    mainBatchApp(argv)
+  elif argv[1].lower() in ['-service', '-s']:
+    mainServiceApp(argv)
+  elif argv[1].lower() in ['-watch', '-w']:
+    mainWatchApp(argv)
+  elif argv[1].lower() in ['-deviation', '-d']:
+    mainCmdLineApp(argv[:1]+argv[2:], meshdiff.safeDoDeviation, 'deviation')
+  elif argv[1].lower() in ['-stream']:
+    import streaming
+    mainCmdLineApp(argv[:1]+argv[2:], streaming.safeDoStreamDifference, 'stream')
   else:
     mainCmdLineApp(argv)
 
@@ -0,0 +1,146 @@
+import os.path as op
+import csv
+import json
+import time
+import traceback
+import multiprocessing as mp
+import meshdiff
+from meshdiff import RetVal
+
+"""Batch mode: compare many point clouds against the same STL input mesh. The
+STL mesh is loaded only once (in the main process), and the jobs are run in a
+pool of processes. A failed job does not stop the
+other ones: the results of all jobs (and their timings) are written to a
+summary file in JSON format.
+
+The manifest is a CSV file with a job in each row: point cloud file, output
+STL file and (optionally) the limits, in the same order as in the command
+line: [[xmin, xmax, ymin, ymax], zmin, zmax]. Relative paths are relative to
+the directory of the manifest. Empty lines and lines starting with # are
+ignored"""
+
+#STL input mesh shared by all jobs in a worker process
+sharedReference = None
+
+"""parse the manifest. Returns a list of jobs, each one a dictionary with the
+line number in the manifest and the string arguments for safeDoDifference()
+(without the STL input file, which is the same for all jobs)"""
+def readManifest(filename):
+  base = op.dirname(op.abspath(filename))
+  jobs = []
+  try:
+    with open(filename, 'rb') as f:
+      for num, row in enumerate(csv.reader(f), 1):
+        row = [x.strip() for x in row]
+        if len(row)==0 or row==[''] or row[0].startswith('#'):
+          continue
+        if len(row) not in [2, 4, 8]:
+          return RetVal(False, 'Error in manifest %s, line %d: expected 2, 4 or 8 fields, but there are %d' % (filename, num, len(row)), -1, 94)
+        filePC, fileResult = [op.join(base, x) for x in row[0:2]]
+        lims   = row[2:]
+        usez   = len(lims)>=2
+        usexy  = len(lims)==6
+        lims   = ['']*(6-len(lims))+lims
+        jobs.append({'line': num, 'args': [filePC, fileResult, usexy, usez]+lims})
+  except (IOError, OSError, csv.Error) as e:
+    return RetVal(False, 'Could not read manifest %s: %s' % (filename, str(e)), -1, 94)
+  if len(jobs)==0:
+    return RetVal(False, 'The manifest %s does not contain any job' % filename, -1, 94)
+  return RetVal(True, jobs)
+
+"""initializer of the worker processes"""
+def initWorker(reference):
+  global sharedReference
+  sharedReference = reference
+
+"""worker function: run a job, returning its result as a dictionary"""
+def runJob(args):
+  job, fileSTL, extraargs, opts = args
+  filePC, fileResult = job['args'][0:2]
+  t0      = time.time()
+  try:
+    opts    = dict(opts, reference=sharedReference)
+    strargs = [filePC, fileSTL]+job['args'][1:]+list(extraargs)
+    ret     = meshdiff.safeDoDifference(strargs, opts)
+  except:
+    ret     = RetVal(False, 'Unexpected exception: '+traceback.format_exc(), -1, 1)
+  return {'line':    job['line'],
+          'pcin':    filePC,
+          'stlout':  fileResult,
+          'ok':      bool(ret.ok),
+          'message': ret.val,
+          'argnum':  ret.argnum,
+          'errcode': ret.errcode,
+          'seconds': time.time()-t0}
+
+"""run all jobs in the manifest against the STL input mesh fileSTL, with
+nprocs processes (None for one per CPU). opts and extraargs (the string
+arguments after the limits: zsub and, optionally, the decimation) are passed
+to safeDoDifference() for all jobs. If summary is not None, the results are
+written to it. Returns a RetVal with the list of results (see runJob)"""
+def runBatch(manifest, fileSTL, summary=None, nprocs=None, opts=None, extraargs=('0.1',)):
+  t0   = time.time()
+  ret  = readManifest(manifest)
+  if not ret.ok:
+    return ret
+  jobs = ret.val
+  if not op.isfile(fileSTL):
+    return RetVal(False, 'Error: STL input file does not exist: '+fileSTL, 1, 3)
+  fileSTL = str(op.abspath(fileSTL))
+  opts = opts or {}
+  try:
+    scratch = meshdiff.makeScratchDir(opts.get('scratchdir'))
+  except (IOError, OSError) as e:
+    return RetVal(False, 'Could not create a directory for the intermediate files: '+str(e), -1, 97)
+  report = []
+  ret  = meshdiff.loadReferenceMesh(fileSTL, op.join(scratch, 'stl.off'), opts.get('refcache', False), report)
+  meshdiff.removeEmptyDir(scratch)
+  if not ret.ok:
+    return ret
+  reference = ret.val
+  #the STL model is cleaned only once for all jobs
+  full = meshdiff.completeOptions(opts)
+  if full['clean'] and not full['refcleaned']:
+    ret  = meshdiff.checkOptions(full)
+    if ret.ok:
+      ret  = meshdiff.cleanInputMesh(reference, 'STL input mesh', 1, full, report, full['refcache'])
+    if not ret.ok:
+      return ret
+    reference = ret.val
+    opts = dict(opts, refcleaned=True)
+  if nprocs is None:
+    try:
+      nprocs = mp.cpu_count()
+    except NotImplementedError:
+      nprocs = 1
+  nprocs = max(1, min(nprocs, len(jobs)))
+  args = [(job, fileSTL, extraargs, opts) for job in jobs]
+  pool = None
+  if nprocs>1:
+    pool    = mp.Pool(nprocs, initWorker, (reference,))
+    results = pool.imap(runJob, args)
+  else:
+    initWorker(reference)
+    results = (runJob(a) for a in args)
+  try:
+    results = list(results)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+    initWorker(None)
+  if summary is not None:
+    nok = sum(r['ok'] for r in results)
+    try:
+      with open(summary, 'w') as f:
+        json.dump({'stlin':     fileSTL,
+                   'manifest':  op.abspath(manifest),
+                   'processes': nprocs,
+                   'ok':        nok,
+                   'failed':    len(results)-nok,
+                   'seconds':   time.time()-t0,
+                   'report':    report,
+                   'jobs':      results}, f, indent=1)
+    except (IOError, OSError) as e:
+      return RetVal(False, 'Could not write the summary file %s: %s' % (summary, str(e)), -1, 95)
+  return RetVal(True, results)
@@ -0,0 +1,642 @@
+#!/usr/bin/python
+
+from __future__ import print_function
+
+"""Benchmarks for the performance-sensitive parts of meshdiff. Run as a script
+to print the timings of each benchmark at several problem sizes:
+
+  benchmark.py [--json=FILE] [--sizes=N,N,...] [--engine=NAME] [--workdir=DIR] [benchmark ...]
+  benchmark.py --compare OLD.json NEW.json
+
+With --json, the results are also written to FILE (with the revision of the
+code and the versions of the libraries), so the results of two revisions can
+be compared with --compare. --sizes overrides the problem sizes of the
+benchmarks. The pipeline benchmarks run doDifference() on synthetic scans of
+synthetic parts, timing each stage (see profiling.py) with the mesh engine
+given by --engine (default: stub, which copies its first operand, so the
+timings do not depend on the external programs). The synthetic scans are
+kept in DIR (default: the system temporary directory) to reuse them"""
+
+import sys
+import time
+import json
+import platform
+import subprocess as sub
+import shutil
+import numpy as n
+import scipy
+from scipy.spatial import Delaunay
+import meshdiff
+import meshio
+import engines
+import os
+import os.path as op
+import tempfile
+
+"""the border ordering algorithm previously used in createMeshFromPointCloud,
+kept as a reference to compare against meshdiff.orderBorder: for each vertex,
+it scans the whole list of edges, so it is O(B^2)"""
+def orderBorderQuadratic(ps):
+  ps = ps.copy()
+  ordered = n.empty(ps.shape[0], dtype=n.int32)
+  ordered[0] = ps[0,0]
+  ordered[1] = ps[0,1]
+  ps[0,:] = -1
+  io = 2
+  while io<ordered.size:
+    i1, i2 = (ps==ordered[io-1]).nonzero()
+    if i1.size!=1:
+      return None
+    ordered[io] = ps[i1, (i2+1)%2]
+    ps[i1,:] = -1
+    io += 1
+  return ordered
+
+"""the OFF writer previously used in createOffFromMesh, kept as a reference to
+compare against meshio.writeOFF: it makes a copy of the triangles to add the
+vertex counts, and it writes the coordinates with 6 decimals"""
+def writeOFFSavetxt(filename, verts, triangles):
+  triangles = n.column_stack((n.full(triangles.shape[0], 3), triangles))
+  with open(filename, 'w') as f:
+    f.write("OFF\n")
+    f.write("%s %s 0\n" % (str(verts.shape[0]), str(triangles.shape[0])))
+    n.savetxt(f, verts,     fmt='%f')
+    n.savetxt(f, triangles, fmt='%d')
+
+"""the OFF reader previously used in meshio.readOFF, kept as a reference: it
+splits the whole file in tokens and converts them to numbers"""
+def readOFFTokens(filename):
+  with open(filename, 'r') as f:
+    tokens = f.read().split()
+  nv, nf = int(tokens[1]), int(tokens[2])
+  verts  = n.array(tokens[4:4+nv*3], dtype=n.float64).reshape(-1, 3)
+  faces  = n.array(tokens[4+nv*3:], dtype=n.int64)
+  return (verts, faces.reshape(-1, 4)[:,1:])
+
+"""closed mesh of a random topography with approximately ntriangles triangles"""
+def topographyMesh(ntriangles, seed=0):
+  side   = int(n.sqrt(ntriangles/2))
+  rnd    = n.random.RandomState(seed)
+  X, Y   = n.meshgrid(n.arange(side)*0.01, n.arange(side)*0.01)
+  points = n.column_stack((X.ravel(), Y.ravel(), rnd.uniform(1, 2, side*side)))
+  return meshdiff.createMeshFromPointCloud(points, [], 0.1, 'grid').val
+
+"""point cloud with nborder points in its convex hull (on a circle) and
+some random points inside"""
+def circleCloud(nborder, ninside=1000, seed=0):
+  rnd    = n.random.RandomState(seed)
+  angles = n.sort(rnd.uniform(0, 2*n.pi, nborder))
+  border = n.column_stack((n.cos(angles), n.sin(angles)))
+  radius = n.sqrt(rnd.uniform(0, 0.81, ninside))
+  angles = rnd.uniform(0, 2*n.pi, ninside)
+  inside = n.column_stack((radius*n.cos(angles), radius*n.sin(angles)))
+  return n.concatenate((border, inside))
+
+"""time a function, returning the best of several repetitions"""
+def timeit(fun, repeat=3):
+  best = float('inf')
+  for r in xrange(repeat):
+    t0   = time.time()
+    fun()
+    best = min(best, time.time()-t0)
+  return best
+
+"""border ordering: linear algorithm vs the previous quadratic one"""
+def benchBorder(sizes, quadraticmax=20000):
+  print('border ordering (B = number of border vertexes)')
+  print('%10s %14s %14s' % ('B', 'linear (s)', 'quadratic (s)'))
+  rows = []
+  for size in sizes:
+    ps      = meshdiff.delaunayBorderEdges(Delaunay(circleCloud(size)))
+    tlinear = timeit(lambda: meshdiff.orderBorder(ps))
+    times   = {'linear': tlinear}
+    if size<=quadraticmax:
+      assert (orderBorderQuadratic(ps)==meshdiff.orderBorder(ps).val).all()
+      times['quadratic'] = timeit(lambda: orderBorderQuadratic(ps), repeat=1)
+      tquad = '%14.4f' % times['quadratic']
+    else:
+      tquad = '%14s' % '-'
+    print('%10d %14.4f %s' % (ps.shape[0], tlinear, tquad))
+    rows.append({'size': ps.shape[0], 'times': times})
+  return rows
+
+"""OFF writer and reader: vectorized vs the previous ones"""
+def benchOFF(sizes):
+  print('OFF files (T = number of triangles)')
+  print('%10s %12s %12s %12s %12s %12s' % ('T', 'write (s)', 'savetxt (s)', 'read (s)', 'tokens (s)', 'max error'))
+  fd, filename = tempfile.mkstemp(suffix='.off')
+  os.close(fd)
+  rows = []
+  try:
+    for size in sizes:
+      verts, triangles = topographyMesh(size)
+      twrite = timeit(lambda: meshio.writeOFF(filename, verts, triangles))
+      tread  = timeit(lambda: meshio.readOFF(filename))
+      v, t   = meshio.readOFF(filename)
+      assert (t==triangles).all()
+      error  = n.abs(v-verts).max()
+      tsave  = timeit(lambda: writeOFFSavetxt(filename, verts, triangles))
+      ttoken = timeit(lambda: readOFFTokens(filename))
+      print('%10d %12.4f %12.4f %12.4f %12.4f %12.2e' % (triangles.shape[0], twrite, tsave, tread, ttoken, error))
+      rows.append({'size': triangles.shape[0], 'error': error,
+                   'times': {'write': twrite, 'savetxt': tsave, 'read': tread, 'tokens': ttoken}})
+  finally:
+    os.remove(filename)
+  return rows
+
+#chunks of topography files which must be parsed as parseChunkSlow() parses
+#them (malformed lines must not go through the fast path)
+parserCases = [b'1;2;3\n4;5;6\n', b'1;2;3\n4;5;6', b' 1 ; 2 ;3\r\n4;5;6\r\n', b'1;2;3\n\n4;5;6\n',
+               b'1;2;\n4;5;6 7\n', b'1 2;;3\n', b'1;2;3;4\n', b'1;2\n', b'1;2;3 # comment\n', b'1;2;x\n']
+
+"""topography parser: vectorized (see pointcloud.parseChunk) vs line by line.
+The results must be the same, also for the malformed chunks in parserCases"""
+def benchParse(sizes):
+  import pointcloud
+  for data in parserCases:
+    fast, slow = pointcloud.parseChunk(data, 1), pointcloud.parseChunkSlow(data, 1)
+    assert fast[0].shape==slow[0].shape and (fast[0]==slow[0]).all() and fast[1]==slow[1], 'parseChunk and parseChunkSlow differ for %r' % data
+  print('topography parser (N = number of points)')
+  print('%10s %12s %12s' % ('N', 'chunk (s)', 'slow (s)'))
+  rng  = n.random.RandomState(0)
+  rows = []
+  for size in sizes:
+    points = rng.uniform(-100, 100, (size, 3))
+    data   = ''.join('%.6f;%.6f;%.6f\n' % tuple(p) for p in points).encode('ascii')
+    tfast  = timeit(lambda: pointcloud.parseChunk(data, 1))
+    tslow  = timeit(lambda: pointcloud.parseChunkSlow(data, 1), repeat=1)
+    assert (pointcloud.parseChunk(data, 1)[0]==pointcloud.parseChunkSlow(data, 1)[0]).all()
+    print('%10d %12.4f %12.4f' % (size, tfast, tslow))
+    rows.append({'size': size, 'times': {'chunk': tfast, 'slow': tslow}})
+  return rows
+
+"""volume and area of a closed mesh"""
+def volumeArea(verts, triangles):
+  a, b, c = verts[triangles[:,0]], verts[triangles[:,1]], verts[triangles[:,2]]
+  normals = n.cross(b-a, c-a)
+  return (normals*a).sum()/6, n.sqrt((normals*normals).sum(axis=1)).sum()/2
+
+"""number of open edges of a mesh (directed edges without the opposite one)"""
+def openEdges(triangles):
+  edges = n.concatenate((triangles[:,[0,1]], triangles[:,[1,2]], triangles[:,[2,0]])).astype(n.int64)
+  base  = edges.max()+1 if edges.size>0 else 1
+  return int((~n.in1d(edges[:,0]*base+edges[:,1], edges[:,1]*base+edges[:,0])).sum())
+
+"""closed mesh of a random topography (see topographyMesh) with T-junctions:
+some edges of the upper face are split at their midpoints on one side, and
+the crack is closed with a triangle of zero area (as with the seams of
+meshes glued by other programs)"""
+def slivered(ntriangles, nslivers, seed=0):
+  verts, triangles = topographyMesh(ntriangles, seed)
+  rnd    = n.random.RandomState(seed)
+  picked = rnd.choice(triangles.shape[0], nslivers, replace=False)
+  #the edges of the picked triangles must be different (a split edge is split once)
+  seen   = set()
+  chosen = []
+  for t in picked:
+    edge = tuple(sorted(triangles[t,0:2]))
+    if edge not in seen:
+      seen.add(edge)
+      chosen.append(t)
+  chosen = n.array(chosen)
+  a, b, c = triangles[chosen,0], triangles[chosen,1], triangles[chosen,2]
+  m      = n.arange(verts.shape[0], verts.shape[0]+chosen.size)
+  verts  = n.concatenate((verts, (verts[a]+verts[b])/2))
+  keep   = n.ones(triangles.shape[0], dtype=bool)
+  keep[chosen] = False
+  triangles = n.concatenate((triangles[keep], n.column_stack((a, m, c)), n.column_stack((m, b, c)), n.column_stack((a, b, m))))
+  return verts, triangles.astype(n.int32), chosen.size
+
+"""cleaning of the input meshes (see clean.py): it must keep a closed mesh
+closed (and with the same volume), also with T-junctions, whose triangles of
+zero area must be fixed instead of just removed (the tolerance is not 0, as
+the midpoints of the edges are not exactly on them with rounding errors)"""
+def benchClean(sizes, tolerance=1e-9):
+  import clean
+  print('cleaning (T = number of triangles)')
+  print('%10s %10s %12s %10s %10s %12s' % ('T', 'slivers', 'clean (s)', 'open', 'removed', 'volume error'))
+  rows = []
+  for size in sizes:
+    verts, triangles, nslivers = slivered(size, max(size//1000, 1))
+    assert openEdges(triangles)==0
+    t0     = time.time()
+    v, t, counts = clean.cleanMesh(verts, triangles, tolerance)
+    tclean = time.time()-t0
+    nopen  = openEdges(t)
+    error  = abs(volumeArea(v, t)[0]-volumeArea(verts, triangles)[0])/abs(volumeArea(verts, triangles)[0])
+    print('%10d %10d %12.4f %10d %10d %12.2e' % (triangles.shape[0], nslivers, tclean, nopen, counts['degenerate'], error))
+    assert nopen==0, 'cleaning opened a closed mesh'
+    assert counts['degenerate']==nslivers and not clean.thinTriangles(v, t, tolerance)[0].any()
+    assert error<=1e-12
+    rows.append({'size': triangles.shape[0], 'error': error, 'times': {'clean': tclean}})
+  return rows
+
+"""mesh engines: the difference of a topography and a box with every available
+backend, checking that the results match the ones of the first backend
+(the volumes and areas must be the same up to float32 precision)"""
+def benchEngines(sizes, names=('cork', 'corklib', 'openscad'), tolerance=1e-4):
+  print('mesh engines (T = number of triangles of the topography)')
+  available = []
+  for name in names:
+    missing = engines.backends[name].missing(meshdiff.toolpaths)
+    if missing is None:
+      available.append(name)
+    else:
+      print('  skipping %s: %s' % (name, missing))
+  rows = []
+  if len(available)==0:
+    return rows
+  print('%10s %10s %12s %12s %14s %14s' % ('T', 'engine', 'time (s)', 'triangles', 'volume', 'area'))
+  for size in sizes:
+    verts, triangles = topographyMesh(size)
+    lo, hi = verts.min(axis=0), verts.max(axis=0)
+    mid    = (lo+hi)/2
+    box    = meshdiff.createCubicMesh([[lo[0]-1, mid[0]], [lo[1]-1, mid[1]], [mid[2], hi[2]+1]])
+    first  = None
+    times  = {}
+    for name in available:
+      engine = engines.backends[name]
+      result = [None]
+      def run():
+        result[0] = engine.boolean(meshdiff.toolpaths, 'diff', (verts, triangles), box)
+      t      = timeit(run, repeat=1)
+      times[name] = t
+      vol, area = volumeArea(*result[0])
+      print('%10d %10s %12.4f %12d %14.6g %14.6g' % (triangles.shape[0], name, t, result[0][1].shape[0], vol, area))
+      if first is None:
+        first = (vol, area)
+      else:
+        assert abs(vol-first[0])<=tolerance*abs(first[0]) and abs(area-first[1])<=tolerance*first[1], 'the results of %s and %s do not match' % (available[0], name)
+    rows.append({'size': triangles.shape[0], 'times': times})
+  return rows
+
+"""mesh engine for the pipeline benchmarks: it copies its first operand, so
+the files are written and read as with cork, but the boolean operation
+itself costs nothing"""
+class StubEngine(engines.Engine):
+  def run(self, toolpaths, operation, in1, in2, out, workdir):
+    shutil.copyfile(in1, out)
+
+engines.backends.setdefault('stub', StubEngine('stub'))
+
+"""in-process twin of StubEngine: it returns its first operand as arrays, so
+doDifference() must write the same output with both engines (see
+benchEnginePaths)"""
+class StubLibrary(engines.Engine):
+  inprocess = True
+
+  def boolean(self, toolpaths, operation, mesh1, mesh2):
+    return mesh1
+
+engines.backends.setdefault('stublib', StubLibrary('stublib'))
+
+"""synthetic reference parts, as lists of prisms (see meshdiff.createCubicMesh)
+in a 100x100 area. The prisms do not touch each other, so they are separate
+shells of a valid solid"""
+parts = {
+  'block':  [[[20, 80], [20, 80], [0, 10]]],
+  'bosses': [[[10, 45], [10, 90], [0, 8]], [[55, 90], [10, 40], [0, 12]], [[55, 90], [60, 90], [0, 5]]],
+  }
+
+"""mesh of a synthetic part"""
+def partMesh(name):
+  verts, triangles = [], []
+  for k, prism in enumerate(parts[name]):
+    v, t = meshdiff.createCubicMesh(prism)
+    verts.append(v)
+    triangles.append(t+8*k)
+  return n.concatenate(verts), n.concatenate(triangles)
+
+"""height of the surface of a synthetic part at the XY positions, plus a
+smooth deviation (the manufacturing error) of amplitude 0.2"""
+def partHeight(name, x, y):
+  z = n.zeros(x.shape)
+  for (x0, x1), (y0, y1), (z0, z1) in parts[name]:
+    inside = (x>=x0) & (x<=x1) & (y>=y0) & (y<=y1)
+    z[inside] = z1
+  return z+0.2*n.sin(x*0.3)*n.cos(y*0.2)
+
+"""write a synthetic line scanner topography of a part with approximately
+npoints points (in scan lines along X, one after another along Y, with
+noise and some missing samples) to a point cloud file, one block of lines
+at a time"""
+def writeScan(filename, name, npoints, seed=0):
+  rnd     = n.random.RandomState(seed)
+  nlines  = int(n.sqrt(npoints))
+  samples = -(-npoints//nlines)
+  xs      = n.linspace(0, 100, samples)
+  ys      = n.linspace(0, 100, nlines)
+  block   = max(1, (1<<20)//samples)
+  tmp     = filename+'.tmp'
+  with open(tmp, 'w') as f:
+    for start in xrange(0, nlines, block):
+      X, Y = n.meshgrid(xs, ys[start:start+block])
+      X, Y = X.ravel(), Y.ravel()
+      Z    = partHeight(name, X, Y)+rnd.normal(0, 0.005, X.size)
+      #scanner dropouts
+      Z[rnd.uniform(0, 1, X.size)<0.001] = n.nan
+      meshio.writeRows(f, n.column_stack((X, Y, Z)), '%.6f;%.6f;%.6f\n')
+  os.rename(tmp, filename)
+
+"""file of a synthetic scan in workdir, written only if it does not exist"""
+def scanFile(workdir, name, npoints, seed=0):
+  filename = op.join(workdir, 'scan-%s-%d-%d.txt' % (name, npoints, seed))
+  if not op.isfile(filename):
+    writeScan(filename, name, npoints, seed)
+  return filename
+
+"""pipeline: doDifference() on synthetic scans of a part, with and without XY
+limits (with and without cropping), timing every stage. The times of the
+stages are the sums over all their calls"""
+def benchPipeline(sizes, part='bosses', engine='stub', workdir=None):
+  print('pipeline (N = number of points, part %s, engine %s)' % (part, engine))
+  workdir = workdir or tempfile.gettempdir()
+  fileSTL = op.join(workdir, 'part-%s.stl' % part)
+  meshio.writeSTL(fileSTL, *partMesh(part))
+  scratch = tempfile.mkdtemp(prefix='meshdiff-benchmark-')
+  rows    = []
+  try:
+    for size in sizes:
+      filePC = scanFile(workdir, part, size)
+      for label, limits in [('full', []), ('limits', ['5', '95', '5', '95', '-1', '20'])]:
+        strargs = [filePC, fileSTL, op.join(scratch, 'out.stl'), len(limits)==6, len(limits)>0]
+        strargs += (['']*(6-len(limits)))+limits+['0.1', '', '']
+        ret = meshdiff.safeDoDifference(strargs, {'engine': engine, 'profile': True, 'scratchdir': scratch})
+        if not ret.ok:
+          print('  %d points, %s: FAILED: %s' % (size, label, ret.val))
+          continue
+        times   = {}
+        peakrss = 0
+        for record in ret.profile['stages']:
+          stage = record['stage'].split('/', 1)[-1]
+          times[stage] = times.get(stage, 0)+record['wall']
+          peakrss = max(peakrss, record['peakrss'] or 0, record['childpeakrss'] or 0)
+        print('  %d points, %s: %.3f s, peak RSS %.1f MB' % (size, label, times['difference'], peakrss/1048576.0))
+        for stage in sorted(times):
+          if stage!='difference':
+            print('    %-50s %10.4f' % (stage, times[stage]))
+        rows.append({'size': size, 'variant': label, 'peakrss': peakrss, 'times': times})
+  finally:
+    shutil.rmtree(scratch, ignore_errors=True)
+  return rows
+
+"""corners of the triangles of a STL file as rows of 9 coordinates, sorted so
+that the same triangles in a different order compare equal"""
+def stlCorners(filename):
+  verts, triangles = meshio.readSTL(filename)
+  corners = verts[triangles].reshape(-1, 9)
+  return corners[n.lexsort(corners.T[::-1])]
+
+"""mesh engine paths: doDifference() with file-based engines (on OFF files,
+see meshdiff.doDifferenceInDir) and their in-process twins (on arrays, see
+meshdiff.doBooleansInProcess), on a synthetic scan of a part with several
+kinds of limits, checking that the output STL files match up to tolerance
+(relative to the size of the part). The stub engines (see StubLibrary) do
+not need external programs, so they are always checked; the other pairs
+are checked only if both engines are available. The last variant gives
+an output file without the extension .stl, which both paths must correct"""
+def benchEnginePaths(sizes, part='bosses', pairs=(('stub', 'stublib'), ('cork', 'corklib')), workdir=None, tolerance=1e-6):
+  print('mesh engine paths (N = number of points, part %s)' % part)
+  available = []
+  for pair in pairs:
+    missing = [engines.backends[name].missing(meshdiff.toolpaths) for name in pair]
+    missing = [m for m in missing if m is not None]
+    if len(missing)==0:
+      available.append(pair)
+    else:
+      print('  skipping %s: %s' % ('/'.join(pair), missing[0]))
+  workdir  = workdir or tempfile.gettempdir()
+  fileSTL  = op.join(workdir, 'part-%s.stl' % part)
+  meshio.writeSTL(fileSTL, *partMesh(part))
+  scratch  = tempfile.mkdtemp(prefix='meshdiff-benchmark-')
+  zlimits  = [-1, 20]
+  box      = [[5, 95], [5, 95], zlimits]
+  variants = [('full',      False, [[], [], []],     {}, '.stl'),
+              ('zlimits',   False, [[], [], zlimits], {}, '.stl'),
+              ('crop',      True,  box,               {}, '.stl'),
+              ('prism',     True,  box,               {'crop': False}, '.stl'),
+              ('extension', True,  box,               {}, '.out')]
+  rows     = []
+  print('%10s %10s %16s %12s %12s %12s' % ('N', 'variant', 'engines', 'file (s)', 'array (s)', 'max error'))
+  try:
+    for size in sizes:
+      filePC = scanFile(workdir, part, size)
+      for fileengine, arrayengine in available:
+        for label, useCube, limits, opts, ext in variants:
+          outputs = []
+          times   = {}
+          for name in [fileengine, arrayengine]:
+            base = op.join(scratch, 'out-%s' % name)
+            t0   = time.time()
+            ret  = meshdiff.doDifference(filePC, fileSTL, base+ext, useCube, limits, 0.1, dict(opts, engine=name, scratchdir=scratch))
+            times[name] = time.time()-t0
+            assert ret.ok, '%s failed with %s: %s' % (label, name, ret.val)
+            assert op.isfile(base+'.stl'), '%s did not write %s' % (name, base+'.stl')
+            outputs.append(stlCorners(base+'.stl'))
+            os.remove(base+'.stl')
+          assert outputs[0].shape==outputs[1].shape, 'the outputs of %s and %s have different numbers of triangles (%s)' % (fileengine, arrayengine, label)
+          error = n.abs(outputs[0]-outputs[1]).max()
+          scale = n.abs(outputs[0]).max()
+          print('%10d %10s %16s %12.4f %12.4f %12.2e' % (size, label, fileengine+'/'+arrayengine, times[fileengine], times[arrayengine], error))
+          assert error<=tolerance*scale, 'the outputs of %s and %s do not match (%s)' % (fileengine, arrayengine, label)
+          rows.append({'size': size, 'variant': '%s %s' % (label, arrayengine), 'error': float(error), 'times': times})
+  finally:
+    shutil.rmtree(scratch, ignore_errors=True)
+  return rows
+
+"""clip a polygon (coordinates (K,3)) against the half-plane
+sign*(coord[axis]-value)>=0 of the XY plane, interpolating the other
+coordinates linearly"""
+def clipPolygon(poly, axis, value, sign):
+  out = []
+  for k in xrange(len(poly)):
+    cur, prev = poly[k], poly[k-1]
+    dcur, dprev = sign*(cur[axis]-value), sign*(prev[axis]-value)
+    if (dcur<0)!=(dprev<0) and dcur!=dprev:
+      out.append(prev+(cur-prev)*(dprev/(dprev-dcur)))
+    if dcur>=0:
+      out.append(cur)
+  return out
+
+"""volume of the intersection of a closed mesh with the infinite prism over the
+XY rectangle rect (xmin, xmax, ymin, ymax). By the divergence theorem (with
+the field (0,0,z)), it is the sum over the triangles of the integral of z n_z
+over their parts within the prism (the sides of the prism do not add to it),
+which is the signed area of their projections clipped to the rectangle times
+z at the centroid. This clips the triangles one at a time, independently of
+crop.py, to check it"""
+def prismVolume(verts, triangles, rect):
+  xmin, xmax, ymin, ymax = rect
+  planes  = [(0, xmin, 1), (0, xmax, -1), (1, ymin, 1), (1, ymax, -1)]
+  corners = verts[triangles]
+  x, y    = corners[:,:,0], corners[:,:,1]
+  inside  = ((x>=xmin) & (x<=xmax) & (y>=ymin) & (y<=ymax)).all(axis=1)
+  outside = n.zeros(triangles.shape[0], dtype=bool)
+  for axis, value, sign in planes:
+    outside |= (sign*(corners[:,:,axis]-value)<0).all(axis=1)
+  def integral(a, b, c):
+    area = ((b[...,0]-a[...,0])*(c[...,1]-a[...,1])-(c[...,0]-a[...,0])*(b[...,1]-a[...,1]))/2
+    return area*(a[...,2]+b[...,2]+c[...,2])/3
+  full    = corners[inside]
+  volume  = integral(full[:,0], full[:,1], full[:,2]).sum()
+  for tri in corners[~(inside | outside)]:
+    poly = list(tri)
+    for axis, value, sign in planes:
+      poly = clipPolygon(poly, axis, value, sign)
+    for k in xrange(1, len(poly)-1):
+      volume += integral(poly[0], poly[k], poly[k+1])
+  return volume
+
+"""cropping (see crop.py): with XY limits, doDifference() crops the mesh of the
+point cloud to the prism of the limits and subtracts the STL input mesh once,
+instead of subtracting it and then intersecting the result with the prism.
+Both give the same result if the cropped mesh is the intersection of the
+solid of the point cloud with the prism (the STL input mesh is not clipped:
+only its shells outside the prism are dropped, so it is the same in both
+cases). This is checked without a mesh engine, comparing the volume of the
+cropped mesh with the one of the uncropped mesh within the prism (see
+prismVolume). If engine is available (and it is not a stub, which does not
+compute the intersection), the volumes of the results of doDifference() with
+and without cropping are also compared. The relative differences must not
+be higher than tolerance"""
+def benchCrop(sizes, part='bosses', engine='cork', workdir=None, tolerance=1e-5):
+  print('cropping (N = number of points, part %s)' % part)
+  workdir  = workdir or tempfile.gettempdir()
+  rects    = [('centered', [5, 95, 5, 95]), ('offset', [12.3, 71.7, 33.1, 88.8])]
+  missing  = engines.backends[engine].missing(meshdiff.toolpaths) if engine in engines.backends else 'unknown engine'
+  if engine in ['stub', 'stublib']:
+    missing  = 'the stub engines do not compute the intersection with the prism'
+  if missing is not None:
+    print('  comparing doDifference() with and without cropping with %s is skipped: %s' % (engine, missing))
+    fileSTL  = None
+  else:
+    fileSTL  = op.join(workdir, 'part-%s.stl' % part)
+    meshio.writeSTL(fileSTL, *partMesh(part))
+  scratch  = tempfile.mkdtemp(prefix='meshdiff-benchmark-')
+  rows     = []
+  print('%10s %10s %10s %14s %14s %10s' % ('N', 'mesh', 'rect', 'volume', 'reference', 'rel. error'))
+  try:
+    for size in sizes:
+      filePC = scanFile(workdir, part, size)
+      points = meshdiff.pointcloud.loadPointCloud(filePC)
+      zbase  = float(n.nanmin(points[:,2]))-0.1
+      #the Z limits (below zbase, so it is not raised) leave out the missing points
+      zlimits = [zbase-1, float(n.nanmax(points[:,2]))+1]
+      for mode in ['grid', 'delaunay']:
+        whole  = meshdiff.createMeshFromPointCloud(points, zlimits, 0.1, mode, zbase=zbase)
+        assert whole.ok, whole.val
+        for label, rect in rects:
+          limits = [rect[0:2], rect[2:4], zlimits]
+          t0     = time.time()
+          ret    = meshdiff.createMeshFromPointCloud(points, zlimits, 0.1, mode, croplimits=limits, zbase=zbase)
+          times  = {'crop mesh': time.time()-t0}
+          assert ret.ok, ret.val
+          volume = volumeArea(*ret.val)[0]
+          expected = prismVolume(whole.val[0], whole.val[1], rect)
+          error  = abs(volume-expected)/abs(expected)
+          print('%10d %10s %10s %14.8g %14.8g %10.2e' % (size, mode, label, volume, expected, error))
+          assert error<=tolerance, 'the cropped mesh of the point cloud is not its intersection with the prism (%s, %s)' % (mode, label)
+          row    = {'size': size, 'variant': '%s %s' % (mode, label), 'error': error, 'times': times}
+          if fileSTL is not None and mode=='grid':
+            volumes = []
+            for crop in [True, False]:
+              out = op.join(scratch, 'out.stl')
+              t0  = time.time()
+              res = meshdiff.doDifference(filePC, fileSTL, out, True, limits, 0.1, {'engine': engine, 'crop': crop, 'scratchdir': scratch})
+              times['crop' if crop else 'prism'] = time.time()-t0
+              assert res.ok, res.val
+              volumes.append(volumeArea(*meshio.readSTL(out))[0])
+            error = abs(volumes[0]-volumes[1])/abs(volumes[1])
+            print('%10s %10s %10s %14.8g %14.8g %10.2e  doDifference() with %s: cropping vs prism' % ('', '', '', volumes[0], volumes[1], error, engine))
+            assert error<=tolerance, 'the results of doDifference() with and without cropping do not match (%s)' % label
+            row['engineerror'] = error
+          rows.append(row)
+  finally:
+    shutil.rmtree(scratch, ignore_errors=True)
+  return rows
+
+"""description of the environment of the benchmarks"""
+def environment():
+  try:
+    revision = sub.check_output(['git', 'rev-parse', 'HEAD'], cwd=op.dirname(op.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+  except (OSError, sub.CalledProcessError):
+    revision = None
+  return {'revision': revision,
+          'date':     time.strftime('%Y-%m-%d %H:%M:%S'),
+          'platform': platform.platform(),
+          'python':   platform.python_version(),
+          'numpy':    n.__version__,
+          'scipy':    scipy.__version__}
+
+"""compare the results of two runs (JSON files written with --json), printing
+the ratios of the times (new/old) of the rows present in both. Ratios above
+threshold are flagged, unless the old time is below mintime (too noisy)"""
+def compare(oldfile, newfile, threshold=1.1, mintime=0.01):
+  with open(oldfile) as f:
+    old = json.load(f)
+  with open(newfile) as f:
+    new = json.load(f)
+  print('%s (%s) -> %s (%s)' % (oldfile, old['environment']['revision'], newfile, new['environment']['revision']))
+  print('%-10s %-10s %-50s %10s %10s %8s' % ('benchmark', 'size', 'time', 'old (s)', 'new (s)', 'ratio'))
+  key = lambda row: (row['size'], row.get('variant'))
+  for name in sorted(set(old['results']) & set(new['results'])):
+    oldrows = dict((key(row), row) for row in old['results'][name])
+    for row in new['results'][name]:
+      if key(row) not in oldrows:
+        continue
+      oldtimes = oldrows[key(row)]['times']
+      for label in sorted(set(oldtimes) & set(row['times'])):
+        a, b  = oldtimes[label], row['times'][label]
+        ratio = b/a if a>0 else float('inf')
+        flag  = '  SLOWER' if ratio>threshold and a>=mintime else ''
+        size  = '%d%s' % (row['size'], '' if row.get('variant') is None else ' '+row['variant'])
+        print('%-10s %-10s %-50s %10.4f %10.4f %8.2f%s' % (name, size, label, a, b, ratio, flag))
+
+#benchmarks: functions taking the problem sizes and the settings from the
+#command line, and their default sizes. The benchmarks not in defaults are
+#only run if they are named in the command line
+benchmarks = {
+  'border':   (lambda sizes, cfg: benchBorder(sizes), [1000, 5000, 20000, 100000]),
+  'off':      (lambda sizes, cfg: benchOFF(sizes), [100000, 1000000, 4000000]),
+  'parse':    (lambda sizes, cfg: benchParse(sizes), [100000, 1000000]),
+  'engines':  (lambda sizes, cfg: benchEngines(sizes), [10000, 100000, 1000000]),
+  'clean':    (lambda sizes, cfg: benchClean(sizes), [10000, 100000, 1000000]),
+  'enginepaths': (lambda sizes, cfg: benchEnginePaths(sizes, workdir=cfg['workdir']), [10000, 100000]),
+  'crop':     (lambda sizes, cfg: benchCrop(sizes, engine=cfg['engine'], workdir=cfg['workdir']), [10000, 100000]),
+  'pipeline': (lambda sizes, cfg: benchPipeline(sizes, engine=cfg['engine'], workdir=cfg['workdir']), [10000, 100000, 1000000]),
+  'pipeline-large': (lambda sizes, cfg: benchPipeline(sizes, engine=cfg['engine'], workdir=cfg['workdir']), [10000000, 50000000]),
+  }
+defaults = ['border', 'off', 'parse', 'clean', 'engines', 'enginepaths', 'crop', 'pipeline']
+
+"""main function: run the benchmarks named in the command line (the default
+ones if none)"""
+def main(argv):
+  cfg   = {'json': None, 'sizes': None, 'engine': 'stub', 'workdir': None}
+  names = []
+  args  = argv[1:]
+  if len(args)==3 and args[0]=='--compare':
+    compare(args[1], args[2])
+    return
+  for arg in args:
+    if arg.startswith('--'):
+      key, eq, value = arg[2:].partition('=')
+      if key not in cfg or eq=='':
+        print('Unknown or malformed flag: '+arg)
+        return
+      cfg[key] = [int(x) for x in value.split(',')] if key=='sizes' else value
+    else:
+      names.append(arg)
+  results = {}
+  for name in names or defaults:
+    if name not in benchmarks:
+      print('Unknown benchmark %s, available: %s' % (name, ', '.join(sorted(benchmarks.keys()))))
+      continue
+    fun, sizes = benchmarks[name]
+    results[name] = fun(cfg['sizes'] or sizes, cfg)
+  if cfg['json'] is not None:
+    with open(cfg['json'], 'w') as f:
+      json.dump({'environment': environment(), 'settings': cfg, 'results': results}, f, indent=1)
+    print('results written to '+cfg['json'])
+
+if __name__=='__main__':
+  main(sys.argv)
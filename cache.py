@@ -0,0 +1,301 @@
+import numpy as n
+import os
+import os.path as op
+import hashlib
+import json
+import time
+import tempfile
+import traceback
+try:
+  import fcntl
+except ImportError:
+  #Windows
+  fcntl = None
+  import msvcrt
+
+"""Caches of intermediate data, to avoid repeating work between runs. Cached
+files are registered in index files (in JSON format) stored in cachedir, which
+record their sizes and the last time they were used, so that the least
+recently used ones can be evicted when the cache grows beyond its size limit.
+The caches are shared by concurrent processes (batch and watch modes) and
+threads (service mode): the index files are changed while holding a lock
+file next to them (see fileLock), and the files are written to unique
+temporary files which are then renamed"""
+
+DEBUG = True
+
+cachedir = op.join(op.expanduser('~'), '.meshdiff')
+
+#size limit for the point cloud sidecar files
+pccachemaxbytes = 8<<30
+
+#size limit for the cached STL input meshes and the data derived from them
+refcachemaxbytes = 2<<30
+
+"""context manager to hold an exclusive lock of lockfile (created if it does
+not exist), between processes and between threads"""
+class fileLock(object):
+  def __init__(self, lockfile):
+    self.lockfile = lockfile
+
+  def __enter__(self):
+    makeDirFor(self.lockfile)
+    self.f = open(self.lockfile, 'a+b')
+    try:
+      if fcntl is not None:
+        fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+      else:
+        #LK_LOCK gives up after 10 seconds
+        self.f.seek(0)
+        while True:
+          try:
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+            break
+          except IOError:
+            pass
+    except:
+      self.f.close()
+      raise
+    return self
+
+  def __exit__(self, *exc):
+    try:
+      if fcntl is not None:
+        fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+      else:
+        self.f.seek(0)
+        msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+    finally:
+      self.f.close()
+    return False
+
+"""index of cached files, with LRU eviction. Each change of the index (load,
+change and save) holds its lock file, so concurrent changes are not lost"""
+class LRUIndex(object):
+  def __init__(self, indexfile):
+    self.indexfile = indexfile
+    self.lockfile  = indexfile+'.lock'
+
+  def load(self):
+    try:
+      with open(self.indexfile, 'r') as f:
+        return json.load(f)
+    except (IOError, OSError, ValueError):
+      return {}
+
+  def save(self, entries):
+    f, tmp = tempFile(self.indexfile, 'w')
+    with f:
+      json.dump(entries, f)
+    replaceFile(tmp, self.indexfile)
+
+  """register a file as used now"""
+  def touch(self, path):
+    with fileLock(self.lockfile):
+      entries = self.load()
+      entries[path] = {'size': op.getsize(path), 'used': time.time()}
+      self.save(entries)
+
+  """unregister a file"""
+  def forget(self, path):
+    with fileLock(self.lockfile):
+      entries = self.load()
+      if entries.pop(path, None) is not None:
+        self.save(entries)
+
+  """remove the least recently used files until their total size is below
+  maxbytes, never removing the files in keep. Returns the removed files"""
+  def evict(self, maxbytes, keep=()):
+    with fileLock(self.lockfile):
+      entries = self.load()
+      entries = dict((p, e) for p, e in entries.iteritems() if op.isfile(p))
+      total   = sum(e['size'] for e in entries.itervalues())
+      removed = []
+      for path, entry in sorted(entries.iteritems(), key=lambda pe: pe[1]['used']):
+        if total<=maxbytes:
+          break
+        if path in keep:
+          continue
+        removeQuietly(path)
+        total -= entry['size']
+        del entries[path]
+        removed.append(path)
+      self.save(entries)
+    return removed
+
+"""create the directory of path if it does not exist"""
+def makeDirFor(path):
+  dr = op.dirname(path)
+  if not op.isdir(dr):
+    try:
+      os.makedirs(dr)
+    except OSError:
+      #it may have been created by another process
+      if not op.isdir(dr):
+        raise
+
+"""new temporary file (with a unique name) next to path, to be renamed to
+path when it is complete. Returns the open file (with the given mode) and
+its name"""
+def tempFile(path, mode='wb'):
+  makeDirFor(path)
+  fd, tmp = tempfile.mkstemp(prefix=op.basename(path)+'.', suffix='.tmp', dir=op.dirname(path))
+  return os.fdopen(fd, mode), tmp
+
+"""rename src to dst, overwriting dst (os.rename fails in Windows if dst exists)"""
+def replaceFile(src, dst):
+  if os.name=='nt' and op.isfile(dst):
+    os.remove(dst)
+  os.rename(src, dst)
+
+"""remove a file, ignoring errors"""
+def removeQuietly(path):
+  try:
+    if op.isfile(path):
+      os.remove(path)
+  except (IOError, OSError):
+    if DEBUG: traceback.print_exc()
+
+"""hash of the contents of a file"""
+def fileHash(filename, blocksize=1<<20):
+  h = hashlib.sha1()
+  with open(filename, 'rb') as f:
+    while True:
+      block = f.read(blocksize)
+      if len(block)==0:
+        break
+      h.update(block)
+  return h.hexdigest()
+
+"""key identifying the current version of a file"""
+def fileKey(filename, usehash=False):
+  st  = os.stat(filename)
+  key = [op.abspath(filename), st.st_size, repr(st.st_mtime)]
+  if usehash:
+    key.append(fileHash(filename))
+  return key
+
+pcindex = LRUIndex(op.join(cachedir, 'pccache.json'))
+
+"""name of the sidecar file for a point cloud file (without the key digest)"""
+def sidecarPrefix(filePC):
+  return op.abspath(filePC)+'.meshdiff-'
+
+"""existing sidecar files for a point cloud file"""
+def sidecarFiles(filePC):
+  prefix = sidecarPrefix(filePC)
+  dr     = op.dirname(prefix)
+  name   = op.basename(prefix)
+  return [op.join(dr, f) for f in os.listdir(dr) if f.startswith(name) and f.endswith('.npy')]
+
+"""load a point cloud, using a sidecar .npy file next to it if it is present
+and it is up to date. Otherwise, load the point cloud with loader(filePC) and
+store it in a new sidecar file. Sidecar files are loaded as memory maps, so
+no copy of the data is done. Returns a tuple (points, True if there was a
+cache hit)"""
+def loadPointCloudCached(filePC, loader, usehash=False, maxbytes=None):
+  if maxbytes is None:
+    maxbytes = pccachemaxbytes
+  digest  = hashlib.sha1(repr(fileKey(filePC, usehash))).hexdigest()[:16]
+  sidecar = sidecarPrefix(filePC)+digest+'.npy'
+  if op.isfile(sidecar):
+    try:
+      points = n.load(sidecar, mmap_mode='r')
+      pcindex.touch(sidecar)
+      return points, True
+    except (IOError, OSError, ValueError):
+      if DEBUG: traceback.print_exc()
+  points = loader(filePC)
+  try:
+    #sidecars for previous versions of the file are not useful anymore
+    for old in sidecarFiles(filePC):
+      removeQuietly(old)
+      pcindex.forget(old)
+    f, tmp = tempFile(sidecar)
+    with f:
+      n.save(f, points)
+    replaceFile(tmp, sidecar)
+    pcindex.touch(sidecar)
+    pcindex.evict(maxbytes, keep=(sidecar,))
+  except (IOError, OSError):
+    #the cache is an optimization, so failing to write it is not an error
+    if DEBUG: traceback.print_exc()
+  return points, False
+
+refindex = LRUIndex(op.join(cachedir, 'refcache.json'))
+refdir   = op.join(cachedir, 'references')
+
+"""load a file of cached arrays (a .npz file), returning a dictionary of
+arrays, or None if it is not present or it cannot be read"""
+def loadArrays(path, index):
+  if not op.isfile(path):
+    return None
+  try:
+    with n.load(path) as data:
+      arrays = dict((k, data[k]) for k in data.files)
+    index.touch(path)
+    return arrays
+  except (IOError, OSError, ValueError, KeyError):
+    if DEBUG: traceback.print_exc()
+    return None
+
+"""store a dictionary of arrays in a file of cached arrays, evicting the least
+recently used files if the cache grows beyond maxbytes. Returns the number
+of evicted files"""
+def storeArrays(path, arrays, index, maxbytes):
+  try:
+    f, tmp = tempFile(path)
+    with f:
+      n.savez(f, **arrays)
+    replaceFile(tmp, path)
+    index.touch(path)
+    return len(index.evict(maxbytes, keep=(path,)))
+  except (IOError, OSError):
+    #the cache is an optimization, so failing to write it is not an error
+    if DEBUG: traceback.print_exc()
+    return 0
+
+"""message about a cache lookup"""
+def cacheMessage(what, hit, evicted):
+  if hit:
+    return '%s: cache hit' % what
+  return '%s: cache miss%s' % (what, '' if evicted==0 else ' (%d files evicted)' % evicted)
+
+"""load the STL input mesh fileSTL, using the cached mesh if the contents of
+the file and the settings of the conversion (any object with a stable repr)
+are the same as in a previous run. Otherwise, load it with loader(fileSTL)
+(which returns (verts, triangles), or None if the mesh cannot be loaded)
+and cache it. Returns the mesh (or None) and a message with the outcome"""
+def loadReferenceCached(fileSTL, loader, settings, maxbytes=None):
+  if maxbytes is None:
+    maxbytes = refcachemaxbytes
+  digest = hashlib.sha1(repr([fileHash(fileSTL), settings])).hexdigest()[:16]
+  path   = op.join(refdir, digest+'.npz')
+  arrays = loadArrays(path, refindex)
+  if arrays is not None:
+    return (arrays['verts'], arrays['triangles']), cacheMessage('STL input mesh', True, 0)
+  mesh   = loader(fileSTL)
+  if mesh is None:
+    return None, cacheMessage('STL input mesh', False, 0)
+  evicted = storeArrays(path, {'verts': mesh[0], 'triangles': mesh[1]}, refindex, maxbytes)
+  return mesh, cacheMessage('STL input mesh', False, evicted)
+
+"""data derived from a mesh (verts, triangles) by builder(verts, triangles),
+which returns a dictionary of arrays. It is cached by name and the contents
+of the mesh, so it can be reused for the same mesh whatever file it comes
+from. Returns the arrays and a message with the outcome"""
+def derivedCached(name, mesh, builder, maxbytes=None):
+  if maxbytes is None:
+    maxbytes = refcachemaxbytes
+  h = hashlib.sha1(name)
+  for array in mesh:
+    array = n.ascontiguousarray(array)
+    h.update(repr((array.dtype.str, array.shape)))
+    h.update(array.data)
+  path   = op.join(refdir, '%s-%s.npz' % (name, h.hexdigest()[:16]))
+  arrays = loadArrays(path, refindex)
+  if arrays is not None:
+    return arrays, cacheMessage(name, True, 0)
+  arrays  = builder(*mesh)
+  evicted = storeArrays(path, arrays, refindex, maxbytes)
+  return arrays, cacheMessage(name, False, evicted)
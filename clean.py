@@ -0,0 +1,269 @@
+import numpy as n
+
+"""Cleaning of the input meshes before the boolean operations. Cork has trouble
+with degenerate triangles, and duplicated vertexes and triangles make the
+meshes bigger (and the mesh engine slower) for nothing, so they are removed
+before the meshes are passed to the engine. All steps are vectorized:
+
+  -vertexes closer than a tolerance are welded. The space is split in cubic
+   cells with side the tolerance, and the vertexes in each cell are replaced
+   by the first one of them (so vertexes closer than the tolerance but in
+   neighbouring cells are not welded). With tolerance 0, only identical
+   vertexes are welded.
+
+  -degenerate triangles are removed: those with repeated vertexes (after
+   welding).
+
+  -thin triangles (the height over their longest edge is not higher than
+   the tolerance; with tolerance 0, triangles with zero area) are not just
+   removed, as that would open a crack in a closed mesh. If their shortest
+   edge is not longer than the tolerance, it is collapsed (its vertexes are
+   welded, so the triangle has repeated vertexes and it is removed).
+   Otherwise (a T-junction: the apex is on the longest edge), the apex is
+   welded onto the longest edge: the triangle on the other side of the edge
+   is split in two at the apex, and the thin triangle is removed. This is
+   repeated until there are no thin triangles (or they cannot be fixed:
+   their longest edges are open, and they are kept).
+
+  -duplicate triangles (with the same vertexes) are removed. Copies with
+   opposite orientations cancel each other (they are an internal wall with
+   no volume), and the remaining copies are replaced by a single one.
+
+  -vertexes not used by any triangle are removed"""
+
+"""group the identical rows of a (N,K) array of integers. Returns the index of
+the first row of each group and the group of each row.
+This is n.unique(..., return_index=True, return_inverse=True) on rows, but
+the rows are packed in single integers, which are much faster to sort than
+rows (with lexsort or as opaque values)"""
+def groupRows(keys):
+  ids    = n.zeros(keys.shape[0], dtype=n.int64)
+  nids   = 1
+  for k in xrange(keys.shape[1]):
+    col  = keys[:,k].astype(n.int64)
+    if col.size>0:
+      col -= col.min()
+    width = int(col.max())+1 if col.size>0 else 1
+    if float(nids)*width>=2**62:
+      #too big to be packed: number the distinct values of the packed columns instead
+      _, ids = n.unique(ids, return_inverse=True)
+      nids   = int(ids.max())+1
+      if float(nids)*width>=2**62:
+        _, col = n.unique(col, return_inverse=True)
+        width  = int(col.max())+1
+    ids  = ids*width+col
+    nids = nids*width
+  order  = n.argsort(ids)
+  sk     = ids[order]
+  newgroup = n.empty(order.size, dtype=bool)
+  newgroup[:1] = True
+  newgroup[1:] = sk[1:]!=sk[:-1]
+  starts = n.flatnonzero(newgroup)
+  first  = n.minimum.reduceat(order, starts) if order.size>0 else order
+  inverse = n.empty(order.size, dtype=n.int64)
+  inverse[order] = n.cumsum(newgroup)-1
+  return first, inverse
+
+"""weld the vertexes closer than tolerance (see the description of the
+module). Returns the new vertexes and the new index of each old vertex"""
+def weldVertices(verts, tolerance=0.0):
+  #single precision vertexes (see the option 'compact' in meshdiff.py) are kept as they are
+  dtype = n.float32 if verts.dtype==n.float32 else n.float64
+  verts = n.ascontiguousarray(verts, dtype=dtype)
+  if tolerance>0:
+    keys = n.floor(verts/tolerance).astype(n.int64)
+  else:
+    #the bits of the coordinates (+0.0 to normalize negative zeros, so that
+    #they are welded with positive zeros)
+    keys = (verts+dtype(0)).view(n.int32 if dtype==n.float32 else n.int64)
+  first, inverse = groupRows(keys)
+  #keep the vertexes in their original order (the groups are sorted by their keys)
+  order = n.argsort(first)
+  rank  = n.empty(order.size, dtype=n.int64)
+  rank[order] = n.arange(order.size)
+  return verts[first[order]], rank[inverse]
+
+#maximum number of rounds of closeThinTriangles()
+maxrounds = 32
+
+"""mask of the degenerate triangles: those with repeated vertexes"""
+def degenerateTriangles(triangles):
+  t0, t1, t2 = triangles[:,0], triangles[:,1], triangles[:,2]
+  return (t0==t1) | (t1==t2) | (t2==t0)
+
+"""thin triangles (see the description of the module) without repeated
+vertexes. Returns their mask, and the index k of the longest and the
+shortest edges of each triangle (edge k goes from vertex k to vertex k+1)
+and the length of the shortest one"""
+def thinTriangles(verts, triangles, tolerance=0.0):
+  a, b, c  = verts[triangles[:,0]], verts[triangles[:,1]], verts[triangles[:,2]]
+  cross    = n.cross(b-a, c-a)
+  #twice the area, and the height over the longest edge is dblarea/longest
+  dblarea  = n.sqrt((cross*cross).sum(axis=1))
+  lengths  = n.column_stack((((b-a)**2).sum(axis=1), ((c-b)**2).sum(axis=1), ((a-c)**2).sum(axis=1)))
+  longest  = n.argmax(lengths, axis=1)
+  shortest = n.argmin(lengths, axis=1)
+  rows     = n.arange(triangles.shape[0])
+  thin     = (dblarea<=tolerance*n.sqrt(lengths[rows, longest])) & ~degenerateTriangles(triangles)
+  return thin, longest, shortest, n.sqrt(lengths[rows, shortest])
+
+"""collapse the shortest edges of the thin triangles thin (indexes). Returns
+the new triangles (without the ones with repeated vertexes)"""
+def collapseEdges(nverts, triangles, thin, shortest):
+  root = n.arange(nverts)
+  def find(v):
+    while root[v]!=v:
+      root[v] = root[root[v]]
+      v       = root[v]
+    return v
+  for t in thin:
+    k      = shortest[t]
+    r1, r2 = find(triangles[t,k]), find(triangles[t,(k+1)%3])
+    #the lowest vertex is kept
+    root[max(r1, r2)] = min(r1, r2)
+  while True:
+    parent = root[root]
+    if (parent==root).all():
+      break
+    root = parent
+  triangles = root[triangles]
+  return triangles[~degenerateTriangles(triangles)]
+
+"""weld the apexes of the thin triangles thin (indexes) onto their longest
+edges, splitting the triangles on the other sides of the edges. Returns the
+new triangles and the number of removed thin triangles"""
+def splitNeighbours(verts, triangles, thin, longest, tolerance):
+  keys    = triangles.astype(n.int64)*verts.shape[0]+n.roll(triangles, -1, axis=1)
+  k       = longest[thin]
+  wanted  = triangles[thin, (k+1)%3].astype(n.int64)*verts.shape[0]+triangles[thin, k]
+  #only the thin triangles and their neighbours are changed
+  relevant = n.in1d(keys.ravel(), wanted).reshape(keys.shape).any(axis=1)
+  relevant[thin] = True
+  current = dict((t, tuple(triangles[t])) for t in n.flatnonzero(relevant))
+  edges   = {}
+  def link(t, tri, add):
+    for j in xrange(3):
+      edge = (tri[j], tri[(j+1)%3])
+      if add:
+        edges[edge] = t
+      elif edges.get(edge)==t:
+        del edges[edge]
+  for t, tri in current.iteritems():
+    link(t, tri, True)
+  nextra  = 0
+  removed = 0
+  for s in thin:
+    tri = current[s]
+    if tri is None:
+      continue
+    #it may have been changed as the neighbour of a previous one
+    still, longk, _, _ = thinTriangles(verts, n.array([tri]), tolerance)
+    if not still[0]:
+      continue
+    j       = longk[0]
+    a, b, c = tri[j], tri[(j+1)%3], tri[(j+2)%3]
+    t       = edges.get((b, a))
+    if t is None or t==s:
+      continue
+    nb      = current[t]
+    d       = nb[(nb.index(b)+2)%3]
+    link(s, tri, False)
+    link(t, nb, False)
+    current[s] = None
+    removed   += 1
+    if d==c:
+      #the neighbour is the same triangle with the opposite orientation: both cancel
+      current[t] = None
+      continue
+    new        = triangles.shape[0]+nextra
+    nextra    += 1
+    current[t] = (b, c, d)
+    current[new] = (c, a, d)
+    link(t, current[t], True)
+    link(new, current[new], True)
+  if removed==0:
+    return triangles, 0
+  triangles = n.concatenate((triangles, n.zeros((nextra, 3), dtype=triangles.dtype)))
+  keep      = n.ones(triangles.shape[0], dtype=bool)
+  for t, tri in current.iteritems():
+    if tri is None:
+      keep[t] = False
+    else:
+      triangles[t] = tri
+  return triangles[keep], removed
+
+"""fix the thin triangles, keeping closed meshes closed (see the description
+of the module). Returns the new triangles and the number of removed
+triangles"""
+def closeThinTriangles(verts, triangles, tolerance=0.0):
+  removed = 0
+  for r in xrange(maxrounds):
+    thin, longest, shortest, short = thinTriangles(verts, triangles, tolerance)
+    collapse = n.flatnonzero(thin & (short<=tolerance))
+    if collapse.size>0:
+      ntris     = triangles.shape[0]
+      triangles = collapseEdges(verts.shape[0], triangles, collapse, shortest)
+      removed  += ntris-triangles.shape[0]
+      continue
+    thin = n.flatnonzero(thin)
+    if thin.size==0:
+      break
+    triangles, count = splitNeighbours(verts, triangles, thin, longest, tolerance)
+    if count==0:
+      break
+    removed += count
+  return triangles, removed
+
+"""mask of the triangles to keep after removing the duplicates (see the
+description of the module)"""
+def uniqueTriangles(triangles):
+  if triangles.shape[0]==0:
+    return n.zeros(0, dtype=bool)
+  rows   = n.arange(triangles.shape[0])
+  #each triangle rotated to start with its lowest vertex: it has the same
+  #orientation as the sorted vertexes if the other two are in ascending order
+  lowest = n.argmin(triangles, axis=1)
+  second = triangles[rows, (lowest+1)%3]
+  third  = triangles[rows, (lowest+2)%3]
+  sign   = n.where(second<third, 1, -1)
+  _, inverse = groupRows(n.sort(triangles, axis=1))
+  net    = n.sign(n.bincount(inverse, weights=sign)).astype(n.int64)
+  #in each group, the first triangle with the orientation of the net sum is kept
+  candidate = n.flatnonzero(sign==net[inverse])
+  _, first  = n.unique(inverse[candidate], return_index=True)
+  keep   = n.zeros(triangles.shape[0], dtype=bool)
+  keep[candidate[first]] = True
+  return keep
+
+"""remove the vertexes not used by any triangle. Returns the new vertexes and
+triangles"""
+def compactVertices(verts, triangles):
+  used  = n.zeros(verts.shape[0], dtype=bool)
+  used[triangles] = True
+  remap = n.cumsum(used)-1
+  return verts[used], remap[triangles]
+
+"""clean the mesh (verts, triangles) (see the description of the module).
+Returns the new vertexes and triangles and a dictionary with the numbers of
+welded vertexes ('welded'), removed degenerate and duplicate triangles
+('degenerate', 'duplicate') and removed unused vertexes ('unused')"""
+def cleanMesh(verts, triangles, tolerance=0.0):
+  dtype     = triangles.dtype
+  nverts    = verts.shape[0]
+  verts, remap = weldVertices(verts, tolerance)
+  triangles = remap[triangles]
+  welded    = nverts-verts.shape[0]
+  ntris     = triangles.shape[0]
+  triangles = triangles[~degenerateTriangles(triangles)]
+  triangles, thin = closeThinTriangles(verts, triangles, tolerance)
+  degenerate = ntris-triangles.shape[0]+thin
+  ntris     = triangles.shape[0]
+  triangles = triangles[uniqueTriangles(triangles)]
+  duplicate = ntris-triangles.shape[0]
+  nverts    = verts.shape[0]
+  verts, triangles = compactVertices(verts, triangles)
+  counts    = {'welded':     welded,
+               'degenerate': degenerate,
+               'duplicate':  duplicate,
+               'unused':     nverts-verts.shape[0]}
+  return verts, triangles.astype(dtype), counts
@@ -0,0 +1,148 @@
+import numpy as n
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+"""Cropping of the input meshes to the box given by the XYZ limits, so that
+the difference can be computed with a single boolean operation (instead of a
+difference followed by an intersection with the prism of the limits).
+
+The upper face of the topography is clipped to the XY rectangle of the limits
+(the rest of the solid is built from the border of the clipped face, so the
+cropped solid is exactly the intersection with the prism). The reference mesh
+cannot be clipped without closing it again, so only its shells (connected
+components) lying completely outside the box are dropped: they cannot affect
+the difference within the box"""
+
+#points closer than this (relative to the size of the rectangle) to its sides are moved to them
+snaptolerance = 1e-9
+
+"""clip a set of convex polygons against the half-plane sign*(coord[axis]-value)>=0.
+Polygons are given as coordinates (C,K,3), indexes of their vertexes in the
+original mesh (C,K, -1 for new vertexes) and number of vertexes (C,). This is
+the Sutherland-Hodgman algorithm, with all polygons processed at once"""
+def clipPolygons(coords, ids, count, axis, value, sign):
+  npolys, kmax = ids.shape
+  rows   = n.arange(npolys)[:,n.newaxis]
+  k      = n.arange(kmax)[n.newaxis,:]
+  valid  = k<count[:,n.newaxis]
+  prevk  = (k-1)%n.maximum(count, 1)[:,n.newaxis]
+  cur    = coords
+  prev   = coords[rows, prevk]
+  dcur   = sign*(cur[:,:,axis]-value)
+  dprev  = sign*(prev[:,:,axis]-value)
+  incur  = valid & (dcur>=0)
+  cross  = valid & (((dcur>0) & (dprev<0)) | ((dcur<0) & (dprev>0)))
+  #the intersection is computed always from the endpoint with the lower
+  #coordinate, so the same edge in two triangles gives exactly the same point
+  swap   = (prev[:,:,axis]>cur[:,:,axis])[:,:,n.newaxis]
+  lo     = n.where(swap, cur, prev)
+  hi     = n.where(swap, prev, cur)
+  denom  = hi[:,:,axis]-lo[:,:,axis]
+  denom[denom==0] = 1
+  t      = (value-lo[:,:,axis])/denom
+  inters = lo+t[:,:,n.newaxis]*(hi-lo)
+  inters[:,:,axis] = value
+  #each edge emits the intersection (if it crosses the line) and then its end (if inside)
+  outc   = n.empty((npolys, 2*kmax, 3), dtype=coords.dtype)
+  outc[:,0::2] = inters
+  outc[:,1::2] = cur
+  outi   = n.empty((npolys, 2*kmax), dtype=ids.dtype)
+  outi[:,0::2] = -1
+  outi[:,1::2] = ids
+  mask   = n.empty((npolys, 2*kmax), dtype=bool)
+  mask[:,0::2] = cross
+  mask[:,1::2] = incur
+  order  = n.argsort(~mask, axis=1, kind='mergesort')[:,:kmax+1]
+  rows   = n.arange(npolys)[:,n.newaxis]
+  return outc[rows, order], outi[rows, order], mask.sum(axis=1)
+
+"""clip a mesh (an upper face, oriented counterclockwise in the XY plane) to
+the XY rectangle (xmin, xmax, ymin, ymax). Points are interpolated linearly at
+the sides of the rectangle. Returns the new points and triangles (unused
+points are removed)"""
+def clipToRect(points, triangles, rect):
+  xmin, xmax, ymin, ymax = rect
+  planes = [(0, xmin, 1), (0, xmax, -1), (1, ymin, 1), (1, ymax, -1)]
+  #snap points very close to the sides of the rectangle, to avoid slivers
+  tol    = snaptolerance*max(xmax-xmin, ymax-ymin)
+  for axis, value, sign in planes:
+    near = n.abs(points[:,axis]-value)<=tol
+    if near.any():
+      if not points.flags.writeable or points.base is not None:
+        points = points.copy()
+      points[near,axis] = value
+  x, y   = points[:,0], points[:,1]
+  inside = (x>=xmin) & (x<=xmax) & (y>=ymin) & (y<=ymax)
+  full   = inside[triangles].all(axis=1)
+  out    = n.zeros(triangles.shape[0], dtype=bool)
+  for axis, value, sign in planes:
+    out |= (sign*(points[triangles,axis]-value)<0).all(axis=1)
+  cut    = ~(full | out)
+  #clip the triangles crossing the sides of the rectangle
+  ids    = triangles[cut]
+  coords = points[ids].astype(n.float64)
+  count  = n.empty(ids.shape[0], dtype=n.int64)
+  count.fill(3)
+  for axis, value, sign in planes:
+    coords, ids, count = clipPolygons(coords, ids, count, axis, value, sign)
+  #split the clipped polygons (which are convex) in fans of triangles
+  fanc   = []
+  fani   = []
+  for k in xrange(1, ids.shape[1]-1):
+    sel  = count>k+1
+    fanc.append(coords[sel][:,[0,k,k+1]])
+    fani.append(ids[sel][:,[0,k,k+1]])
+  fanc   = n.concatenate(fanc) if len(fanc)>0 else n.empty((0, 3, 3))
+  fani   = n.concatenate(fani) if len(fani)>0 else n.empty((0, 3), dtype=n.int64)
+  #merge the new points (the same point is generated by both triangles sharing an edge)
+  isnew  = fani<0
+  newc   = n.ascontiguousarray(fanc[isnew])
+  rowsv  = newc.view(n.dtype((n.void, newc.dtype.itemsize*3))).ravel()
+  uniq, first, inverse = n.unique(rowsv, return_index=True, return_inverse=True)
+  fani   = fani.copy()
+  fani[isnew] = points.shape[0]+inverse
+  allp   = n.concatenate((points, newc[first].astype(points.dtype)))
+  tris   = n.concatenate((triangles[full], fani))
+  tris   = tris[(tris[:,0]!=tris[:,1]) & (tris[:,1]!=tris[:,2]) & (tris[:,2]!=tris[:,0])]
+  #remove unused points
+  used   = n.zeros(allp.shape[0], dtype=bool)
+  used[tris] = True
+  remap  = n.cumsum(used)-1
+  return allp[used], remap[tris]
+
+"""edges in the border of a mesh (those used by only one triangle), keeping
+their orientation in the triangles"""
+def borderEdges(triangles):
+  edges  = n.concatenate((triangles[:,[0,1]], triangles[:,[1,2]], triangles[:,[2,0]]))
+  #each undirected edge as a single integer (sorting it is much faster than sorting pairs)
+  lo     = n.minimum(edges[:,0], edges[:,1]).astype(n.int64)
+  hi     = n.maximum(edges[:,0], edges[:,1]).astype(n.int64)
+  keys   = lo*(int(edges.max())+1)+hi
+  uniq, inverse, counts = n.unique(keys, return_inverse=True, return_counts=True)
+  return edges[counts[inverse]==1]
+
+"""drop the shells (connected components) of a mesh whose bounding boxes do not
+intersect the box given by limits ([[xmin, xmax], [ymin, ymax], [zmin, zmax]])
+expanded by margin. Returns the new vertexes and triangles and the number of
+shells before and after"""
+def dropShellsOutsideBox(verts, triangles, limits, margin=0.0):
+  nv      = verts.shape[0]
+  ones    = n.ones(triangles.shape[0]*2, dtype=n.int8)
+  rows    = n.concatenate((triangles[:,0], triangles[:,1]))
+  cols    = n.concatenate((triangles[:,1], triangles[:,2]))
+  nshells, labels = connected_components(coo_matrix((ones, (rows, cols)), shape=(nv, nv)), directed=False)
+  order   = n.argsort(labels, kind='mergesort')
+  starts  = n.searchsorted(labels[order], n.arange(nshells))
+  lo      = n.minimum.reduceat(verts[order], starts, axis=0)
+  hi      = n.maximum.reduceat(verts[order], starts, axis=0)
+  boxlo   = n.array([l[0] for l in limits])-margin
+  boxhi   = n.array([l[1] for l in limits])+margin
+  keep    = ((lo<=boxhi) & (hi>=boxlo)).all(axis=1)
+  #shells with vertexes but without triangles are unused vertexes
+  tkeep   = keep[labels[triangles[:,0]]]
+  tris    = triangles[tkeep]
+  used    = n.zeros(nv, dtype=bool)
+  used[tris] = True
+  remap   = n.cumsum(used)-1
+  shells  = n.unique(labels[triangles[:,0]])
+  return verts[used], remap[tris], shells.size, int(keep[shells].sum())
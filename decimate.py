@@ -0,0 +1,80 @@
+import numpy as n
+
+"""Decimation of point clouds before meshing them. Topographies are usually
+much denser than the tolerance we care about, and the cost of the mesh
+engine grows with the number of triangles, so it pays to average points
+which are closer than the tolerance. All functions return the decimated
+points and the maximum height error introduced, measured as the maximum
+difference between the Z coordinate of each input point and the Z coordinate
+of the point replacing it"""
+
+#maximum number of subdivisions in the max height error mode
+maxlevels = 30
+
+"""average the points in each group given by inverse (as returned by
+n.unique(..., return_inverse=True)), returning the averages and the maximum
+height error within each group"""
+def groupAverages(points, inverse, ngroups):
+  counts  = n.bincount(inverse, minlength=ngroups).astype(n.float64)
+  means   = n.empty((ngroups, 3), dtype=n.float64)
+  for k in xrange(3):
+    means[:,k] = n.bincount(inverse, weights=points[:,k], minlength=ngroups)/counts
+  order   = n.argsort(inverse, kind='mergesort')
+  dev     = n.abs(points[order,2]-means[inverse[order],2])
+  starts  = n.searchsorted(inverse[order], n.arange(ngroups))
+  errors  = n.maximum.reduceat(dev, starts)
+  return means, errors
+
+"""group the points by the cells of a regular XY grid with the given cell
+size. Returns the number of cells and the cell of each point"""
+def cellGroups(points, origin, cell):
+  ij  = n.ascontiguousarray(n.floor((points[:,0:2]-origin)/cell).astype(n.int64))
+  ij  = ij.view(n.dtype((n.void, ij.dtype.itemsize*2))).ravel()
+  uniq, inverse = n.unique(ij, return_inverse=True)
+  return uniq.size, inverse
+
+"""voxel grid decimation: the points in each cell of a regular XY grid with
+size cell are replaced by their average"""
+def voxelDecimate(points, cell):
+  if points.shape[0]==0:
+    return points, 0.0
+  ncells, inverse = cellGroups(points, points[:,0:2].min(axis=0), cell)
+  means, errors   = groupAverages(points, inverse, ncells)
+  return means, float(errors.max())
+
+"""max height error decimation: a quadtree is built over the XY plane, and the
+points in each cell are replaced by their average if the height error is not
+higher than maxerror. Otherwise, the cell is split in four. Each level of the
+quadtree is processed at once, with vectorized operations"""
+def heightDecimate(points, maxerror):
+  if points.shape[0]==0:
+    return points, 0.0
+  origin    = points[:,0:2].min(axis=0)
+  cell      = float((points[:,0:2].max(axis=0)-origin).max())
+  if cell==0:
+    cell    = 1.0
+  remaining = points
+  result    = []
+  error     = 0.0
+  for level in xrange(maxlevels):
+    ncells, inverse = cellGroups(remaining, origin, cell)
+    means, errors   = groupAverages(remaining, inverse, ncells)
+    done     = errors<=maxerror
+    result.append(means[done])
+    if done.any():
+      error  = max(error, float(errors[done].max()))
+    remaining = remaining[~done[inverse]]
+    if remaining.shape[0]==0:
+      break
+    cell    /= 2
+  else:
+    #points with (almost) the same XY coordinates but very different heights
+    result.append(remaining)
+  return n.concatenate(result), error
+
+modes = {'voxel': voxelDecimate, 'height': heightDecimate}
+
+"""decimate the points using one of the modes: 'voxel' (tolerance is the cell
+size) or 'height' (tolerance is the maximum height error)"""
+def decimate(points, mode, tolerance):
+  return modes[mode](points, tolerance)
@@ -0,0 +1,315 @@
+import numpy as n
+from scipy.spatial import cKDTree
+
+"""Signed distances from the points of a point cloud to the surface of a mesh
+(the deviation of a scan with respect to the reference), without computing
+any boolean operation.
+
+The triangles are indexed with a bounding volume hierarchy: they are sorted
+along a Morton (Z-order) curve, grouped in leaves of a few triangles, and a
+complete binary tree of axis aligned bounding boxes is built bottom-up over
+the leaves. For each point, the distance to the triangle with the nearest
+centroid is an upper bound of the distance to the surface, and the tree is
+traversed level by level for a whole batch of points at once, discarding
+the boxes farther than the upper bound. Distances to the triangles in the
+remaining leaves are computed with vectorized operations.
+
+The sign of the distance is given by the angle weighted pseudonormal of the
+nearest feature (face, edge or vertex) of the mesh, which is correct for
+closed meshes with consistent orientation (positive outside the mesh)"""
+
+#points processed at once (to limit the memory used by the candidate pairs)
+batchsize = 1<<14
+#triangles in each leaf of the bounding volume hierarchy
+leafsize  = 4
+#points traversing the bounding volume hierarchy together
+groupsize = 8
+
+#closest features of a triangle (see closestPoints)
+FACE, EDGEAB, EDGEBC, EDGECA, VERTA, VERTB, VERTC = range(7)
+
+"""closest points to the points p in the triangles (a, b, c) (all arrays of
+shape (N,3)), and the feature of each triangle where they are (FACE, EDGE*
+or VERT*). This is the algorithm in Ericson's Real-Time Collision Detection,
+with all regions computed at once"""
+def closestPoints(p, a, b, c):
+  ab  = b-a
+  ac  = c-a
+  ap  = p-a
+  bp  = p-b
+  cp  = p-c
+  dot = lambda x, y: n.einsum('ij,ij->i', x, y)
+  d1, d2 = dot(ab, ap), dot(ac, ap)
+  d3, d4 = dot(ab, bp), dot(ac, bp)
+  d5, d6 = dot(ab, cp), dot(ac, cp)
+  va  = d3*d6-d5*d4
+  vb  = d5*d2-d1*d6
+  vc  = d1*d4-d3*d2
+  with n.errstate(divide='ignore', invalid='ignore'):
+    denom   = 1.0/(va+vb+vc)
+    vab     = d1/(d1-d3)
+    wca     = d2/(d2-d6)
+    wbc     = (d4-d3)/((d4-d3)+(d5-d6))
+    q       = a+ab*(vb*denom)[:,n.newaxis]+ac*(vc*denom)[:,n.newaxis]
+  feature = n.zeros(p.shape[0], dtype=n.int8)
+  #regions in reverse order of precedence, so the first ones are the ones kept
+  regions = [(EDGEBC, (va<=0) & (d4-d3>=0) & (d5-d6>=0), lambda: b+(c-b)*wbc[:,n.newaxis]),
+             (EDGECA, (vb<=0) & (d2>=0) & (d6<=0),       lambda: a+ac*wca[:,n.newaxis]),
+             (VERTC,  (d6>=0) & (d5<=d6),                lambda: c),
+             (EDGEAB, (vc<=0) & (d1>=0) & (d3<=0),       lambda: a+ab*vab[:,n.newaxis]),
+             (VERTB,  (d3>=0) & (d4<=d3),                lambda: b),
+             (VERTA,  (d1<=0) & (d2<=0),                 lambda: a)]
+  for code, mask, point in regions:
+    if mask.any():
+      q[mask]       = point()[mask]
+      feature[mask] = code
+  return q, feature
+
+"""Morton codes (interleaving the bits of the quantized coordinates) of points"""
+def mortonCodes(points):
+  lo    = points.min(axis=0)
+  span  = max(float((points.max(axis=0)-lo).max()), 1e-300)
+  q     = n.minimum(((points-lo)/span*(1<<21)).astype(n.uint64), (1<<21)-1)
+  codes = n.zeros(points.shape[0], dtype=n.uint64)
+  for bit in xrange(21):
+    for axis in xrange(3):
+      codes |= ((q[:,axis]>>n.uint64(bit)) & n.uint64(1)) << n.uint64(3*bit+axis)
+  return codes
+
+"""squared distances from the points p to the boxes, given as arrays of shape
+(N,6) (lower corner and upper corner with the sign changed)"""
+def boxDistance2(boxes, p):
+  d = n.maximum(boxes-n.concatenate((p, -p), axis=1), 0)
+  return (d*d).sum(axis=1)
+
+"""index over the triangles of a mesh to find the closest ones to points"""
+class TriangleIndex(object):
+  def __init__(self, verts, triangles):
+    verts      = n.asarray(verts, dtype=n.float64)
+    triangles  = n.asarray(triangles, dtype=n.int64)
+    a, b, c    = verts[triangles[:,0]], verts[triangles[:,1]], verts[triangles[:,2]]
+    normals    = n.cross(b-a, c-a)
+    area2      = n.sqrt((normals*normals).sum(axis=1))
+    #degenerate triangles cannot be the only closest ones, so they are ignored
+    keep       = area2>0
+    triangles  = triangles[keep]
+    a, b, c    = a[keep], b[keep], c[keep]
+    self.verts     = verts
+    self.triangles = triangles
+    self.normals   = normals[keep]/area2[keep][:,n.newaxis]
+    self.pseudonormals(verts, triangles, a, b, c)
+    centroids  = (a+b+c)/3
+    self.nearest   = cKDTree(centroids)
+    self.triboxes  = n.concatenate((n.minimum(n.minimum(a, b), c), -n.maximum(n.maximum(a, b), c)), axis=1)
+    self.buildTree(centroids, self.triboxes)
+
+  """the arrays of the index, to store it (see fromState)"""
+  def state(self):
+    arrays = dict((k, getattr(self, k)) for k in ['verts', 'triangles', 'normals', 'triboxes', 'leaftris',
+                                                  'vnormals', 'enormals', 'edgeids'])
+    arrays['centroids'] = self.nearest.data
+    for level, boxes in enumerate(self.boxes):
+      arrays['boxes%d' % level] = boxes
+    return arrays
+
+  """rebuild an index from the arrays returned by state(), which is much faster
+  than building it from the mesh (only the KD-tree of the centroids is built)"""
+  @classmethod
+  def fromState(cls, arrays):
+    index = cls.__new__(cls)
+    for k, v in arrays.iteritems():
+      if not k.startswith('boxes') and k!='centroids':
+        setattr(index, k, v)
+    index.nearest = cKDTree(arrays['centroids'])
+    index.boxes   = [arrays['boxes%d' % level] for level in xrange(len(arrays)) if 'boxes%d' % level in arrays]
+    return index
+
+  """build the bounding volume hierarchy, from the centroids and the bounding
+  boxes of the triangles (see boxDistance2). self.leaftris has the triangles
+  of each leaf (-1 for padding), and self.boxes the boxes of each level (from
+  the root to the leaves)"""
+  def buildTree(self, centroids, triboxes):
+    ntris   = centroids.shape[0]
+    order   = n.argsort(mortonCodes(centroids), kind='mergesort')
+    nleaves = max(1, -(-ntris//leafsize))
+    nlevels = int(n.ceil(n.log2(nleaves)))
+    nleaves = 1<<nlevels
+    leaftris = n.empty(nleaves*leafsize, dtype=n.int64)
+    leaftris.fill(-1)
+    leaftris[:ntris] = order
+    self.leaftris = leaftris.reshape(nleaves, leafsize)
+    #empty boxes for the padding
+    boxes   = n.empty((nleaves*leafsize, 6))
+    boxes.fill(n.inf)
+    boxes[:ntris] = triboxes[order]
+    #the minimum of the lower corners and of the upper corners with the sign changed
+    levels  = [boxes.reshape(nleaves, leafsize, 6).min(axis=1)]
+    while levels[0].shape[0]>1:
+      levels.insert(0, levels[0].reshape(-1, 2, 6).min(axis=1))
+    self.boxes = levels
+
+  """angle weighted pseudonormals of the vertexes and the edges of the mesh"""
+  def pseudonormals(self, verts, triangles, a, b, c):
+    nf      = self.normals
+    corners = [(a, b, c), (b, c, a), (c, a, b)]
+    vnormals = n.zeros(verts.shape, dtype=n.float64)
+    for k, (p, q, r) in enumerate(corners):
+      u     = q-p
+      v     = r-p
+      cos   = (u*v).sum(axis=1)/n.sqrt((u*u).sum(axis=1)*(v*v).sum(axis=1))
+      angle = n.arccos(n.clip(cos, -1, 1))
+      for axis in xrange(3):
+        vnormals[:,axis] += n.bincount(triangles[:,k], weights=angle*nf[:,axis], minlength=verts.shape[0])
+    self.vnormals = vnormals
+    #edges: sum of the normals of the (two, in a manifold mesh) faces sharing them
+    edges   = n.concatenate((triangles[:,[0,1]], triangles[:,[1,2]], triangles[:,[2,0]]))
+    keys    = n.ascontiguousarray(n.sort(edges, axis=1))
+    keys    = keys.view(n.dtype((n.void, keys.dtype.itemsize*2))).ravel()
+    uniq, inverse = n.unique(keys, return_inverse=True)
+    enormals = n.zeros((uniq.size, 3), dtype=n.float64)
+    nf3      = n.concatenate((nf, nf, nf))
+    for axis in xrange(3):
+      enormals[:,axis] = n.bincount(inverse, weights=nf3[:,axis], minlength=uniq.size)
+    #edge of each triangle, in the order AB, BC, CA
+    self.edgeids  = inverse.reshape(3, -1).T
+    self.enormals = enormals
+
+  """candidate pairs (point, triangle) for the points p"""
+  def candidates(self, p):
+    dummy, first = self.nearest.query(p)
+    #the distance to the triangle with the nearest centroid is an upper bound
+    q, feature   = closestPoints(p, *self.corners(first))
+    upper        = n.sqrt(((p-q)**2).sum(axis=1))
+    limit2       = (upper*(1+1e-9))**2
+    #traverse the tree level by level with groups of consecutive points (which
+    #are close to each other if the points are sorted along a Morton curve),
+    #keeping the pairs (group, node) such that the box of the node is not
+    #farther from the box of the group than the maximum upper bound
+    npoints = p.shape[0]
+    ngroups = -(-npoints//groupsize)
+    pad     = ngroups*groupsize-npoints
+    padded  = n.concatenate((p, p[-1:].repeat(pad, axis=0)))
+    gupper  = n.concatenate((upper, upper[-1:].repeat(pad))).reshape(ngroups, groupsize).max(axis=1)
+    #upper corner and lower corner with the sign changed, to compute the
+    #distances to the boxes of the nodes as in boxDistance2
+    gboxes  = n.concatenate((padded.reshape(ngroups, groupsize, 3).max(axis=1),
+                            -padded.reshape(ngroups, groupsize, 3).min(axis=1)), axis=1)
+    glimit2 = (gupper*(1+1e-9))**2
+    gidx    = n.arange(ngroups)
+    node    = n.zeros(ngroups, dtype=n.int64)
+    for level in xrange(1, len(self.boxes)):
+      gidx  = n.repeat(gidx, 2)
+      node  = (n.repeat(node, 2)*2)+n.tile([0, 1], node.size)
+      d     = n.maximum(self.boxes[level][node]-gboxes[gidx], 0)
+      keep  = (d*d).sum(axis=1)<=glimit2[gidx]
+      gidx, node = gidx[keep], node[keep]
+    #pairs (point, leaf) for the leaves of the group of each point (sorted by point)
+    gstarts = n.searchsorted(gidx, n.arange(ngroups))
+    gcounts = n.diff(n.append(gstarts, gidx.size))
+    group   = n.arange(npoints)//groupsize
+    counts  = gcounts[group]
+    pidx    = n.repeat(n.arange(npoints), counts)
+    first   = n.cumsum(counts)-counts
+    pair    = n.arange(pidx.size)-first[pidx]+gstarts[group][pidx]
+    #candidate triangles in the leaves (discarding them by their boxes)
+    pidx    = n.repeat(pidx, leafsize)
+    tidx    = self.leaftris[node[pair]].ravel()
+    keep    = tidx>=0
+    pidx, tidx = pidx[keep], tidx[keep]
+    keep    = boxDistance2(self.triboxes[tidx], p[pidx])<=limit2[pidx]
+    return pidx[keep], tidx[keep]
+
+  """vertexes of the triangles tris"""
+  def corners(self, tris):
+    t = self.triangles[tris]
+    return self.verts[t[:,0]], self.verts[t[:,1]], self.verts[t[:,2]]
+
+  """signed distances from the points p to the mesh (and the closest points)"""
+  def signedDistances(self, p):
+    pidx, tidx  = self.candidates(p)
+    q, feature  = closestPoints(p[pidx], *self.corners(tidx))
+    d2          = ((p[pidx]-q)**2).sum(axis=1)
+    #nearest candidate of each point (candidates are sorted by point)
+    starts      = n.searchsorted(pidx, n.arange(p.shape[0]))
+    nearest     = n.flatnonzero(d2==n.minimum.reduceat(d2, starts)[pidx])
+    best        = nearest[n.searchsorted(pidx[nearest], n.arange(p.shape[0]))]
+    q, feature, tri = q[best], feature[best], tidx[best]
+    #pseudonormal of the nearest feature
+    normal      = self.normals[tri].copy()
+    isedge      = (feature>=EDGEAB) & (feature<=EDGECA)
+    normal[isedge] = self.enormals[self.edgeids[tri[isedge], feature[isedge]-EDGEAB]]
+    isvert      = feature>=VERTA
+    normal[isvert] = self.vnormals[self.triangles[tri[isvert], feature[isvert]-VERTA]]
+    dist        = n.sqrt(d2[best])
+    sign        = n.where(n.einsum('ij,ij->i', p-q, normal)<0, -1.0, 1.0)
+    return sign*dist, q
+
+"""signed distances from the points to the mesh (verts, triangles), positive
+outside the mesh. Returns the distances and the closest points in the mesh.
+index is the TriangleIndex of the mesh, if it is already built"""
+def pointDeviations(points, verts, triangles, index=None):
+  if index is None:
+    index = TriangleIndex(verts, triangles)
+  dist    = n.empty(points.shape[0], dtype=n.float64)
+  closest = n.empty((points.shape[0], 3), dtype=n.float64)
+  #points close to each other are processed together
+  order   = n.argsort(mortonCodes(points), kind='mergesort')
+  for start in xrange(0, points.shape[0], batchsize):
+    batch = order[start:start+batchsize]
+    dist[batch], closest[batch] = index.signedDistances(n.asarray(points[batch], dtype=n.float64))
+  return dist, closest
+
+"""summary statistics of the deviations"""
+def statistics(dist):
+  absd = n.abs(dist)
+  p5, p50, p95 = n.percentile(dist, [5, 50, 95])
+  return {'points':  int(dist.size),
+          'min':     float(dist.min()),
+          'max':     float(dist.max()),
+          'mean':    float(dist.mean()),
+          'std':     float(dist.std()),
+          'rms':     float(n.sqrt((dist*dist).mean())),
+          'maxabs':  float(absd.max()),
+          'meanabs': float(absd.mean()),
+          'p5':      float(p5),
+          'median':  float(p50),
+          'p95':     float(p95)}
+
+"""colors for the deviations with a diverging colormap (blue for negative,
+white for zero, red for positive), saturated at +/-limit. Returns an array of
+shape (N,3) of uint8"""
+def deviationColors(dist, limit):
+  t      = n.clip(dist/limit, -1, 1) if limit>0 else n.zeros(dist.shape)
+  colors = n.empty((dist.size, 3), dtype=n.float64)
+  pos    = t>=0
+  #positive: white to red (decreasing green and blue); negative: white to blue
+  colors[:,0] = n.where(pos, 1, 1+t)
+  colors[:,1] = 1-n.abs(t)
+  colors[:,2] = n.where(pos, 1-t, 1)
+  return n.round(colors*255).astype(n.uint8)
+
+"""write the points with their deviations (as colors and as a scalar
+property) in a binary PLY file"""
+def writePLY(filename, points, dist, colors):
+  record = n.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+                    ('red', 'u1'), ('green', 'u1'), ('blue', 'u1'),
+                    ('deviation', '<f4')])
+  data   = n.empty(points.shape[0], dtype=record)
+  data['x'], data['y'], data['z'] = points[:,0], points[:,1], points[:,2]
+  data['red'], data['green'], data['blue'] = colors[:,0], colors[:,1], colors[:,2]
+  data['deviation'] = dist
+  header = '\n'.join(['ply',
+                      'format binary_little_endian 1.0',
+                      'comment deviations computed by meshdiff',
+                      'element vertex %d' % points.shape[0],
+                      'property float x',
+                      'property float y',
+                      'property float z',
+                      'property uchar red',
+                      'property uchar green',
+                      'property uchar blue',
+                      'property float deviation',
+                      'end_header'])+'\n'
+  with open(filename, 'wb') as f:
+    f.write(header.encode('ascii'))
+    data.tofile(f)
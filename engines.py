@@ -0,0 +1,179 @@
+import os
+import os.path as op
+import shutil
+import tempfile
+import ctypes
+from distutils.spawn import find_executable
+import numpy as n
+import meshio
+import profiling
+
+"""Mesh engines: backends computing the boolean operations of meshdiff
+(difference and intersection) of two closed meshes. All backends have the
+same interface, with meshes given as (verts, triangles) arrays
+(Engine.boolean) or as OFF files (Engine.run), so they can be used both ways:
+
+  -executable engines (cork, openscad) run an external program on OFF files,
+   so using them with arrays costs writing and parsing the files.
+
+  -in-process engines (corklib) call a shared library with the arrays, so no
+   process is launched and no file is written. A crash of the library (cork
+   aborts with some degenerate inputs) brings down the calling process, while
+   the executable engines only fail the operation.
+
+The paths of the programs and libraries are taken from the toolpaths
+dictionary of meshdiff"""
+
+#operations of the engines: difference (mesh1 minus mesh2) and intersection
+operations = ['diff', 'inters']
+
+"""error of a mesh engine"""
+class EngineError(Exception):
+  pass
+
+"""base class of the mesh engines"""
+class Engine(object):
+  #True if the engine works on arrays without launching a process
+  inprocess = False
+  #error code if the engine is not available
+  errcode   = 28
+
+  def __init__(self, name):
+    self.name = name
+
+  """error message if the engine cannot be used, None otherwise"""
+  def missing(self, toolpaths):
+    return None
+
+  """compute the operation of mesh1 and mesh2, returning a mesh"""
+  def boolean(self, toolpaths, operation, mesh1, mesh2):
+    workdir = tempfile.mkdtemp(prefix='meshdiff-engine-')
+    try:
+      in1, in2, out = [op.join(workdir, name) for name in ['in1.off', 'in2.off', 'out.off']]
+      meshio.writeOFF(in1, *mesh1)
+      meshio.writeOFF(in2, *mesh2)
+      self.run(toolpaths, operation, in1, in2, out, workdir)
+      if not op.isfile(out):
+        raise EngineError('%s did not write its output' % self.name)
+      return meshio.readOFF(out)
+    finally:
+      shutil.rmtree(workdir, ignore_errors=True)
+
+  """compute the operation of the meshes in the OFF files in1 and in2, writing
+  the result to the OFF file out (it is not written if the result is empty).
+  workdir is a directory for additional files"""
+  def run(self, toolpaths, operation, in1, in2, out, workdir):
+    result = self.boolean(toolpaths, operation, meshio.readOFF(in1), meshio.readOFF(in2))
+    if result[1].shape[0]>0:
+      meshio.writeOFF(out, *result)
+
+"""cork executable"""
+class CorkExecutable(Engine):
+  errcode = 26
+
+  def missing(self, toolpaths):
+    if not op.isfile(toolpaths['cork']):
+      return 'cork was selected as meshdiff engine, but the executable could not be found: '+toolpaths['cork']
+
+  def run(self, toolpaths, operation, in1, in2, out, workdir):
+    flag = '-diff' if operation=='diff' else '-isct'
+    profiling.call([toolpaths['cork'], flag, in1, in2, out])
+
+"""openscad executable"""
+class OpenSCADExecutable(Engine):
+  errcode = 27
+
+  def missing(self, toolpaths):
+    if not op.isfile(toolpaths['openscad']) and find_executable(toolpaths['openscad']) is None:
+      return 'openscad was selected as meshdiff engine, but the executable could not be found: '+toolpaths['openscad']
+
+  def run(self, toolpaths, operation, in1, in2, out, workdir):
+    operation = 'difference' if operation=='diff' else 'intersection'
+    filestr   = ('%s(){import("%s");import("%s");}' % (operation, str(in1).encode('string_escape'), str(in2).encode('string_escape')))
+    scad      = op.join(workdir, 'open.scad')
+    with open(scad, 'w') as f:
+      f.write(filestr)
+    profiling.call([toolpaths['openscad'], '-o', out, scad])
+
+"""mesh as passed to and returned by the C API of cork"""
+class CorkTriMesh(ctypes.Structure):
+  _fields_ = [('n_triangles', ctypes.c_uint),
+              ('n_vertices',  ctypes.c_uint),
+              ('triangles',   ctypes.POINTER(ctypes.c_uint)),
+              ('vertices',    ctypes.POINTER(ctypes.c_float))]
+
+"""cork shared library, called with ctypes. The functions of the C API of cork
+(cork.h) are looked up with plain names (if the library exports them with C
+linkage) or with their names mangled by GCC/Clang (as in the original
+sources, which do not declare them extern "C")"""
+class CorkLibrary(Engine):
+  inprocess = True
+  errcode   = 107
+  functions = {'diff':   ('computeDifference',   '_Z17computeDifference11CorkTriMeshS_PS_'),
+               'inters': ('computeIntersection', '_Z19computeIntersection11CorkTriMeshS_PS_'),
+               'free':   ('freeCorkTriMesh',     '_Z15freeCorkTriMeshP11CorkTriMesh')}
+
+  def __init__(self, name):
+    super(CorkLibrary, self).__init__(name)
+    #loaded libraries, by path
+    self.libraries = {}
+
+  """functions of the library in toolpaths['corklib'], loaded only once"""
+  def load(self, toolpaths):
+    path = toolpaths['corklib']
+    if path not in self.libraries:
+      try:
+        lib = ctypes.CDLL(path)
+      except OSError as e:
+        raise EngineError('the cork library could not be loaded from %s: %s' % (path, str(e)))
+      funs = {}
+      for key, names in self.functions.iteritems():
+        for name in names:
+          if hasattr(lib, name):
+            funs[key] = getattr(lib, name)
+            break
+        else:
+          raise EngineError('the cork library %s does not have the function %s' % (path, names[0]))
+      for key in operations:
+        funs[key].argtypes = [CorkTriMesh, CorkTriMesh, ctypes.POINTER(CorkTriMesh)]
+        funs[key].restype  = None
+      funs['free'].argtypes = [ctypes.POINTER(CorkTriMesh)]
+      funs['free'].restype  = None
+      self.libraries[path] = funs
+    return self.libraries[path]
+
+  def missing(self, toolpaths):
+    try:
+      self.load(toolpaths)
+    except EngineError as e:
+      return 'corklib was selected as meshdiff engine, but '+str(e)
+
+  def boolean(self, toolpaths, operation, mesh1, mesh2):
+    funs   = self.load(toolpaths)
+    #cork works with float32 vertices and uint32 indices: arrays already in
+    #these types are passed without copies. The arrays are referenced in
+    #inputs while the library is using their memory
+    inputs = [(n.ascontiguousarray(verts, dtype=n.float32), n.ascontiguousarray(triangles, dtype=n.uint32))
+              for verts, triangles in [mesh1, mesh2]]
+    meshes = [CorkTriMesh(triangles.shape[0], verts.shape[0],
+                          triangles.ctypes.data_as(ctypes.POINTER(ctypes.c_uint)),
+                          verts.ctypes.data_as(ctypes.POINTER(ctypes.c_float)))
+              for verts, triangles in inputs]
+    result = CorkTriMesh()
+    funs[operation](meshes[0], meshes[1], ctypes.byref(result))
+    try:
+      if result.n_triangles==0:
+        return (n.zeros((0, 3)), n.zeros((0, 3), dtype=n.int32))
+      #copy the result out of the memory of the library before freeing it
+      verts     = n.ctypeslib.as_array(result.vertices,  shape=(result.n_vertices*3,)).reshape(-1, 3).astype(n.float64)
+      triangles = n.ctypeslib.as_array(result.triangles, shape=(result.n_triangles*3,)).reshape(-1, 3).astype(n.int32)
+    finally:
+      funs['free'](ctypes.byref(result))
+    return (verts, triangles)
+
+#registered mesh engines, by name
+backends = {
+  'cork':     CorkExecutable('cork'),
+  'openscad': OpenSCADExecutable('openscad'),
+  'corklib':  CorkLibrary('corklib'),
+  }
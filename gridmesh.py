@@ -0,0 +1,173 @@
+import numpy as n
+
+"""Meshing of topographies acquired by a line scanner: the points come in scan
+lines (the slow axis is constant along each line, the fast axis varies), so
+the upper face of the mesh can be built directly from the line structure,
+joining consecutive lines with strips of triangles, without a Delaunay
+triangulation. Everything is done with vectorized operations, in O(N). Missing
+samples (scanner dropouts) are handled naturally, because the strips join
+lines with arbitrary (and different) numbers of points"""
+
+#minimum mean number of samples per line to accept a detected line structure
+minsamples = 4
+
+"""check that the lines described by their start indexes are consistent with
+a line scanner: the mean slow coordinate of the lines must be monotonic"""
+def monotonicLines(xy, starts, slow):
+  counts = n.diff(n.append(starts, xy.shape[0]))
+  if starts.size<2 or xy.shape[0]<minsamples*starts.size:
+    return False
+  means  = n.add.reduceat(xy[:,slow], starts)/counts
+  d      = n.diff(means)
+  return bool((d>0).all() or (d<0).all())
+
+"""detect the scan lines in the XY coordinates of a point cloud (in acquisition
+order), returning the start indexes of the lines and the fast axis, or None.
+Lines are detected first as runs of points with the same slow coordinate, and
+then as the points where the fast coordinate jumps back"""
+def detectLines(xy):
+  if xy.shape[0]<2*minsamples:
+    return None
+  best = None
+  for slow in (1, 0):
+    starts = n.concatenate(([0], n.flatnonzero(xy[1:,slow]!=xy[:-1,slow])+1))
+    if monotonicLines(xy, starts, slow) and (best is None or starts.size<best[0].size):
+      best = (starts, 1-slow)
+  if best is not None:
+    return best
+  for fast in (0, 1):
+    d      = n.diff(xy[:,fast])
+    sign   = n.sign(n.median(d))
+    if sign==0:
+      continue
+    starts = n.concatenate(([0], n.flatnonzero(d*sign<0)+1))
+    if monotonicLines(xy, starts, 1-fast):
+      return (starts, fast)
+  return None
+
+"""line index of each point of the cloud (-1 for points whose XY coordinates
+are not finite), and the fast axis. If samples is not None, the lines are
+consecutive blocks of samples points (missing samples should be present in
+the file with non-finite coordinates). Otherwise, the lines are detected.
+Returns None if the cloud does not have a line structure"""
+def scanLineIds(points, samples=None):
+  npoints = points.shape[0]
+  if samples is not None:
+    if samples<2 or npoints<2*samples:
+      return None
+    lineids = n.arange(npoints)//samples
+    first   = points[:samples,0:2]
+    first   = first[n.isfinite(first).all(axis=1)]
+    if first.shape[0]<2:
+      return None
+    fast    = int(n.argmax(first.max(axis=0)-first.min(axis=0)))
+    lineids[~n.isfinite(points[:,0:2]).all(axis=1)] = -1
+    return lineids, fast
+  finite  = n.flatnonzero(n.isfinite(points[:,0:2]).all(axis=1))
+  xy      = points[finite,0:2]
+  lines   = detectLines(xy)
+  if lines is None:
+    return None
+  starts, fast = lines
+  lineids = n.empty(npoints, dtype=n.int64)
+  lineids.fill(-1)
+  lineids[finite] = n.repeat(n.arange(starts.size), n.diff(n.append(starts, xy.shape[0])))
+  return lineids, fast
+
+"""Join consecutive lines with strips of triangles. The lines are given as
+slices of members (starts and counts, every line with at least 2 points),
+which contains indexes of the points, and fastcoord is the coordinate of the
+points along the lines. Each strip advances along the two lines in order of
+the fast coordinate, adding a triangle each time it advances. The indexes
+are computed with the integer type of members"""
+def joinLines(members, starts, counts, fastcoord):
+  nlines  = starts.size
+  itype   = members.dtype
+  if nlines<2:
+    return n.empty((0, 3), dtype=itype)
+  starts  = starts.astype(itype)
+  posline = n.repeat(n.arange(nlines, dtype=itype), counts)
+  notfirst    = n.ones(members.size, dtype=bool)
+  notfirst[starts] = False
+  #each point except the first one of each line makes the strip advance, in
+  #the strip above its line (A role) and in the strip below it (B role)
+  posA  = n.flatnonzero(notfirst & (posline<nlines-1)).astype(itype)
+  posB  = n.flatnonzero(notfirst & (posline>0)).astype(itype)
+  notfirst = None
+  pos   = n.concatenate((posA, posB))
+  strip = n.concatenate((posline[posA], posline[posB]-1))
+  isA   = n.concatenate((n.ones(posA.size, dtype=bool), n.zeros(posB.size, dtype=bool)))
+  order = n.lexsort((~isA, fastcoord[members[pos]], strip))
+  pos   = None
+  strip = strip[order]
+  isA   = isA[order]
+  order = None
+  #number of points advanced in each line (inclusive), restarting in each strip
+  firsts = n.searchsorted(strip, n.arange(nlines-1))
+  ca     = n.cumsum(isA, dtype=itype)
+  cb     = n.cumsum(~isA, dtype=itype)
+  ia     = ca-n.concatenate(([0], ca))[firsts][strip]
+  ib     = cb-n.concatenate(([0], cb))[firsts][strip]
+  sA     = starts[strip]
+  sB     = starts[strip+1]
+  #A step: (A[ia-1], A[ia], B[ib]); B step: (A[ia], B[ib], B[ib-1])
+  t0 = n.where(isA, sA+ia-1, sA+ia)
+  t1 = n.where(isA, sA+ia,   sB+ib)
+  t2 = n.where(isA, sB+ib,   sB+ib-1)
+  return members[n.column_stack((t0, t1, t2))]
+
+"""signed areas of triangles projected in the XY plane"""
+def signedAreas(xy, triangles):
+  a = xy[triangles[:,0]]
+  b = xy[triangles[:,1]]
+  c = xy[triangles[:,2]]
+  return ((b[:,0]-a[:,0])*(c[:,1]-a[:,1])-(b[:,1]-a[:,1])*(c[:,0]-a[:,0]))*0.5
+
+"""make all triangles counterclockwise in the XY plane"""
+def orientCCW(xy, triangles):
+  flip = signedAreas(xy, triangles)<0
+  triangles[flip] = triangles[flip][:,[0,2,1]]
+  return triangles
+
+"""Build the upper face of the mesh from points sorted by line and by the fast
+coordinate within each line (lineids must be non-decreasing, and all lines
+must have at least 2 points). Returns the triangles of the upper face, the
+ordered (counterclockwise) border, and the triangles of the base (as indexes
+in the border, counterclockwise). The triangles are given with the integer
+type itype"""
+def meshScanLines(points, lineids, fast, itype=n.int64):
+  npoints   = points.shape[0]
+  starts    = n.concatenate(([0], n.flatnonzero(lineids[1:]!=lineids[:-1])+1))
+  counts    = n.diff(n.append(starts, npoints))
+  fastcoord = points[:,fast]
+  xy        = points[:,0:2]
+  members   = n.arange(npoints, dtype=itype)
+  tU        = orientCCW(xy, joinLines(members, starts, counts, fastcoord))
+  ordered, tB = scanLinesBorder(xy, lineids, starts, counts, fastcoord, itype)
+  return tU, ordered, tB
+
+"""ordered (counterclockwise) border of the upper face built from the lines
+(see meshScanLines), and the triangles of the base (as indexes in the
+border, counterclockwise, with the integer type itype)"""
+def scanLinesBorder(xy, lineids, starts, counts, fastcoord, itype=n.int64):
+  npoints   = xy.shape[0]
+  ends      = starts+counts-1
+  #border: first line, ends of the lines, last line backwards, starts of the lines backwards
+  ordered   = n.concatenate((n.arange(starts[0], ends[0]+1),
+                             ends[1:-1],
+                             n.arange(ends[-1], starts[-1]-1, -1),
+                             starts[-2:0:-1]))
+  x, y      = xy[ordered,0], xy[ordered,1]
+  if (x*n.roll(y, -1)-n.roll(x, -1)*y).sum()<0:
+    ordered = ordered[::-1]
+  #base: the same strips, but only with the points in the border
+  inborder  = n.zeros(npoints, dtype=bool)
+  inborder[ordered] = True
+  rmembers  = n.flatnonzero(inborder).astype(itype)
+  rlines    = lineids[rmembers]
+  rstarts   = n.concatenate(([0], n.flatnonzero(rlines[1:]!=rlines[:-1])+1))
+  rcounts   = n.diff(n.append(rstarts, rmembers.size))
+  tB        = orientCCW(xy, joinLines(rmembers, rstarts, rcounts, fastcoord))
+  position  = n.empty(npoints, dtype=itype)
+  position[ordered] = n.arange(ordered.size)
+  return ordered.astype(n.int32), position[tB]
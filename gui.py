@@ -4,6 +4,8 @@ import os
 import os.path as op
 import traceback
 import sys
+import threading
+import Queue
 try:
   import meshdiff
 except:
@@ -61,7 +63,7 @@ class MeshDiffGUI(wx.Frame):
         fgsA.AddGrowableCol(1, 1)
 
         #grid of widgets to input limits and misc stuff, and main buttons
-        fgsB = wx.FlexGridSizer(3, 6, 10, 10)
+        fgsB = wx.FlexGridSizer(4, 6, 10, 10)
         
         cexit = wx.CheckBox(parent, label='Close GUI if successful')
         cxy   = wx.CheckBox(parent, label='Use limits in XY axes')
@@ -80,9 +82,15 @@ class MeshDiffGUI(wx.Frame):
         
         bcomp = wx.Button(parent, label='Compute')
         bexit = wx.Button(parent, label='Close')
-        #do not put help button, but we need a placeholder for the FlexGridSizer
-        bhelp = wx.StaticText(parent, label='') 
-        #bhelp = wx.Button(parent, label='Help')
+        #cancels the running computation and the queued ones
+        bcanc = wx.Button(parent, label='Cancel')
+        bcanc.Enable(False)
+        
+        #decimation of the point cloud: mode and tolerance
+        ldec  = wx.StaticText(parent, style=wx.ALIGN_RIGHT, label='Decimation')
+        cdec  = wx.ComboBox(parent, value='none', choices=['none']+sorted(meshdiff.decimate.modes), style=wx.CB_READONLY)
+        ltol  = wx.StaticText(parent, style=wx.ALIGN_RIGHT, label='Tolerance')
+        tdec  = wx.TextCtrl(parent)
         
         #code to add all previously defined controls into the frexgridsizer
         cspecs = [(cexit, 0, wx.ALIGN_CENTER | wx.ALL, 0),
@@ -90,16 +98,28 @@ class MeshDiffGUI(wx.Frame):
                   (cz,    0, wx.ALIGN_LEFT   | wx.ALL, 0)]
         lspecs = list(it.chain(*[[(x, 0, wx.ALL, 0), (y, 1, wx.EXPAND)]
                                          for x,y in zip(lablims, textlims)]))
-        bspecs = [(x, 0, wx.ALIGN_CENTER | wx.ALL, 0) for x in [bcomp, bexit, bhelp]]
+        bspecs = [(x, 0, wx.ALIGN_CENTER | wx.ALL, 0) for x in [bcomp, bexit, bcanc]]
         #put the controls inside the flexgrdisizer in the right order
         specs = it.chain(*[(a,b[0],b[1],b[2],b[3],c)
                                 for a,b,c in zip(cspecs, group(lspecs, 4), bspecs)])
         fgsB.AddMany(specs)
+        fgsB.AddMany([wx.StaticText(parent, label=''),
+                      (ldec, 0, wx.ALL, 0), (cdec, 1, wx.EXPAND),
+                      (ltol, 0, wx.ALL, 0), (tdec, 1, wx.EXPAND),
+                      wx.StaticText(parent, label='')])
         fgsB.AddGrowableCol(2, 1)
         fgsB.AddGrowableCol(4, 1)
         
+        #progress of the computations: the gauge pulses while they are running,
+        #and the text shows the stage being computed
+        gauge  = wx.Gauge(parent, range=100, size=(150, -1))
+        status = wx.StaticText(parent, label='Ready')
+        bsS = wx.BoxSizer(wx.HORIZONTAL)
+        bsS.AddMany([(gauge, 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 10), (status, 1, wx.ALIGN_CENTER_VERTICAL)])
+        
         bs4 = wx.BoxSizer(wx.VERTICAL)
         bs4.AddMany([(x, 1, wx.EXPAND | wx.ALIGN_TOP | wx.ALL, 10) for x in [fgsA, fgsB]])
+        bs4.Add(bsS, 0, wx.EXPAND | wx.LEFT | wx.RIGHT | wx.BOTTOM, 10)
         
         parent.SetSizer(bs4)
         
@@ -107,14 +127,17 @@ class MeshDiffGUI(wx.Frame):
         
         #read values from the file and set the GUI accordingly
         values = readDefaultValues()
-        controls = [tpc, tstlin, tstlout, cexit, cxy, cz]+textlims
-        for i in xrange(len(values)):
+        controls = [tpc, tstlin, tstlout, cexit, cxy, cz]+textlims+[cdec, tdec]
+        for i in xrange(min(len(values), len(controls))):
           name = controls[i].GetClassName()
           if   name=='wxCheckBox':
             val = values[i].lower() in ("yes", "true", "t", "1")
             controls[i].SetValue(val)
           elif name=='wxTextCtrl':
             controls[i].SetValue(values[i])
+          elif name=='wxComboBox':
+            if values[i] in controls[i].GetItems():
+              controls[i].SetValue(values[i])
           else:
             print 'Unexpected control type %s for value %s'%(name, values[i])
         #make sure that the checks are consistent
@@ -129,12 +152,20 @@ class MeshDiffGUI(wx.Frame):
         
         #EVENT HANDLERS
         if os.name=='posix':
-          txtext = '*.TXT;*.txt'
+          txtext = '*.TXT;*.txt;*.NPY;*.npy;*.PLY;*.ply;*.F32;*.f32;*.F64;*.f64'
           stlext = '*.STL;*.stl'
         else:
-          txtext = '*.txt'
+          txtext = '*.txt;*.npy;*.ply;*.f32;*.f64'
           stlext = '*.stl'
 
+        #the computations run in a background thread, reporting to the GUI thread
+        #the None is a placeholder for zsub, which has no control
+        argcontrols = [tpc, tstlin, tstlout, cxy, cz]+textlims+[None, cdec, tdec]
+        timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, lambda event: gauge.Pulse(), timer)
+        self.worker = Worker(closureProgress(self, status),
+                             closureResult(self, argcontrols, cexit, bcanc, gauge, status, timer))
+        
         #close event (window and button)
         self.Bind(wx.EVT_CLOSE, closureClose(self, controls))        
         bexit.Bind(wx.EVT_BUTTON, closureClose(self, controls))
@@ -145,8 +176,9 @@ class MeshDiffGUI(wx.Frame):
         #events for checkboxes
         cz.Bind( wx.EVT_CHECKBOX, closureCheck(cz,  [4, 5],       cxy, [0, 1, 2, 3], textlims, False))
         cxy.Bind(wx.EVT_CHECKBOX, closureCheck(cxy, [0, 1, 2, 3], cz,  [4, 5],       textlims, True))
-        #compute event
-        bcomp.Bind(wx.EVT_BUTTON, closureCompute(self, tpc, tstlin, tstlout, cz, cxy, cexit, textlims))
+        #compute and cancel events
+        bcomp.Bind(wx.EVT_BUTTON, closureCompute(self.worker, argcontrols, bcanc, status, timer))
+        bcanc.Bind(wx.EVT_BUTTON, closureCancel(self.worker, status))
         #bcomp.Bind(wx.EVT_BUTTON, closureHelp)
         
 """event handler for closing the application. It has to write the parameters to
@@ -155,6 +187,7 @@ def closureClose(frame, allcontrols):
   def handleEvent(event):
     values = [str(x.GetValue()) for x in allcontrols]
     writeDefaultValues(values)
+    frame.worker.stop()
     frame.Destroy()
   return handleEvent
 
@@ -189,26 +222,119 @@ def closureCheck(c1, rang1, c2, rang2, textlims, triggerval):
         textlims[i].Enable(val)
   return handleEvent
 
-"""event handler for the COMPUTE button: call meshdiff.safeDoDifference,
-display resulting messages, and if successful and requested, close GUI"""
-def closureCompute(frame, tpc, tstlin, tstlout, cz, cxy, cexit, textlims):
+"""runs the computations (calls to meshdiff.safeDoDifference) in a background
+thread, one after another, so the GUI is responsive while they run. progress
+is called with the name of each stage, and result with the result of each
+computation and the number of computations still pending. Both are called in
+the GUI thread (with wx.CallAfter)"""
+class Worker(object):
+  def __init__(self, progress, result):
+    self.progress = progress
+    self.result   = result
+    self.jobs     = Queue.Queue()
+    self.lock     = threading.Lock()
+    #cancellation events of the pending computations (queued or running)
+    self.events   = []
+    self.thread   = threading.Thread(target=self.loop)
+    self.thread.daemon = True
+    self.thread.start()
+
+  """number of computations queued or running"""
+  def pending(self):
+    with self.lock:
+      return len(self.events)
+
+  """queue a computation with the arguments of meshdiff.safeDoDifference"""
+  def submit(self, strargs):
+    cancel = threading.Event()
+    with self.lock:
+      self.events.append(cancel)
+    self.jobs.put((strargs, cancel))
+
+  """cancel the running computation (it stops at the beginning of its next stage,
+  or as soon as possible if an external program is running) and the queued ones"""
+  def cancelAll(self):
+    with self.lock:
+      for cancel in self.events:
+        cancel.set()
+
+  """cancel everything and finish the thread. It waits a bit for the running
+  computation, so the external program it may be running is killed"""
+  def stop(self):
+    self.cancelAll()
+    self.jobs.put((None, None))
+    self.thread.join(2.0)
+
+  def loop(self):
+    while True:
+      strargs, cancel = self.jobs.get()
+      if strargs is None:
+        return
+      if cancel.is_set():
+        #cancelled while queued: it is not reported
+        ret = None
+      else:
+        opts = {'progress': lambda name: wx.CallAfter(self.progress, name),
+                'cancel':   cancel}
+        ret  = meshdiff.safeDoDifference(strargs, opts)
+      with self.lock:
+        self.events.remove(cancel)
+        remaining = len(self.events)
+      if ret is not None:
+        wx.CallAfter(self.result, ret, remaining)
+
+"""event handler for the COMPUTE button: queue a computation with the current
+values of the controls (so they can be edited while it is running)"""
+def closureCompute(worker, controls, bcanc, status, timer):
+  def handleEvent(event):
+    strargs     = [x.GetValue() if x is not None else '0.1' for x in controls]
+    if worker.pending()>0:
+      status.SetLabel('Computation queued (%d pending)' % (worker.pending()+1))
+    worker.submit(strargs)
+    bcanc.Enable(True)
+    if not timer.IsRunning():
+      timer.Start(100)
+  return handleEvent
+
+"""event handler for the CANCEL button"""
+def closureCancel(worker, status):
   def handleEvent(event):
-    controls    = [tpc, tstlin, tstlout, cxy, cz]+textlims
-    strargs     = [x.GetValue() for x in controls]
-    strargs.append('0.1') #zsub
-    ret = meshdiff.safeDoDifference(strargs)
+    worker.cancelAll()
+    status.SetLabel('Cancelling...')
+  return handleEvent
+
+"""progress of the running computation: show the name of the stage"""
+def closureProgress(frame, status):
+  def handleProgress(name):
+    #the frame may have been closed after the event was posted
+    if not frame:
+      return
+    status.SetLabel('Computing: '+name.replace('/', ' > '))
+  return handleProgress
+
+"""result of a computation: display resulting messages, and if successful,
+requested and there are no more computations pending, close GUI"""
+def closureResult(frame, controls, cexit, bcanc, gauge, status, timer):
+  def handleResult(ret, remaining):
+    if not frame:
+      return
     if ret.errcode!=None:
       global errcode
       errcode = ret.errcode
+    if remaining==0:
+      timer.Stop()
+      gauge.SetValue(0)
+      bcanc.Enable(False)
+      status.SetLabel('Ready')
     if ret.ok:
-      if cexit.GetValue():
+      if cexit.GetValue() and remaining==0:
         frame.Close()
         return
     if ret.val:
       msgbox(ret.val)
-    if (ret.argnum>=0) and (ret.argnum<len(controls)):
+    if (ret.argnum>=0) and (ret.argnum<len(controls)) and (controls[ret.argnum] is not None):
       controls[ret.argnum].SetFocus()
-  return handleEvent
+  return handleResult
 
 """use a dialog box to notify the user of something. If the message has several
 lines (possibly because of containing a exception), the dialog allows to select
@@ -5,25 +5,49 @@ import subprocess as sub
 #import scipy.spatial.distance as sp
 from scipy.spatial import Delaunay
 import traceback
+import tempfile
 import collections as cols
+import meshio
+import pointcloud
+import cache
+import gridmesh
+import decimate
+import crop
+import clean
+import simplify
+import deviation
+import register
+import engines
+import profiling
 
 DEBUG    = True
 NOTDEBUG = not DEBUG
 
 #return values are of this type for easy coding
-class RetVal(cols.namedtuple('RetVal', ['ok', 'val', 'argnum', 'errcode'])):
-    def __new__(cls, ok=None, val=None, argnum=None, errcode=None):
-        return super(RetVal, cls).__new__(cls, ok, val, argnum, errcode)
+#(profile is the trace of the stages of the run, if it has been profiled, see profiling.py)
+class RetVal(cols.namedtuple('RetVal', ['ok', 'val', 'argnum', 'errcode', 'profile'])):
+    def __new__(cls, ok=None, val=None, argnum=None, errcode=None, profile=None):
+        return super(RetVal, cls).__new__(cls, ok, val, argnum, errcode, profile)
 
 freecadscript = op.join(op.dirname(op.realpath(__file__)), 'freecadscript.py')
 
-#this should be a parameter, but we will keep it a hardcoded choice while it is not necessary
+#default mesh engine (see engines.py and the option 'engine')
 meshmode = 'cork'
 #meshmode = 'openscad'
+#meshmode = 'corklib'
+
+#conversion between STL and OFF files is done in-process by default. If it
+#fails (for example, because the STL file is malformed in a way that meshio
+#cannot handle), the external converter in convertfallback is used instead
+#(None to disable the fallback)
+convertmode     = 'native'
+convertfallback = 'freecad'
+#convertfallback = 'meshlab'
 
 if   os.name=='posix':
   toolpaths = {
     'cork':      op.join(op.dirname(op.realpath(__file__)), 'cork'),
+    'corklib':   op.join(op.dirname(op.realpath(__file__)), 'libcork.so'),
     'openscad': 'openscad',
     'meshlab':  'meshlabserver',
     'freecadp': 'python'
@@ -31,6 +55,7 @@ if   os.name=='posix':
 elif os.name=='nt':
   toolpaths = {
     'cork':      op.join(op.dirname(op.realpath(__file__)), 'cork.exe'),
+    'corklib':   op.join(op.dirname(op.realpath(__file__)), 'cork.dll'),
     'openscad': op.join(op.dirname(op.realpath(__file__)), 'openscad.exe'),
     'meshlab':  'C:\\Program Files\\VCG\\MeshLab\\meshlabserver.exe',
     'freecadp': 'C:\\Program Files\\FreeCAD 0.14\\bin\\python.exe'
@@ -38,36 +63,101 @@ elif os.name=='nt':
 else:
   raise Exception('this script expects to be run either in Windows or in *NIX!!!')
 
+#RAM-backed filesystem for the intermediate files (see the option 'scratchdir')
+ramdir = '/dev/shm'
+
+#default values for the optional settings of doDifference()
+defaultOptions = {
+  'pccache':     False, #keep the parsed point cloud in a sidecar .npy file next to it
+  'pccachehash': False, #if pccache is True, also check the contents of the point cloud file
+  'pcformat':    None,   #format of the point cloud file (None to detect it, see pointcloud.py)
+  'refcache':    False, #keep the loaded STL input mesh (and data derived from it) in a cache (see cache.py)
+  'meshmode':    'auto', #how to mesh the point cloud: 'auto', 'grid' or 'delaunay' (see createMeshFromPointCloud)
+  'gridsamples': None,   #samples per scan line for meshmode 'grid' (None to detect the scan lines)
+  'decimation':  None,   #decimate the point cloud before meshing: (mode, tolerance), see decimate.py
+  'crop':        True,   #with XY limits, crop the mesh of the point cloud to the limits instead of intersecting with a prism (the STL input mesh is not clipped, see crop.py)
+  'cropmargin':  0.0,    #margin around the limits to keep the shells of the reference mesh
+  'clean':       True,   #clean the input meshes before the boolean operations (see clean.py)
+  'cleantolerance': 0.0, #vertexes closer than this are welded, and thinner triangles are fixed (see clean.py)
+  'refcleaned':  False,  #the mesh in 'reference' has already been cleaned (see cleanInputMesh)
+  'simplifyerror': None, #simplify the upper face of the mesh of the point cloud up to this error (see simplify.py)
+  'simplifyfaces': None, #simplify the upper face of the mesh of the point cloud down to this number of triangles
+  'compact':     False,  #store the point cloud and its mesh in single precision (see compactPointCloud)
+  'compacttolerance': None, #in compact mode, maximum rounding error of the point cloud (None: the one of
+                            #the STL input mesh, see compactTolerance)
+  'points':      None,   #the point cloud, already loaded (the point cloud file is not read)
+  'upperface':   None,   #the upper face of the mesh of the point cloud, already built (see streaming.py)
+  'zbase':       None,   #height of the base of the mesh of the point cloud (None for zsub below the lowest point)
+  'reference':   None,   #the STL input mesh, already loaded as (verts, triangles) (see loadReferenceMesh)
+  'refindex':    None,   #the index of the triangles of 'reference' for doDeviation, already built (see deviation.py)
+  'workdir':     None,   #directory for the intermediate files (None for a new private directory in scratchdir)
+  'engine':      None,   #mesh engine for the boolean operations (None for meshmode, see engines.py)
+  'register':    False,  #align the point cloud to the STL model before anything else (see register.py)
+  'deviationrange': None, #deviations saturating the colors in the output of doDeviation (None for the 99th percentile)
+  'profile':     False,  #record the time and resources used by each stage of the run (see profiling.py)
+  'monitor':     None,   #function called with the record of each stage as soon as it finishes (implies profile)
+  'progress':    None,   #function called with the name of each stage when it starts
+  'cancel':      None,   #object such as threading.Event: the run is cancelled when it is set (see profiling.py)
+  'scratchdir':  None,   #where the private directories for the intermediate files are created (None for the
+                         #system temporary directory, 'ram' for a RAM-backed filesystem, see ramdir)
+  }
+
+"""fill missing optional settings with their default values"""
+def completeOptions(opts):
+  full = dict(defaultOptions)
+  if opts is not None:
+    full.update(opts)
+  return full
+
 """If the arguments are strings from the user, execute the doDifference()
-method in a safe way, checking everything and degrading gracefully"""
-def safeDoDifference(strargs):
-  arguments   = sanitizeStrArguments(*strargs)
+method in a safe way, checking everything and degrading gracefully. opts
+is a dictionary of optional settings (see defaultOptions)"""
+def safeDoDifference(strargs, opts=None):
+  return safeCall(doDifference, strargs, opts)
+
+"""Same as safeDoDifference(), but for doDeviation() (the output file must be
+a PLY file)"""
+def safeDoDeviation(strargs, opts=None):
+  return safeCall(doDeviation, strargs, opts, '.ply')
+
+"""execute function (with the same arguments as doDifference()) with the
+string arguments from the user, checking everything and degrading
+gracefully. outext is the required extension of the output file"""
+def safeCall(function, strargs, opts=None, outext='.stl'):
+  arguments   = sanitizeStrArguments(*strargs, outext=outext)
   if not arguments.ok:
     return arguments
+  #settings from the string arguments override the ones in opts
+  args        = arguments.val
+  args[-1]    = dict(opts or {}, **args[-1])
   try:
-    ret       = doDifference(*(arguments.val))
+    ret       = function(*args)
   except:
     return RetVal(False, 'Unexpected exception: '+traceback.format_exc(), -1, 1)
-  return ret  
+  return ret
 
 """make sure that all parameters are OK and consistent. Third element of
 return tuples (False, msgstr, idx) is the index (in the list of arguments)
 of the argument which caused the error. If successful, returns a list of
-arguments which can be used to call doDifference.
+arguments which can be used to call doDifference (the last one is a
+dictionary with the optional settings specified in the arguments).
+outext is the required extension of the output file. If pcstream is True,
+the point cloud is read as a stream (see streaming.py), and filePC does not
+need to be a file (it is not checked).
 ATTENTION: useXY and useZ are booleans, NOT STRINGS"""
-def sanitizeStrArguments(filePC, fileSTL, fileResult, useXY, useZ, xmin, xmax, ymin, ymax, zmin, zmax, zsub):
-  if not op.isfile(filePC):
+def sanitizeStrArguments(filePC, fileSTL, fileResult, useXY, useZ, xmin, xmax, ymin, ymax, zmin, zmax, zsub, decimation='', decimationTol='', outext='.stl', pcstream=False):
+  if not pcstream and not op.isfile(filePC):
     return RetVal(False, 'Error: point cloud input file does not exist: '+filePC, 0, 2)
   if not op.isfile(fileSTL):
     return RetVal(False, 'Error: STL input file does not exist: '+fileSTL, 1, 3)
   a,ext     = op.splitext(fileResult)
   dr        = op.dirname(fileResult)
-  if ext.lower()!=".stl":
-    return RetVal(False, 'Error: output file does not have STL extension: '+fileResult, 2, 4)
+  if ext.lower()!=outext:
+    return RetVal(False, 'Error: output file does not have %s extension: %s' % (outext[1:].upper(), fileResult), 2, 4)
     return
   if dr!='' and not op.isdir(dr):
     return RetVal(False, 'Error: output file is not in a valid directory: '+fileResult, 2, 5)
-  filePC     = str(op.abspath(filePC))
+  filePC     = filePC if pcstream else str(op.abspath(filePC))
   fileSTL    = str(op.abspath(fileSTL))
   fileResult = str(op.abspath(fileResult))
   if useXY and not useZ:
@@ -96,8 +186,45 @@ def sanitizeStrArguments(filePC, fileSTL, fileResult, useXY, useZ, xmin, xmax, y
     zsub = float(zsub)
   except:
     return RetVal(False, 'Error: invalid value for zsub: '+str(zsub), 11, 7)
-  return RetVal(True, [filePC, fileSTL, fileResult, useCube, limits, zsub])
+  opts = {}
+  decimation = decimation.strip().lower()
+  if decimation not in ['', 'none']:
+    if decimation not in decimate.modes:
+      return RetVal(False, 'Error: invalid decimation mode: %s (valid modes: %s)' % (decimation, ', '.join(sorted(decimate.modes))), 12, 35)
+    try:
+      opts['decimation'] = (decimation, float(decimationTol))
+    except:
+      return RetVal(False, 'Error: invalid value for the decimation tolerance: '+str(decimationTol), 13, 36)
+  return RetVal(True, [filePC, fileSTL, fileResult, useCube, limits, zsub, opts])
   
+"""make sure that the optional settings are sane"""
+def checkOptions(opts):
+  if opts['decimation'] is not None:
+    mode, tol = opts['decimation']
+    if mode not in decimate.modes:
+      return RetVal(False, 'Invalid decimation mode: '+str(mode), 12, 35)
+    if not tol>0:
+      return RetVal(False, 'The decimation tolerance must be higher than 0', 13, 37)
+  if opts['deviationrange'] is not None and not opts['deviationrange']>0:
+    return RetVal(False, 'The range of deviations for the colors must be higher than 0', -1, 101)
+  if opts['engine'] is not None and opts['engine'] not in engines.backends:
+    return RetVal(False, 'Unrecognized mesh engine mode: '+str(opts['engine']), -1, 28)
+  if not opts['cropmargin']>=0:
+    return RetVal(False, 'The crop margin cannot be negative', -1, 91)
+  if not opts['cleantolerance']>=0:
+    return RetVal(False, 'The cleaning tolerance cannot be negative', -1, 109)
+  if opts['simplifyerror'] is not None and not opts['simplifyerror']>0:
+    return RetVal(False, 'The maximum error of the simplification must be higher than 0', -1, 112)
+  if opts['simplifyfaces'] is not None and not opts['simplifyfaces']>0:
+    return RetVal(False, 'The number of triangles of the simplification must be higher than 0', -1, 121)
+  if opts['compacttolerance'] is not None and not opts['compacttolerance']>=0:
+    return RetVal(False, 'The rounding tolerance of the compact mode cannot be negative', -1, 114)
+  if opts['pcformat'] is not None and opts['pcformat'] not in pointcloud.formats:
+    return RetVal(False, 'Unrecognized point cloud format: '+str(opts['pcformat']), 0, 115)
+  if opts['upperface'] is not None and (opts['register'] or opts['decimation'] is not None):
+    return RetVal(False, 'The point cloud cannot be registered nor decimated if the upper face of its mesh is given', -1, 120)
+  return RetVal(True)
+
 """make sure that all limits are sane"""
 def checklimits(useCube, limits, zsub):
   if zsub<=0:
@@ -149,47 +276,158 @@ specialFiles = {
   'scad': ('open.scad', 'specification file for the OpenSCAD mesh engine (if used)')
   }
 
-#quick hack to avoid registering this file entry if we are not using openscad engine
-if meshmode!='openscad': 
-  specialFiles.pop('scad', None)
+"""create a private directory for the intermediate files of a run, in the
+directory base (None for the system temporary directory, 'ram' for ramdir if
+it is available)"""
+def makeScratchDir(base=None):
+  if base=='ram':
+    base = ramdir if op.isdir(ramdir) else None
+  return tempfile.mkdtemp(prefix='meshdiff-', dir=base)
 
-"""Intersect a point cloud and a STL model within a given box. The logic of the
+"""remove a directory if it is empty. Returns True if it has been removed"""
+def removeEmptyDir(path):
+  try:
+    os.rmdir(path)
+    return True
+  except OSError:
+    return False
+
+"""run function(*args) recording its stages if the options 'profile',
+'monitor', 'progress' or 'cancel' are set (see profiling.py). If the option
+'profile' or 'monitor' is set, the trace of the run is returned in the field
+profile of the RetVal"""
+def runProfiled(opts, name, function, *args):
+  if not opts['profile'] and all(opts[k] is None for k in ['monitor', 'progress', 'cancel']):
+    return function(*args)
+  if profiling.currentProfiler() is not None:
+    #already profiled (for example, as part of a bigger run)
+    with profiling.stage(name):
+      return function(*args)
+  profiler = profiling.Profiler(opts['monitor'], opts['progress'], opts['cancel'])
+  try:
+    with profiling.active(profiler):
+      with profiling.stage(name):
+        ret = function(*args)
+  except profiling.Cancelled:
+    ret = None
+  #the exception may also have been caught (and turned into an error) by the stage
+  if opts['cancel'] is not None and opts['cancel'].is_set() and (ret is None or not ret.ok):
+    return RetVal(False, 'The run has been cancelled', -1, 108)
+  if opts['profile'] or opts['monitor'] is not None:
+    ret = ret._replace(profile=profiler.trace())
+  return ret
+
+"""Intersect a point cloud and a STL model within a given box. Unless the
+option 'workdir' is set, the intermediate files are written to a new private
+directory (so several runs can be done concurrently), which is removed at
+the end (if files are kept because of an error, it is not removed)"""
+def doDifference(filePC, fileSTL, fileResult, useCube, limits, zsub, opts=None):
+  opts = completeOptions(opts)
+  return runProfiled(opts, 'difference', doDifferenceUnprofiled, filePC, fileSTL, fileResult, useCube, limits, zsub, opts)
+
+"""body of doDifference()"""
+def doDifferenceUnprofiled(filePC, fileSTL, fileResult, useCube, limits, zsub, opts):
+  if opts['workdir'] is not None:
+    return doDifferenceInDir(filePC, fileSTL, fileResult, useCube, limits, zsub, opts)
+  try:
+    workdir = makeScratchDir(opts['scratchdir'])
+  except (IOError, OSError) as e:
+    return RetVal(False, 'Could not create a directory for the intermediate files: '+str(e), -1, 97)
+  try:
+    ret = doDifferenceInDir(filePC, fileSTL, fileResult, useCube, limits, zsub, dict(opts, workdir=workdir))
+  finally:
+    removed = removeEmptyDir(workdir)
+  if not removed and not ret.ok:
+    ret = ret._replace(val='%s\n(intermediate files have been kept in %s)' % (ret.val, workdir))
+  return ret
+
+"""Intersect a point cloud and a STL model within a given box, writing the
+intermediate files to the directory in the option 'workdir'. The logic of the
 function is spaguetti because we need to assume that anything could go wrong,
 so we have to double-check everything and provide meaningful error messages"""
-def doDifference(filePC, fileSTL, fileResult, useCube, limits, zsub):
-  #we may use meshlab, but freecad seems to produce (for whatever reason)
-  #better results (specifically, the STL output file had some flipped normals
-  #with meshlab, while it didn't with freecad)
-  mode = 'freecad'
-  #mode = 'meshlab'
+def doDifferenceInDir(filePC, fileSTL, fileResult, useCube, limits, zsub, opts):
+  opts = completeOptions(opts)
+  #external converters: we may use meshlab, but freecad seems to produce (for
+  #whatever reason) better results (specifically, the STL output file had some
+  #flipped normals with meshlab, while it didn't with freecad)
+  mode = convertmode
   #sanity check
   ret  = checklimits(useCube, limits, zsub)
   if not ret.ok: return ret
-  #read point cloud
-  try:
-    pc = n.loadtxt(filePC, dtype=float, delimiter=';')
-  except:
-    return RetVal(False, 'Could not read point cloud file '+filePC, -1, 12)
-  if pc.size==0:
-    return RetVal(False, 'Incorrect or empty point cloud file '+filePC, -1, 13)
-  if pc.shape[1]!=3:
-    return RetVal(False, 'Point cloud must have 3 columns, but it has '+str(pc.shape[1]), 0, 14)
+  ret  = checkOptions(opts)
+  if not ret.ok: return ret
+  #lines of information about the run, added to the final message
+  report = []
+  #read point cloud (unless the upper face of its mesh is given)
+  pc   = None
+  if opts['upperface'] is None:
+    ret  = readPointCloud(filePC, opts)
+    if not ret.ok: return ret
+    pc   = ret.val
+  #load the STL model now if it is needed, so it is used later instead of converting it again
+  needcompact = opts['compact'] and opts['compacttolerance'] is None and pc is not None
+  if opts['reference'] is None and (opts['register'] or opts['refcache'] or opts['clean'] or needcompact):
+    ret  = loadReferenceMesh(fileSTL, op.join(opts['workdir'], specialFiles['stl'][0]), opts['refcache'], report)
+    if not ret.ok: return ret
+    opts = dict(opts, reference=ret.val)
+  if opts['clean'] and not opts['refcleaned']:
+    ret  = cleanInputMesh(opts['reference'], 'STL input mesh', 1, opts, report, opts['refcache'])
+    if not ret.ok: return ret
+    opts = dict(opts, reference=ret.val, refcleaned=True)
+  #align point cloud to the STL model
+  if opts['register']:
+    ret  = registerPointCloud(pc, opts['reference'])
+    if not ret.ok: return ret
+    pc, transform, msg = ret.val
+    report.append(msg)
+  #decimate point cloud
+  if opts['decimation'] is not None:
+    try:
+      result = decimatePointCloud(pc, limits[2], *opts['decimation'])
+    except:
+      return RetVal(False, 'Unexpected error while decimating the point cloud: '+traceback.format_exc(), 0, 38)
+    if not result.ok:
+      return result
+    pc, msg  = result.val
+    report.append(msg)
+  if opts['compact'] and pc is not None:
+    pc, msg  = compactPointCloud(pc, compactTolerance(opts, opts['reference']))
+    report.append(msg)
+  #with XY limits, the inputs are cropped to the prism of the limits, so the
+  #mesh engine has to be called only once
+  cropping   = useCube and opts['crop']
   #create mesh
+  simplification = None
+  if opts['simplifyerror'] is not None or opts['simplifyfaces'] is not None:
+    simplification = (opts['simplifyerror'], opts['simplifyfaces'])
   try:
-    result   = createMeshFromPointCloud(pc, limits[2], zsub)
+    result   = createMeshFromPointCloud(pc, limits[2], zsub, opts['meshmode'], opts['gridsamples'], limits if cropping else None, opts['zbase'], simplification, report, opts['upperface'])
+    if cropping and not result.ok and result.errcode==31:
+      #the border of the cropped mesh is not a single loop: use the prism instead
+      cropping = False
+      result   = createMeshFromPointCloud(pc, limits[2], zsub, opts['meshmode'], opts['gridsamples'], None, opts['zbase'], simplification, report, opts['upperface'])
+      report.append('the point cloud could not be cropped to the XY limits, the limits were applied with a second boolean operation')
     pc=None
   except:
     return RetVal(False, 'Unexpected error while generating the mesh from the point cloud: '+traceback.format_exc(), 0, 15)
   if not result.ok:
     return result
-  #compose absolute paths for intermediate and final files
-  dirname    = op.dirname(fileSTL)
-  fs         = {k: op.join(dirname,v[0]) for k, v in specialFiles.iteritems()}
+  if opts['clean']:
+    result   = cleanInputMesh(result.val, 'mesh of the point cloud', 0, opts, report)
+    if not result.ok:
+      return result
   fileName, fileExtension = op.splitext(fileResult)#filePC)
   #fileResult = op.join(dirname, fileName+'.diff.stl')
   if fileExtension.lower()!='.stl': #heal fileResult if the extension is not correct
     fileResult = fileName+'.stl'
-  if useCube:
+  engine     = opts['engine'] or meshmode
+  if engine in engines.backends and engines.backends[engine].inprocess:
+    #no intermediate files: the meshes are passed to the engine as arrays
+    return doBooleansInProcess(engines.backends[engine], fileSTL, fileResult, useCube, cropping, limits, result.val, opts, report)
+  #compose absolute paths for intermediate and final files
+  dirname    = opts['workdir']
+  fs         = {k: op.join(dirname,v[0]) for k, v in specialFiles.iteritems()}
+  if useCube and not cropping:
     fileO    = fs['int']
   else:
     fileO    = fs['out']
@@ -199,25 +437,41 @@ def doDifference(filePC, fileSTL, fileResult, useCube, limits, zsub):
   #it is because the conversion has been successful, not because it was
   #already there
   map(removefile, toRemove+[fileResult])
-  if useCube:
+  if useCube and not cropping:
     #create limiting cube and the related intermediate OFF file
     cube     = createCubicMesh(limits)
     createOffFromMesh(fs['cube'],  *cube)
     if not fileCheck(fs['cube'], toRemove): return RetVal(False, 'Failed before diff: could not create file '+fs['cube'], -1, 16)
   #create OFF files for CORK
   createOffFromMesh(fs['pc'], *result.val)
-  result = None
   if not fileCheck(fs['pc'], toRemove):  return RetVal(False, 'Failed before diff: could not create file '+fs['pc'], -1, 17)
-  ret = safeConvert(toolpaths, mode, fileSTL, fs['stl'], toRemove,
-                    ('Failed before diff: could not convert the file %s to %s (%s may be invalid or be an empty mesh)' % (fileSTL, fs['stl'], fileSTL), -1, 18),
-                    ('Failed before diff: unexpected error trying to convert the file %s to %s' % (fileSTL, fs['stl']), -1, 19))
-  if not ret.ok: return ret
-  #execute meshdiff engine
-  ret   = callMeshEngine(toolpaths, toRemove, meshmode, 'diff',   fs, fs['pc'],  fs['stl'], fileO,      ('The meshdiff operation was not successful', -1, 20))
-  if not ret.ok: return ret
-  if useCube:
+  reference = opts['reference']
+  if reference is None:
+    ret = safeConvert(toolpaths, mode, fileSTL, fs['stl'], toRemove,
+                      ('Failed before diff: could not convert the file %s to %s (%s may be invalid or be an empty mesh)' % (fileSTL, fs['stl'], fileSTL), -1, 18),
+                      ('Failed before diff: unexpected error trying to convert the file %s to %s' % (fileSTL, fs['stl']), -1, 19))
+    if not ret.ok: return ret
+  elif not cropping:
+    createOffFromMesh(fs['stl'], *reference)
+    if not fileCheck(fs['stl'], toRemove): return RetVal(False, 'Failed before diff: could not create file '+fs['stl'], -1, 92)
+  empty = False
+  if cropping:
+    ret = cropReferenceMesh(reference, fs['stl'], limits, opts['cropmargin'], toRemove)
+    if not ret.ok: return ret
+    empty, msg = ret.val
+    report.append(msg)
+  if empty:
+    #nothing to subtract within the limits: the result is the cropped point cloud mesh
+    createOffFromMesh(fs['out'], *result.val)
+    if not fileCheck(fs['out'], toRemove): return RetVal(False, 'Failed before diff: could not create file '+fs['out'], -1, 92)
+  else:
+    #execute meshdiff engine
+    ret   = callMeshEngine(toolpaths, toRemove, engine, 'diff',   fs, fs['pc'],  fs['stl'], fileO,      ('The meshdiff operation was not successful', -1, 20))
+    if not ret.ok: return ret
+  result = None
+  if useCube and not cropping:
     #mesh engine another time: intersect with limiting cube
-    ret = callMeshEngine(toolpaths, toRemove, meshmode, 'inters', fs, fs['int'], fs['cube'], fs['out'], ('The second meshdiff operation (with the prism) was not successful', -1, 21))
+    ret = callMeshEngine(toolpaths, toRemove, engine, 'inters', fs, fs['int'], fs['cube'], fs['out'], ('The second meshdiff operation (with the prism) was not successful', -1, 21))
     if not ret.ok: return ret
   #convert OFF file to output STL file
   ret = safeConvert(toolpaths, mode, fs['out'], fileResult, toRemove,
@@ -227,42 +481,295 @@ def doDifference(filePC, fileSTL, fileResult, useCube, limits, zsub):
   if not fileCheck(fileResult, toRemove): return RetVal(False, 'No errors were detected, but the output file was not created: '+fileResult, -1, 24)
   #if successful, unconditionally remove files
   map(removefile, toRemove)
-  return RetVal(True, 'output file has been written: '+fileResult, -1, 0)
+  return RetVal(True, '\n'.join(['output file has been written: '+fileResult]+report), -1, 0)
+
+"""clean the mesh (verts, triangles) (see clean.py) with the tolerance in the
+option 'cleantolerance'. what names the mesh in the messages, and argnum is
+the argument to signal if it is empty after cleaning it. If cached is True,
+the cleaned mesh is taken from the cache of data derived from STL input
+meshes (see cache.py) if possible. Messages are appended to the list report.
+Returns the cleaned mesh"""
+def cleanInputMesh(mesh, what, argnum, opts, report, cached=False):
+  tolerance = opts['cleantolerance']
+  def builder(verts, triangles):
+    verts, triangles, counts = clean.cleanMesh(verts, triangles, tolerance)
+    return dict(counts, verts=verts, triangles=triangles)
+  try:
+    with profiling.stage('clean '+what):
+      if cached:
+        arrays, msg = cache.derivedCached('clean-closed-%r' % tolerance, mesh, builder)
+        report.append(msg)
+      else:
+        arrays = builder(*mesh)
+  except:
+    return RetVal(False, 'Unexpected error while cleaning the %s: %s' % (what, traceback.format_exc()), argnum, 110)
+  counts = dict((k, int(arrays[k])) for k in ['welded', 'degenerate', 'duplicate', 'unused'])
+  report.append('cleaning the %s: %d vertexes welded, %d degenerate and %d duplicate triangles removed, %d unused vertexes removed' %
+                (what, counts['welded'], counts['degenerate'], counts['duplicate'], counts['unused']))
+  if arrays['triangles'].shape[0]==0:
+    return RetVal(False, 'The %s does not have valid triangles after cleaning it' % what, argnum, 111)
+  return RetVal(True, (arrays['verts'], arrays['triangles']))
+
+"""drop the shells of the reference mesh (given as (verts, triangles), or None
+to read it from the OFF file fileOFF) which are outside the prism of the
+limits (expanded by margin), and write the result to fileOFF. Returns a flag
+signaling that no triangles are left, and a message"""
+@profiling.profiled('crop STL input mesh')
+def cropReferenceMesh(reference, fileOFF, limits, margin, toRemove):
+  try:
+    if reference is None:
+      reference = meshio.readOFF(fileOFF)
+    verts, triangles, msg = cropReference(reference, limits, margin)
+    if triangles.shape[0]>0:
+      removefile(fileOFF)
+      createOffFromMesh(fileOFF, verts, triangles)
+      if not fileCheck(fileOFF, toRemove):
+        return RetVal(False, 'Failed before diff: could not create file '+fileOFF, -1, 92)
+  except:
+    cleanFiles(toRemove)
+    return RetVal(False, 'Unexpected error while cropping the STL input mesh: '+traceback.format_exc(), -1, 93)
+  return RetVal(True, (triangles.shape[0]==0, msg))
+
+"""drop the shells of the reference mesh (verts, triangles) which are outside
+the prism of the limits (expanded by margin). Returns the remaining mesh and
+a message"""
+def cropReference(reference, limits, margin):
+  verts, triangles = reference
+  zlimits = [-n.inf, n.inf] if len(limits[2])==0 else limits[2]
+  verts, triangles, nshells, nkept = crop.dropShellsOutsideBox(verts, triangles, limits[0:2]+[zlimits], margin)
+  msg = 'cropping to the XY limits: %d of %d shells of the STL input mesh within the limits' % (nkept, nshells)
+  return verts, triangles, msg
+
+"""second half of doDifferenceInDir() for in-process mesh engines (see
+engines.py): the mesh of the point cloud (pcmesh) and the STL input mesh are
+passed to the engine as arrays, and the result is written directly to
+fileResult (which must already have the extension .stl), so there are no
+intermediate files"""
+def doBooleansInProcess(engine, fileSTL, fileResult, useCube, cropping, limits, pcmesh, opts, report):
+  removefile(fileResult)
+  reference = opts['reference']
+  if reference is None:
+    ret = loadReferenceMesh(fileSTL, op.join(opts['workdir'], specialFiles['stl'][0]), opts['refcache'], report)
+    if not ret.ok: return ret
+    reference = ret.val
+  missing = engine.missing(toolpaths)
+  if missing is not None:
+    return RetVal(False, missing, -1, engine.errcode)
+  if cropping:
+    try:
+      verts, triangles, msg = cropReference(reference, limits, opts['cropmargin'])
+    except:
+      return RetVal(False, 'Unexpected error while cropping the STL input mesh: '+traceback.format_exc(), -1, 93)
+    reference = (verts, triangles)
+    report.append(msg)
+  steps = []
+  if reference[1].shape[0]>0:
+    steps.append(('diff', reference, ('The meshdiff operation was not successful', -1, 20)))
+  #with cropping, an empty reference means that there is nothing to subtract within the limits
+  if useCube and not cropping:
+    steps.append(('inters', createCubicMesh(limits), ('The second meshdiff operation (with the prism) was not successful', -1, 21)))
+  mesh = pcmesh
+  for operation, other, msg in steps:
+    try:
+      with profiling.stage('mesh engine %s (%s)' % (engine.name, operation)):
+        mesh = engine.boolean(toolpaths, operation, mesh, other)
+    except engines.EngineError as e:
+      return RetVal(False, '%s: %s' % (msg[0], str(e)), *msg[1:])
+    except:
+      return RetVal(False, 'Unexpected exception while executing %s mesh engine: %s' % (engine.name, traceback.format_exc()), -1, 29)
+    if mesh[1].shape[0]==0:
+      return RetVal(False, *msg)
+  try:
+    with profiling.stage('write output STL'):
+      meshio.writeSTL(fileResult, *mesh)
+  except:
+    if DEBUG: traceback.print_exc()
+  if not op.isfile(fileResult):
+    return RetVal(False, 'No errors were detected, but the output file was not created: '+fileResult, -1, 24)
+  return RetVal(True, '\n'.join(['output file has been written: '+fileResult]+report), -1, 0)
+
+"""load the STL input mesh as (verts, triangles), to reuse it in several calls
+to doDifference (see the option 'reference'). If it cannot be read natively,
+it is converted to the OFF file tmpOFF with the fallback converter. If
+usecache is True, the mesh is taken from the cache of STL input meshes (see
+cache.py) if possible, and the outcome is appended to the list report"""
+@profiling.profiled('load STL input mesh')
+def loadReferenceMesh(fileSTL, tmpOFF, usecache=False, report=None):
+  if not usecache or not op.isfile(fileSTL):
+    return loadReferenceMeshUncached(fileSTL, tmpOFF)
+  failed = []
+  def loader(filename):
+    ret = loadReferenceMeshUncached(filename, tmpOFF)
+    if ret.ok:
+      return ret.val
+    failed.append(ret)
+  #the converters are part of the key, as they may produce different meshes
+  mesh, msg = cache.loadReferenceCached(fileSTL, loader, [convertmode, convertfallback])
+  if report is not None:
+    report.append(msg)
+  if mesh is None:
+    return failed[0]
+  return RetVal(True, mesh)
 
-"""helper to execute the mesh engine controlling for possible errors at every step"""
+"""load the STL input mesh, without using the cache (see loadReferenceMesh)"""
+def loadReferenceMeshUncached(fileSTL, tmpOFF):
+  reason = 'the mesh is empty'
+  try:
+    verts, triangles = meshio.readMesh(fileSTL)
+    if verts.shape[0]>0 and triangles.shape[0]>0:
+      return RetVal(True, (verts, triangles))
+  except Exception as e:
+    if DEBUG: traceback.print_exc()
+    reason = exceptionReason(e)
+  if convertfallback is not None:
+    ret = safeConvert(toolpaths, convertfallback, fileSTL, tmpOFF, [tmpOFF],
+                      ('Could not convert the file %s to %s (%s may be invalid or be an empty mesh)' % (fileSTL, tmpOFF, fileSTL), 1, 18),
+                      ('Unexpected error trying to convert the file %s to %s' % (fileSTL, tmpOFF), 1, 19))
+    if not ret.ok: return withNativeReason(ret, reason)
+    try:
+      verts, triangles = meshio.readOFF(tmpOFF)
+      if verts.shape[0]>0 and triangles.shape[0]>0:
+        return RetVal(True, (verts, triangles))
+    except:
+      if DEBUG: traceback.print_exc()
+    finally:
+      removefile(tmpOFF)
+  return withNativeReason(RetVal(False, 'Could not read the STL input file %s (it may be invalid or be an empty mesh)' % fileSTL, 1, 18), reason)
+
+"""Compute the signed distances from the points of the point cloud (within the
+limits) to the surface of the STL model (positive outside it), instead of the
+boolean difference, writing them to fileResult (a PLY file with the points,
+colored by their deviations, and the deviations as a scalar property). The
+arguments are the same as for doDifference() (zsub is not used), and the
+returned message has summary statistics of the deviations"""
+def doDeviation(filePC, fileSTL, fileResult, useCube, limits, zsub, opts=None):
+  opts = completeOptions(opts)
+  return runProfiled(opts, 'deviation', doDeviationUnprofiled, filePC, fileSTL, fileResult, useCube, limits, zsub, opts)
+
+"""body of doDeviation()"""
+def doDeviationUnprofiled(filePC, fileSTL, fileResult, useCube, limits, zsub, opts):
+  #sanity check
+  ret  = checklimits(useCube, limits, zsub)
+  if not ret.ok: return ret
+  ret  = checkOptions(opts)
+  if not ret.ok: return ret
+  #read point cloud and STL model
+  ret  = readPointCloud(filePC, opts)
+  if not ret.ok: return ret
+  pc   = ret.val
+  report = []
+  reference = opts['reference']
+  if reference is None:
+    try:
+      workdir = makeScratchDir(opts['scratchdir'])
+    except (IOError, OSError) as e:
+      return RetVal(False, 'Could not create a directory for the intermediate files: '+str(e), -1, 97)
+    ret = loadReferenceMesh(fileSTL, op.join(workdir, specialFiles['stl'][0]), opts['refcache'], report)
+    removeEmptyDir(workdir)
+    if not ret.ok: return ret
+    reference = ret.val
+  if opts['register']:
+    ret = registerPointCloud(pc, reference)
+    if not ret.ok: return ret
+    pc, transform, msg = ret.val
+    report.append(msg)
+  #remove the points outside the limits
+  mask = n.isfinite(pc).all(axis=1)
+  for axis in xrange(3):
+    if len(limits[axis])==2:
+      mask &= n.logical_and(pc[:,axis]>limits[axis][0], pc[:,axis]<limits[axis][1])
+  if not mask.all():
+    pc = pc[mask,:]
+  if pc.shape[0]==0:
+    return RetVal(False, 'There are no valid points within the limits in the point cloud', 0, 98)
+  #compute deviations
+  try:
+    index   = opts['refindex']
+    if index is None and opts['refcache']:
+      #the index of the triangles is cached with the STL input mesh
+      arrays, msg = cache.derivedCached('deviation-index', reference, lambda v, t: deviation.TriangleIndex(v, t).state())
+      index   = deviation.TriangleIndex.fromState(arrays)
+      report.append(msg)
+    with profiling.stage('deviations'):
+      dist, closest = deviation.pointDeviations(pc, reference[0], reference[1], index)
+    stats   = deviation.statistics(dist)
+    limit   = opts['deviationrange']
+    if limit is None:
+      limit = float(n.percentile(n.abs(dist), 99))
+    colors  = deviation.deviationColors(dist, limit)
+  except:
+    return RetVal(False, 'Unexpected error while computing the deviations: '+traceback.format_exc(), -1, 99)
+  removefile(fileResult)
+  try:
+    with profiling.stage('write output PLY'):
+      deviation.writePLY(fileResult, pc, dist, colors)
+  except:
+    if DEBUG: traceback.print_exc()
+  if not op.isfile(fileResult):
+    return RetVal(False, 'Could not write the output file '+fileResult, 2, 100)
+  report += ['deviations of %(points)d points: min %(min)g, max %(max)g, mean %(mean)g, std %(std)g, rms %(rms)g' % stats,
+            'percentiles: 5%% %(p5)g, 50%% %(median)g, 95%% %(p95)g; max absolute deviation %(maxabs)g' % stats,
+            'colors saturate at deviations of +/-%g' % limit]
+  return RetVal(True, '\n'.join(['output file has been written: '+fileResult]+report), -1, 0)
+
+"""align the point cloud to the STL model (verts, triangles) with ICP (see
+register.py), returning the transformed points, the 4x4 transformation and
+a message with the transformation and the residual"""
+@profiling.profiled('register')
+def registerPointCloud(pc, reference):
+  try:
+    transform, rms, inliers, iterations = register.icp(pc, *reference)
+    pc = register.transformPoints(transform, pc)
+  except:
+    return RetVal(False, 'Unexpected error while aligning the point cloud to the STL model: '+traceback.format_exc(), -1, 102)
+  rows = '\n'.join('  '+' '.join('%12.8g' % x for x in row) for row in transform)
+  msg  = 'point cloud aligned to the STL model in %d iterations (RMS residual %g, %.1f%% inliers), transformation:\n%s' % (iterations, rms, inliers*100, rows)
+  return RetVal(True, (pc, transform, msg))
+
+"""read the point cloud file, as specified in the options"""
+@profiling.profiled('read point cloud')
+def readPointCloud(filePC, opts):
+  if opts['points'] is not None:
+    return RetVal(True, opts['points'])
+  try:
+    fmt  = opts['pcformat'] or pointcloud.detectFormat(filePC)
+    if fmt!='text':
+      #binary files are memory-mapped, so they do not need the cache
+      pc = pointcloud.mapPointCloud(filePC, fmt)
+    elif opts['pccache']:
+      pc, hit = cache.loadPointCloudCached(filePC, pointcloud.loadPointCloud, opts['pccachehash'])
+    else:
+      pc = pointcloud.loadPointCloud(filePC)
+  except pointcloud.PointCloudError as e:
+    if e.columns is not None:
+      return RetVal(False, str(e), 0, 14)
+    return RetVal(False, 'Could not read point cloud file %s: %s' % (filePC, str(e)), -1, 12)
+  except:
+    return RetVal(False, 'Could not read point cloud file '+filePC, -1, 12)
+  if pc.size==0:
+    return RetVal(False, 'Incorrect or empty point cloud file '+filePC, -1, 13)
+  if pc.shape[1]!=3:
+    return RetVal(False, 'Point cloud must have 3 columns, but it has '+str(pc.shape[1]), 0, 14)
+  return RetVal(True, pc)
+
+"""helper to execute the mesh engine (see engines.py) on OFF files controlling for possible errors at every step"""
 def callMeshEngine(toolpaths, toRemove, mode, operation, fs, in1, in2, out, msg):
   try:
     #we support two operations: difference and intersection
-    if operation=='diff':
-      dodiff = True
-    elif operation=='inters':
-      dodiff = False
-    else:
+    if operation not in engines.operations:
       cleanFiles(toRemove)
       return RetVal(False, 'Unexpected mesh engine operation: '+operation, -1, 25)
-    #prepare command line for cork mesh engine
-    if mode == 'cork':
-      if not op.isfile(toolpaths['cork']):
-        cleanFiles(toRemove)
-        return RetVal(False, 'cork was selected as meshdiff engine, but the executable could not be found: '+toolpaths['cork'], -1, 26)
-      operation = '-diff' if dodiff else '-isct'
-      command = [toolpaths['cork'], operation, in1, in2, out]
-    #prepare command line for openscad mesh engine
-    elif mode == 'openscad':
-      if (os.name=='nt') and not op.isfile(toolpaths['openscad']):
-        cleanFiles(toRemove)
-        return RetVal(False, 'openscad was selected as meshdiff engine, but the executable could not be found: '+toolpaths['openscad'], -1, 27)
-      operation = 'difference' if dodiff else 'intersection'
-      filestr = ('%s(){import("%s");import("%s");}' % (operation, str(in1).encode('string_escape'), str(in2).encode('string_escape')))
-      with open(fs['scad'], 'w') as f:
-        f.write(filestr)
-      command = [toolpaths['openscad'], '-o', out, fs['scad']]
-    #unrecognized engine
-    else:
+    if mode not in engines.backends:
       cleanFiles(toRemove)
       return RetVal(False, 'Unrecognized mesh engine mode: '+mode, -1, 28)
+    engine  = engines.backends[mode]
+    missing = engine.missing(toolpaths)
+    if missing is not None:
+      cleanFiles(toRemove)
+      return RetVal(False, missing, -1, engine.errcode)
     #execute engine
-    sub.call(command)
+    with profiling.stage('mesh engine %s (%s)' % (mode, operation)):
+      engine.run(toolpaths, operation, in1, in2, out, op.dirname(out))
     if not fileCheck(out, toRemove):
       return RetVal(False, *msg)
     return RetVal(True)
@@ -270,28 +777,58 @@ def callMeshEngine(toolpaths, toRemove, mode, operation, fs, in1, in2, out, msg)
     cleanFiles(toRemove)
     return RetVal(False, 'Unexpected exception while executing %s mesh engine: %s' % (mode, traceback.format_exc()), -1, 29)
 
-"""helper to execute the conversion engine (either freecad or meshlab) controlling for possible errors at every step"""
+"""helper to execute the conversion engine (native, freecad or meshlab) controlling for possible errors at every step
+(if the native conversion fails, its reason is added to the error message of the fallback)"""
 def safeConvert(toolpaths, mode, inp, outp, toRemove, msg1, msg2):
-  if mode=='freecad':
-    #command = '"%s" "%s" "%s" "%s"' % (toolpaths['freecadp'], freecadscript, inp, outp)
-    command = [toolpaths['freecadp'], freecadscript, inp, outp]
-  elif mode=='meshlab':
-    #command = '"%s" -i "%s" -o "%s"' % (toolpaths['meshlab'], inp, outp)
-    command = [toolpaths['meshlab'], '-i', inp, '-o', outp]
-  else:
-    Exception('Unrecognized mode for safeConvert: '+mode)
-  try:
-    #print command
-    #os.system(command)
-    sub.call(command)
-    if not fileCheck(outp, toRemove):
-      return RetVal(False, *msg1)
-    return RetVal(True)
-  except:
-    if DEBUG: traceback.print_exc()
-    cleanFiles(toRemove)
-    return RetVal(False, *msg2)
+  with profiling.stage('convert %s to %s' % (op.basename(inp), op.basename(outp))):
+    reason = None
+    if mode=='native':
+      try:
+        if not meshio.convertMesh(inp, outp):
+          reason = 'the mesh is empty'
+      except Exception as e:
+        if DEBUG: traceback.print_exc()
+        reason = exceptionReason(e)
+      if op.isfile(outp):
+        return RetVal(True)
+      if convertfallback is None:
+        return withNativeReason(safeConvertResult(outp, toRemove, msg1), reason)
+      mode = convertfallback
+    if mode=='freecad':
+      #command = '"%s" "%s" "%s" "%s"' % (toolpaths['freecadp'], freecadscript, inp, outp)
+      command = [toolpaths['freecadp'], freecadscript, inp, outp]
+    elif mode=='meshlab':
+      #command = '"%s" -i "%s" -o "%s"' % (toolpaths['meshlab'], inp, outp)
+      command = [toolpaths['meshlab'], '-i', inp, '-o', outp]
+    else:
+      cleanFiles(toRemove)
+      return withNativeReason(RetVal(False, 'Unrecognized mode for safeConvert: %s' % mode, msg2[1], msg2[2]), reason)
+    try:
+      #print command
+      #os.system(command)
+      profiling.call(command)
+      return withNativeReason(safeConvertResult(outp, toRemove, msg1), reason)
+    except:
+      if DEBUG: traceback.print_exc()
+      cleanFiles(toRemove)
+      return withNativeReason(RetVal(False, *msg2), reason)
+
+"""a short description of an exception, for error messages"""
+def exceptionReason(e):
+  return '%s: %s' % (e.__class__.__name__, e) if str(e) else e.__class__.__name__
 
+"""add the reason of the failure of the native conversion (if there is one) to
+the message of a failed RetVal"""
+def withNativeReason(ret, reason):
+  if ret.ok or reason is None:
+    return ret
+  return RetVal(False, '%s (native conversion failed: %s)' % (ret.val, reason), ret.argnum, ret.errcode)
+
+"""check the output of a conversion"""
+def safeConvertResult(outp, toRemove, msg1):
+  if not fileCheck(outp, toRemove):
+    return RetVal(False, *msg1)
+  return RetVal(True)
 
 """logic to check if a file has been created, if it is not and we are not
 debugging, remove all previous files"""
@@ -318,9 +855,136 @@ def removefile(path):
     if DEBUG: traceback.print_exc()
 
 
+"""decimate the point cloud (after removing the points outside the Z limits,
+which must not be averaged with the valid ones), returning the decimated
+points and a message with the results"""
+@profiling.profiled('decimate')
+def decimatePointCloud(points, zlimits, mode, tolerance):
+  mask = n.isfinite(points).all(axis=1)
+  if len(zlimits)==2:
+    mask &= n.logical_and(points[:,2]<zlimits[1], points[:,2]>zlimits[0])
+  before = points.shape[0]
+  if not mask.all():
+    points = points[mask,:]
+  if points.shape[0]==0:
+    return RetVal(False, 'There are no valid points to decimate in the point cloud', 0, 39)
+  points, error = decimate.decimate(points, mode, tolerance)
+  msg = 'decimation (%s, tolerance %g): %d -> %d points, max height error %g' % (mode, tolerance, before, points.shape[0], error)
+  return RetVal(True, (points, msg))
+
+"""convert the point cloud to single precision, halving the memory used by it
+and by its mesh (the triangles of meshes with single precision points are
+built with 32-bit indexes). The mesh engines use single precision
+coordinates anyway, so this loses nothing in the boolean operations, but
+the meshing steps (cropping, simplification, cleaning) see rounded points.
+The point cloud is converted only if the rounding error is not higher than
+tolerance (see compactTolerance). Returns the point cloud and a message"""
+def compactPointCloud(points, tolerance):
+  if points.dtype==n.float32:
+    return points, 'compact mode: the point cloud is already in single precision'
+  maxabs = max(abs(float(n.nanmax(points))), abs(float(n.nanmin(points)))) if points.size>0 else 0.0
+  error  = roundingError(maxabs)
+  if error>tolerance:
+    return points, 'compact mode: the point cloud has been kept in double precision (the rounding error would be up to %g, the tolerance is %g)' % (error, tolerance)
+  return points.astype(n.float32), 'compact mode: the point cloud has been converted to single precision (rounding error up to %g, the tolerance is %g)' % (error, tolerance)
+
+"""bound of the rounding error of converting coordinates not higher than
+maxabs (in absolute value) to single precision: half the spacing of float32
+at maxabs"""
+def roundingError(maxabs):
+  return float(n.spacing(n.float32(maxabs)))/2
+
+"""maximum rounding error of the point cloud in compact mode: the option
+'compacttolerance' or, if it is None, the rounding error of the STL input
+mesh reference (STL files store the coordinates in single precision), so the
+point cloud is never rounded more than the STL input file already is"""
+def compactTolerance(opts, reference):
+  if opts['compacttolerance'] is not None:
+    return opts['compacttolerance']
+  verts = reference[0]
+  return roundingError(n.abs(verts).max()) if verts.size>0 else 0.0
+
+"""integer type of the triangles of a mesh with these points: 32-bit indexes
+for single precision points (see compactPointCloud), 64-bit otherwise"""
+def indexType(points):
+  return n.int32 if points.dtype==n.float32 else n.int64
+
 """Creates a mesh from a point cloud, as a cylinder: top and base meshes
-connected by a ribbon"""
-def createMeshFromPointCloud(points, zlimits, zsub):#(d, zmax, zmin, zsub):
+connected by a ribbon. The top mesh is built with a Delaunay triangulation
+(mode 'delaunay'), from the scan lines of a line scanner (mode 'grid', see
+gridmesh.py; samples is the number of samples per line, None to detect the
+lines), or with the scan lines if they can be detected, otherwise with a
+Delaunay triangulation (mode 'auto'). If croplimits is not None (XYZ limits,
+as in doDifference), the mesh is cropped to the prism of the limits. The
+base is zsub below the lowest point, unless its height is given in zbase.
+If simplification is not None (maximum error and number of triangles, either
+can be None), the upper face is simplified (see simplify.py) before adding
+the ribbon and the base, and a message is appended to the list report.
+If upper is not None, it is the upper face, already built (as returned by
+createUpperFaceFromScanLines), and points is not used"""
+@profiling.profiled('mesh point cloud')
+def createMeshFromPointCloud(points, zlimits, zsub, mode='delaunay', samples=None, croplimits=None, zbase=None, simplification=None, report=None, upper=None):#(d, zmax, zmin, zsub):
+  result = None
+  if upper is not None:
+    result = RetVal(True, upper)
+  elif mode in ['grid', 'auto']:
+    with profiling.stage('detect scan lines'):
+      lines = gridmesh.scanLineIds(points, samples)
+    if lines is not None:
+      result = createUpperFaceFromScanLines(points, zlimits, *lines)
+    elif mode=='grid':
+      return RetVal(False, 'Error trying to generate a mesh from the point cloud: the scan lines could not be detected', -1, 33)
+  if result is None:
+    result = createUpperFace(points, zlimits)
+  if not result.ok:
+    return result
+  usedPoints, tU, ordered, tBorder = result.val
+  if zbase is None:
+    zbase = usedPoints[:,2].min()-zsub
+  if croplimits is not None:
+    with profiling.stage('crop'):
+      usedPoints, tU = crop.clipToRect(usedPoints, tU, croplimits[0]+croplimits[1])
+      tU = tU.astype(indexType(usedPoints), copy=False)
+    if tU.shape[0]==0:
+      return RetVal(False, 'Error trying to generate a mesh from the point cloud: there are no points within the XY limits', -1, 90)
+    with profiling.stage('border edges'):
+      border = crop.borderEdges(tU)
+    ret = orderBorder(border)
+    if not ret.ok:
+      return ret
+    ordered = ret.val
+    tBorder = None
+    zbase   = max(zbase, croplimits[2][0])
+  if simplification is not None:
+    ret = simplifyUpperFace(usedPoints, tU, ordered, *simplification)
+    if not ret.ok:
+      return ret
+    usedPoints, tU, ordered, msg = ret.val
+    if report is not None:
+      report.append(msg)
+  return closeMesh(usedPoints, tU, ordered, zbase, tBorder, croplimits is not None)
+
+"""simplify the upper face of the mesh of the point cloud (see simplify.py),
+keeping its border (given as the ordered indexes of its points), so the
+ribbon and the base built from it are not changed. Returns the new points,
+triangles and ordered border, and a message"""
+@profiling.profiled('simplify')
+def simplifyUpperFace(usedPoints, tU, ordered, maxerror, maxfaces):
+  try:
+    locked = n.zeros(usedPoints.shape[0], dtype=bool)
+    locked[ordered] = True
+    points, triangles, remap, error = simplify.simplify(usedPoints, tU, locked, maxerror, maxfaces)
+  except:
+    return RetVal(False, 'Unexpected error while simplifying the mesh of the point cloud: '+traceback.format_exc(), -1, 113)
+  msg = 'simplification of the mesh of the point cloud: %d -> %d triangles in the upper face (%.1f%% fewer), max quadric error %g' % (
+        tU.shape[0], triangles.shape[0], 100.0*(tU.shape[0]-triangles.shape[0])/max(tU.shape[0], 1), error)
+  return RetVal(True, (points, triangles, remap[ordered], msg))
+
+"""Creates the upper face of the mesh with a Delaunay triangulation of the
+point cloud. Returns the used points, the triangles, the ordered border and
+None (see createUpperFaceFromScanLines)"""
+@profiling.profiled('delaunay')
+def createUpperFace(points, zlimits):
   #remove invalid points  
   if len(zlimits)==2:
     mask   = n.logical_and(points[:,2]<zlimits[1], points[:,2]>zlimits[0])
@@ -340,56 +1004,162 @@ def createMeshFromPointCloud(points, zlimits, zsub):#(d, zmax, zmin, zsub):
   tU = tessU.simplices
   
   #get border edges in border triangles
-  i1, i2 = (tessU.neighbors==-1).nonzero() #indexes of vertexes not opossed to a triangle, they are not in the edge of the mesh, but the other two vertexes of the triangle are!
-  i21 = (i2+1)%3  #these are the column indexes of vertexes in the edge of the mesh
-  i22 = (i21+1)%3 #
-  ps = n.column_stack((tU[i1,i21], tU[i1,i22])) #edges at the edge of the mesh
+  ps = delaunayBorderEdges(tessU)
   #order the points in the edges (counterclockwise)
-  ordered = n.empty(ps.shape[0], dtype=n.int32)
-  ordered[0] = ps[0,0] #seed the sequence with the first edge
-  ordered[1] = ps[0,1]
-  ps[0,:] = -1
-  io = 2
-  while io<ordered.size:
-    i1, i2 = (ps==ordered[io-1]).nonzero() #get the position of the last vertex in the ordered sequence
-    if i1.size!=1: #each vertex should appear only twice in the list of edges
-      return RetVal(False, "could not get ordered border for delaunay triangulation", -1, 31)
-    ordered[io] = ps[i1, (i2+1)%2] #add the adjacent vertex to the ordered list
-    ps[i1,:] = -1 #remove the edge from the list of edges
-    io += 1
+  ret = orderBorder(ps)
+  if not ret.ok:
+    return ret
+  ordered = ret.val
+  return RetVal(True, (usedPoints, tU, ordered, None))
+
+"""Creates the upper face of the mesh from a point cloud with the structure of
+a line scanner (the line of each point is in lineids, -1 for invalid points,
+and fast is the axis along the lines). Returns the used points, the triangles,
+the ordered border and the triangles of the base"""
+@profiling.profiled('scan lines')
+def createUpperFaceFromScanLines(points, zlimits, lineids, fast):
+  #remove invalid points (and scanner dropouts)
+  mask = lineids>=0
+  mask &= n.isfinite(points[:,2])
+  if len(zlimits)==2:
+    mask &= n.logical_and(points[:,2]<zlimits[1], points[:,2]>zlimits[0])
+  idxs    = n.flatnonzero(mask)
+  lineids = lineids[idxs]
+  #remove lines with less than two points
+  counts  = n.bincount(lineids)
+  keep    = counts[lineids]>=2
+  idxs    = idxs[keep]
+  lineids = lineids[keep]
+  if n.unique(lineids).size<2:
+    return RetVal(False, 'Error trying to generate a mesh from the point cloud: less than two scan lines have valid points', -1, 34)
+  #sort the points by line, and by the fast coordinate within each line
+  order      = n.lexsort((points[idxs,fast], lineids))
+  idxs       = idxs[order]
+  lineids    = lineids[order]
+  itype      = indexType(points)
+  usedPoints = points[idxs,:]
+  tU, ordered, tBorder = gridmesh.meshScanLines(usedPoints, lineids.astype(itype, copy=False), fast, itype)
+  return RetVal(True, (usedPoints, tU, ordered, tBorder))
+
+"""check that the triangles of a Delaunay triangulation of a polygon are a
+valid triangulation of the polygon: it must be convex (otherwise, some of the
+triangles would be outside) and all its points must have been used"""
+def validPolygonTriangulation(xy, simplices):
+  nb  = xy.shape[0]
+  if simplices.shape[0]!=nb-2 or n.unique(simplices).size!=nb:
+    return False
+  e1  = n.roll(xy, -1, axis=0)-xy
+  e0  = n.roll(e1, 1, axis=0)
+  cross = e0[:,0]*e1[:,1]-e0[:,1]*e1[:,0]
+  scale = n.abs(e0).max()*n.abs(e1).max()
+  return bool((cross>=-1e-12*scale).all())
+
+"""Given the upper face of the mesh (points and triangles) and its ordered
+border, add the base (at height zbase) and the ribbon connecting it to the
+upper face. The base is triangulated with a Delaunay triangulation of the
+border, unless its triangles are provided in tBorder (as indexes in the
+border, counterclockwise). If checkBase is True, the Delaunay triangulation
+is checked to be valid for the border; if it is not (the border is not
+convex), the base is a copy of the upper face"""
+@profiling.profiled('close mesh')
+def closeMesh(usedPoints, tU, ordered, zbase, tBorder=None, checkBase=False):
   #points in the base are those at the edge, but lowered by a certain amount  
   newpoints = usedPoints[ordered,:]
-  newpoints[:,2] = usedPoints[:,2].min()-zsub
+  newpoints[:,2] = zbase
+  #get base mesh
+  copyBase  = False
+  if tBorder is None:
+    try:
+      #tessB = Delaunay(newpoints[:,0:2], qhull_options='QJ') #This is to make sure that all points are used
+      tessB = Delaunay(newpoints[:,0:2])
+      tBorder = tessB.simplices
+    except:
+      traceback.print_exc()
+      if not checkBase:
+        return RetVal(False, 'Error trying to generate a mesh from the point cloud: Delaunay triangulation of the base failed', -1, 32)
+    copyBase = checkBase and (tBorder is None or not validPolygonTriangulation(newpoints[:,0:2], tBorder))
+  itype  = indexType(usedPoints)
+  nU, nb = usedPoints.shape[0], ordered.size
+  nL     = nU if copyBase else nb
+  nT     = tU.shape[0] if copyBase else tBorder.shape[0]
+  #the arrays with all points and all triangles are filled in place, to avoid
+  #the copies of concatenating the parts
+  allPoints = n.empty((nU+nL, 3), dtype=usedPoints.dtype)
+  allPoints[:nU] = usedPoints
+  tA     = n.empty((tU.shape[0]+2*nb+nT, 3), dtype=itype)
+  tA[:tU.shape[0]] = tU
+  if copyBase:
+    #the base is a copy of the upper face
+    allPoints[nU:] = usedPoints
+    allPoints[nU:,2] = zbase
+    #ordered list of vertexes at the lower mesh
+    nidxL = nU+ordered
+  else:
+    allPoints[nU:] = newpoints
+    #ordered list of vertexes at the lower mesh
+    nidxL = n.arange(nU, nU+nb)
   #ordered list of vertexes at the edges of the upper mesh
   nidxU = ordered
   #same, list, but shifted
-  nidxUp1 = n.concatenate((ordered[ordered.shape[0]-1:ordered.shape[0]], ordered[0:-1]))
-  #ordered list of vertexes at the lower mesh
-  nidxL = n.arange(usedPoints.shape[0], usedPoints.shape[0]+newpoints.shape[0])
+  nidxUp1 = n.roll(ordered, 1)
   #same, list, but shifted the other way around
-  nidxLm1 = n.concatenate((nidxL[1:nidxL.size], nidxL[0:1]))
+  nidxLm1 = n.roll(nidxL, -1)
   #triangles for the connecting ribbon
-  Tmed1 = n.column_stack((nidxU, nidxUp1, nidxL))
-  Tmed2 = n.column_stack((nidxLm1, nidxU, nidxL))
-  #get base mesh
-  try:
-    #tessB = Delaunay(newpoints[:,0:2], qhull_options='QJ') #This is to make sure that all points are used
-    tessB = Delaunay(newpoints[:,0:2])
-  except:
-    traceback.print_exc()
-    return RetVal(False, 'Error trying to generate a mesh from the point cloud: Delaunay triangulation of the base failed', -1, 32)
-  #reindex the triangles of the base mesh
-  tB = nidxL[tessB.simplices]
-  # this is to have all triangles of the base mesh to be counterclockwise
-  tB = tB[:,[0,2,1]] 
-  tA = n.concatenate((tU, Tmed1, Tmed2, tB))
-  #create arrays with all points
-  allPoints  = n.concatenate((usedPoints, newpoints))
+  ribbon = tA[tU.shape[0]:tU.shape[0]+2*nb]
+  ribbon[:nb,0], ribbon[:nb,1], ribbon[:nb,2] = nidxU, nidxUp1, nidxL
+  ribbon[nb:,0], ribbon[nb:,1], ribbon[nb:,2] = nidxLm1, nidxU, nidxL
+  #the triangles of the base, reindexed and flipped to have all of them counterclockwise
+  base  = tA[tU.shape[0]+2*nb:]
+  for dst, src in [(0, 0), (1, 2), (2, 1)]:
+    base[:,dst] = tU[:,src]+nU if copyBase else nidxL[tBorder[:,src]]
   return RetVal(True, (allPoints, tA))
-  #return RetVal(True, (allPoints, tA, (tU.copy(), Tmed1, Tmed2, tB)))
   
 
 
+"""get the edges at the border of a Delaunay triangulation, as an array of shape (B,2)"""
+def delaunayBorderEdges(tess):
+  tU = tess.simplices
+  i1, i2 = (tess.neighbors==-1).nonzero() #indexes of vertexes not opossed to a triangle, they are not in the edge of the mesh, but the other two vertexes of the triangle are!
+  i21 = (i2+1)%3  #these are the column indexes of vertexes in the edge of the mesh
+  i22 = (i21+1)%3 #
+  return n.column_stack((tU[i1,i21], tU[i1,i22])) #edges at the edge of the mesh
+
+"""Given the edges at the border of a mesh (as an array of shape (B,2), each
+row being the indexes of the vertexes of an edge), return the vertexes in the
+order in which they are visited walking along the border, starting with the
+first edge. The border must be a single closed loop in which every vertex
+appears in exactly two edges, otherwise the mesh is not manifold. The
+adjacency is built with vectorized operations, and the walk is linear in B"""
+@profiling.profiled('border ordering')
+def orderBorder(ps):
+  nb = ps.shape[0]
+  if nb<3:
+    return RetVal(False, "could not get ordered border for delaunay triangulation", -1, 31)
+  #sort all edge endpoints by vertex: each vertex must appear exactly twice
+  flat   = ps.ravel()
+  other  = ps[:,::-1].ravel()
+  order  = n.argsort(flat, kind='mergesort')
+  sflat  = flat[order]
+  verts  = sflat[0::2]
+  if not ((verts==sflat[1::2]).all() and (verts[1:]!=verts[:-1]).all()):
+    return RetVal(False, "could not get ordered border for delaunay triangulation", -1, 31)
+  #for each vertex (by position in verts), the positions of its two neighbours
+  nbrs   = n.searchsorted(verts, other[order]).reshape(-1, 2).tolist()
+  start  = int(n.searchsorted(verts, ps[0,0]))
+  prev   = start
+  cur    = int(n.searchsorted(verts, ps[0,1]))
+  walk   = [start, cur]
+  for io in xrange(2, nb):
+    a, b = nbrs[cur]
+    nxt  = b if a==prev else a
+    if nxt==start: #the loop has been closed before visiting all vertexes
+      return RetVal(False, "could not get ordered border for delaunay triangulation", -1, 31)
+    walk.append(nxt)
+    prev, cur = cur, nxt
+  if start not in nbrs[cur]:
+    return RetVal(False, "could not get ordered border for delaunay triangulation", -1, 31)
+  return RetVal(True, verts[walk].astype(n.int32))
+
 """given a set of limits for each axis as [[xmin, xmax],[ymin, ymax],[zmin, zmax]],
 generate a mesh representing a prism"""
 def createCubicMesh(limits):
@@ -423,12 +1193,8 @@ def createCubicMesh(limits):
 """Given a mesh in the format (verts, triangs), create an OFF file"""
 def createOffFromMesh(filename, verts, triangles):
   try:
-    triangles = n.column_stack((n.full(triangles.shape[0], 3), triangles))
-    with open(filename, 'w') as f:
-      f.write("OFF\n")
-      f.write("%s %s 0\n" % (str(verts.shape[0]), str(triangles.shape[0])))
-      n.savetxt(f, verts,     fmt='%f')
-      n.savetxt(f, triangles, fmt='%d')
+    with profiling.stage('write '+op.basename(filename)):
+      meshio.writeOFF(filename, verts, triangles)
   except:
     traceback.print_exc()
 
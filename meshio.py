@@ -0,0 +1,199 @@
+import numpy as n
+import os.path as op
+import re
+
+"""In-process readers and writers for the mesh formats used by meshdiff (STL
+and OFF), so that we do not have to launch an external converter just to
+translate between them. Meshes are handled as a tuple (verts, triangles),
+the same representation used by createMeshFromPointCloud()"""
+
+#layout of a facet record in a binary STL file
+stlRecord = n.dtype([('normal', '<f4', (3,)),
+                     ('verts',  '<f4', (3,3)),
+                     ('attr',   '<u2')])
+
+stlHeaderSize = 80
+
+#significant digits of the coordinates in OFF files: 9 digits represent any
+#float32 number exactly (cork uses float32 coordinates internally). Use 17
+#digits to represent float64 coordinates exactly
+offprecision = 9
+
+#number of rows formatted at once when writing text files
+textchunk = 1<<16
+
+#number of facet records built at once when writing binary STL files
+stlchunk = 1<<18
+
+#header of an OFF file: keyword and numbers of vertexes, faces and edges. The
+#variants with more data per vertex (COFF, NOFF, STOFF, 4OFF...) are not
+#supported, as their vertexes would be read wrong
+offHeader = re.compile(br'\s*OFF\s+(\d+)\s+(\d+)\s+(\d+)')
+
+#float numbers in ASCII STL files, after the 'vertex' keyword
+asciiVertex = re.compile(br'vertex\s+(\S+)\s+(\S+)\s+(\S+)')
+
+"""merge identical vertices in an array of triangle corners (shape (M,3,3)),
+returning the mesh as (verts, triangles)"""
+def weldCorners(corners):
+  corners = n.ascontiguousarray(corners.reshape(-1, 3), dtype=n.float64)
+  #+0.0 to normalize negative zeros, so that they are welded with positive zeros
+  corners += 0.0
+  #view each row as a single opaque value, to make n.unique work on rows
+  rows    = corners.view(n.dtype((n.void, corners.dtype.itemsize*3))).ravel()
+  _, first, inverse = n.unique(rows, return_index=True, return_inverse=True)
+  verts     = corners[first]
+  triangles = inverse.reshape(-1, 3).astype(n.int64)
+  return (verts, triangles)
+
+"""True if the file looks like a binary STL file"""
+def isBinarySTL(data):
+  if len(data)<stlHeaderSize+4:
+    return False
+  count = n.frombuffer(data, dtype='<u4', count=1, offset=stlHeaderSize)[0]
+  if len(data)==stlHeaderSize+4+stlRecord.itemsize*int(count):
+    return True
+  #some exporters write binary files with a header starting with 'solid', so
+  #we only trust the header if the size test has failed
+  return not data[:5].lower()==b'solid'
+
+"""read a STL file (binary or ASCII) as (verts, triangles)"""
+def readSTL(filename):
+  with open(filename, 'rb') as f:
+    data = f.read()
+  if isBinarySTL(data):
+    count   = n.frombuffer(data, dtype='<u4', count=1, offset=stlHeaderSize)[0]
+    count   = min(int(count), (len(data)-stlHeaderSize-4)//stlRecord.itemsize)
+    records = n.frombuffer(data, dtype=stlRecord, count=count, offset=stlHeaderSize+4)
+    corners = records['verts']
+  else:
+    coords  = asciiVertex.findall(data)
+    if len(coords)%3!=0:
+      raise ValueError('ASCII STL file %s has a number of vertices which is not a multiple of 3' % filename)
+    corners = n.array(coords, dtype=n.float64)
+  return weldCorners(corners)
+
+"""write a mesh (verts, triangles) as a binary STL file"""
+def writeSTL(filename, verts, triangles):
+  with open(filename, 'wb') as f:
+    writeSTLHeader(f, triangles.shape[0])
+    writeSTLRecords(f, verts, triangles)
+
+"""write the header of a binary STL file with ntriangles triangles"""
+def writeSTLHeader(f, ntriangles):
+  f.write(b'binary STL written by meshdiff'.ljust(stlHeaderSize, b' '))
+  n.array([ntriangles], dtype='<u4').tofile(f)
+
+"""records of a binary STL file for the mesh (verts, triangles)"""
+def stlRecords(verts, triangles):
+  corners  = verts[triangles]
+  normals  = n.cross(corners[:,1,:]-corners[:,0,:], corners[:,2,:]-corners[:,0,:])
+  lengths  = n.sqrt((normals*normals).sum(axis=1))
+  lengths[lengths==0] = 1
+  normals /= lengths[:,n.newaxis]
+  records  = n.zeros(triangles.shape[0], dtype=stlRecord)
+  records['normal'] = normals
+  records['verts']  = corners
+  return records
+
+"""write the records of the mesh (verts, triangles) to the binary STL file f,
+building stlchunk records at once (the corners of the triangles take much
+more memory than the mesh itself)"""
+def writeSTLRecords(f, verts, triangles):
+  for start in xrange(0, triangles.shape[0], stlchunk):
+    stlRecords(verts, triangles[start:start+stlchunk]).tofile(f)
+
+"""read an OFF file as (verts, triangles). Polygonal faces are split in fans
+of triangles. Files without comments (such as the ones written by cork) are
+parsed with a single call to n.fromstring(). Raises ValueError for the
+variants of the format (see offHeader)"""
+def readOFF(filename):
+  with open(filename, 'rb') as f:
+    text = f.read()
+  header = offHeader.match(text)
+  if header is not None and b'#' not in text:
+    nv, nf = int(header.group(1)), int(header.group(2))
+    values = n.fromstring(text[header.end():], dtype=n.float64, sep=' ')
+    if values.size>=nv*3+nf*4:
+      verts = values[:nv*3].reshape(-1, 3)
+      faces = values[nv*3:].astype(n.int64)
+      return (verts, facesToTriangles(faces, nf, filename))
+  #slow path: comments, or malformed numbers
+  if b'#' in text:
+    text = re.sub(br'#[^\n]*', b'', text)
+  tokens = text.split()
+  if len(tokens)==0 or not tokens[0].endswith(b'OFF'):
+    raise ValueError('File %s is not in OFF format' % filename)
+  if tokens[0]!=b'OFF':
+    raise ValueError('File %s is in the %s variant of the OFF format, which is not supported' % (filename, tokens[0]))
+  nv, nf = int(tokens[1]), int(tokens[2])
+  start  = 4
+  verts  = n.array(tokens[start:start+nv*3], dtype=n.float64).reshape(-1, 3)
+  faces  = n.array(tokens[start+nv*3:], dtype=n.int64)
+  return (verts, facesToTriangles(faces, nf, filename))
+
+"""convert the face section of an OFF file (a flat sequence of vertex counts,
+each one followed by the vertex indexes) to an array of triangles"""
+def facesToTriangles(faces, nf, filename):
+  if nf==0:
+    return n.empty((0, 3), dtype=n.int64)
+  if faces.size>=nf*4 and (faces[0:nf*4:4]==3).all():
+    return faces[:nf*4].reshape(-1, 4)[:,1:].copy()
+  #general case: polygons with an arbitrary number of vertexes
+  triangles = []
+  pos = 0
+  for i in xrange(nf):
+    cnt  = faces[pos]
+    poly = faces[pos+1:pos+1+cnt]
+    if poly.size!=cnt:
+      raise ValueError('File %s has a truncated face list' % filename)
+    for k in xrange(1, cnt-1):
+      triangles.append((poly[0], poly[k], poly[k+1]))
+    pos += 1+cnt
+  return n.array(triangles, dtype=n.int64).reshape(-1, 3)
+
+"""write the rows of an array to a file, formatting textchunk rows at once
+with the format fmt (for a whole row)"""
+def writeRows(f, array, fmt):
+  for start in xrange(0, array.shape[0], textchunk):
+    chunk = array[start:start+textchunk]
+    f.write((fmt*chunk.shape[0]) % tuple(chunk.ravel().tolist()))
+
+"""write a mesh (verts, triangles) as an OFF file, with precision significant
+digits for the coordinates (None for offprecision)"""
+def writeOFF(filename, verts, triangles, precision=None):
+  if precision is None:
+    precision = offprecision
+  vfmt = '%%.%dg %%.%dg %%.%dg\n' % (precision, precision, precision)
+  with open(filename, 'w') as f:
+    f.write("OFF\n")
+    f.write("%d %d 0\n" % (verts.shape[0], triangles.shape[0]))
+    writeRows(f, verts, vfmt)
+    writeRows(f, triangles, '3 %d %d %d\n')
+
+readers = {'.stl': readSTL, '.off': readOFF}
+writers = {'.stl': writeSTL, '.off': writeOFF}
+
+"""read a mesh file, choosing the format from the extension"""
+def readMesh(filename):
+  ext = op.splitext(filename)[1].lower()
+  if ext not in readers:
+    raise ValueError('Unsupported mesh format: '+filename)
+  return readers[ext](filename)
+
+"""write a mesh file, choosing the format from the extension"""
+def writeMesh(filename, verts, triangles):
+  ext = op.splitext(filename)[1].lower()
+  if ext not in writers:
+    raise ValueError('Unsupported mesh format: '+filename)
+  writers[ext](filename, verts, triangles)
+
+"""convert between mesh formats. Empty meshes are not written, so the caller
+can detect the failure because the output file is not present (this mimics the
+behaviour of freecadscript.py)"""
+def convertMesh(inp, outp):
+  verts, triangles = readMesh(inp)
+  if verts.shape[0]==0 or triangles.shape[0]==0:
+    return False
+  writeMesh(outp, verts, triangles)
+  return True
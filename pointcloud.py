@@ -0,0 +1,359 @@
+import numpy as n
+import os.path as op
+import multiprocessing as mp
+
+"""Fast loader for the topography files: text files with one point per line,
+and the three coordinates separated by semicolons. The file is parsed in
+chunks of whole lines (optionally in several processes), and each chunk is
+parsed with a single call to n.fromstring() after checking with vectorized
+operations that every line has exactly three fields, each one with a single
+value. Chunks which fail this check are parsed line by line to report the
+malformed lines.
+
+Binary topography files are not parsed, but memory-mapped (see
+mapPointCloud), so only the pages which are used are read, and they do not
+count as memory of the process. The supported formats are .npy files, binary
+PLY files (the coordinates are the properties x, y and z of the element
+vertex), and raw files of XYZ triplets (little endian) of float32 (raw32) or
+float64 (raw64). The format of a file is detected from its contents (.npy and
+PLY files start with a signature, text files do not have control characters)
+and, for raw files, from its extension (see rawExtensions)"""
+
+#size (in bytes) of the chunks in which the file is split
+chunkbytes     = 1<<24
+#files smaller than this are always parsed in the calling process
+parallelbytes  = 1<<26
+#maximum number of malformed lines reported in error messages
+maxreported    = 10
+
+NEWLINE   = ord('\n')
+SEMICOLON = ord(';')
+#bytes up to this one are whitespace (n.fromstring() skips them), so they
+#separate the values of a line, as semicolons do
+SPACE     = ord(' ')
+
+#formats of point cloud files
+formats        = ['text', 'npy', 'ply', 'raw32', 'raw64']
+#extensions of raw files (they cannot be told apart by their contents)
+rawExtensions  = {'.f32': 'raw32', '.raw32': 'raw32', '.f64': 'raw64', '.raw64': 'raw64'}
+#types of the raw formats
+rawTypes       = {'raw32': '<f4', 'raw64': '<f8'}
+#bytes read at the start of a file to detect its format
+sniffbytes     = 4096
+#signature of .npy files
+NPYMAGIC       = b'\x93NUMPY'
+#types of the scalar properties of PLY files
+plyTypes = {'char':  'i1', 'int8':    'i1', 'uchar':  'u1', 'uint8':   'u1',
+            'short': 'i2', 'int16':   'i2', 'ushort': 'u2', 'uint16':  'u2',
+            'int':   'i4', 'int32':   'i4', 'uint':   'u4', 'uint32':  'u4',
+            'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+#byte order of the binary PLY formats
+plyOrders = {'binary_little_endian': '<', 'binary_big_endian': '>'}
+
+"""error while parsing a point cloud file. badlines is a list of tuples
+(line number, line contents), with line numbers starting at 1. If the file is
+well formed but all lines have a number of fields different from 3, it is
+stored in columns"""
+class PointCloudError(ValueError):
+  def __init__(self, message, badlines=(), columns=None):
+    super(PointCloudError, self).__init__(message)
+    self.badlines = list(badlines)
+    self.columns  = columns
+
+"""split the file in chunks of whole lines. Returns a list of tuples
+(offset, length, first line number, number of lines) and the total number
+of lines"""
+def splitChunks(filename, size=None):
+  if size is None:
+    size = chunkbytes
+  chunks = []
+  offset = 0
+  nlines = 0
+  with open(filename, 'rb') as f:
+    while True:
+      f.seek(offset)
+      data = f.read(size)
+      if len(data)==0:
+        break
+      if len(data)==size:
+        cut = data.rfind(b'\n')+1
+        #lines longer than the chunk size: keep reading until a newline is found
+        while cut==0:
+          more = f.read(size)
+          if len(more)==0:
+            cut = len(data)
+            break
+          cut   = more.find(b'\n')+1
+          cut   = len(data)+cut if cut>0 else 0
+          data += more
+      else:
+        cut = len(data)
+      count = data.count(b'\n', 0, cut)
+      if cut>0 and data[cut-1:cut]!=b'\n':
+        count += 1 #last line without newline
+      chunks.append((offset, cut, nlines+1, count))
+      offset += cut
+      nlines += count
+  return chunks, nlines
+
+"""parse a chunk of text line by line, returning the points and a list
+of the malformed lines as tuples (line number, line)"""
+def parseChunkSlow(data, firstline):
+  rows     = []
+  bad      = []
+  columns  = set()
+  for i, line in enumerate(data.splitlines()):
+    line = line.split(b'#', 1)[0].strip()
+    if len(line)==0:
+      continue
+    fields = line.split(b';')
+    if fields[-1].strip()==b'': #trailing semicolon
+      fields = fields[:-1]
+    columns.add(len(fields))
+    try:
+      if len(fields)!=3:
+        raise ValueError
+      rows.append([float(x) for x in fields])
+    except ValueError:
+      bad.append((firstline+i, line))
+  return n.array(rows, dtype=n.float64).reshape(-1, 3), bad, columns
+
+"""parse a chunk of text, returning the points and a list of the malformed
+lines as tuples (line number, line)"""
+def parseChunk(data, firstline):
+  if len(data)==0:
+    return n.empty((0, 3), dtype=n.float64), [], set()
+  buf   = n.frombuffer(data, dtype=n.uint8)
+  ends  = n.flatnonzero(buf==NEWLINE)
+  if data[-1:]!=b'\n':
+    ends = n.append(ends, len(data))
+  if data.find(b'#')<0 and oneValuePerField(buf, ends.size):
+    values = n.fromstring(data.replace(b';', b' '), dtype=n.float64, sep=' ')
+    if values.size==3*ends.size:
+      return values.reshape(-1, 3), [], set([3])
+  return parseChunkSlow(data, firstline)
+
+"""check that each line of a chunk (given as bytes buf, with nlines lines) has
+three fields, with a single value (a run of bytes without separators) in
+each one: the values, semicolons and newlines must come in the order
+value;value;value\n"""
+def oneValuePerField(buf, nlines):
+  semi   = buf==SEMICOLON
+  sep    = (buf<=SPACE) | semi
+  #first bytes of the values: not separators, after a separator or at the start
+  first  = n.empty(buf.size, dtype=bool)
+  first[0] = not sep[0]
+  n.greater(sep[:-1], sep[1:], out=first[1:])
+  events = n.flatnonzero(first | semi | (buf==NEWLINE))
+  kinds  = n.where(first[events], 0, buf[events])
+  pattern = n.tile(n.array([0, SEMICOLON, 0, SEMICOLON, 0, NEWLINE], dtype=kinds.dtype), nlines)
+  if buf[-1]!=NEWLINE:
+    pattern = pattern[:-1]
+  return kinds.size==pattern.size and (kinds==pattern).all()
+
+"""worker function: read and parse a chunk of a file"""
+def loadChunk(args):
+  filename, offset, length, firstline = args
+  with open(filename, 'rb') as f:
+    f.seek(offset)
+    data = f.read(length)
+  return parseChunk(data, firstline)
+
+"""number of processes to use for a given file size"""
+def defaultProcesses(filesize):
+  if filesize<parallelbytes:
+    return 1
+  try:
+    return mp.cpu_count()
+  except NotImplementedError:
+    return 1
+
+"""error for a point cloud file with malformed lines (bad), given the set of
+numbers of columns found in the file"""
+def malformedError(filename, bad, columns):
+  if len(columns)==1 and 3 not in columns:
+    cols = list(columns)[0]
+    return PointCloudError('Point cloud must have 3 columns, but it has %d' % cols, bad, cols)
+  lines = ''.join('\n  line %d: %s' % (num, line[:80]) for num, line in bad[:maxreported])
+  more  = '' if len(bad)<=maxreported else '\n  (and %d more)' % (len(bad)-maxreported)
+  return PointCloudError('%d malformed lines in point cloud file %s:%s%s' % (len(bad), filename, lines, more), bad)
+
+"""iterate over the chunks of a point cloud file, yielding arrays of shape
+(N,3), so the whole file does not have to be in memory. Raises
+PointCloudError at the end if there are malformed lines"""
+def iterPointCloud(filename):
+  chunks, nlines = splitChunks(filename)
+  bad     = []
+  columns = set()
+  for offset, length, first, count in chunks:
+    values, badlines, cols = loadChunk((filename, offset, length, first))
+    bad.extend(badlines)
+    columns.update(cols)
+    if len(bad)==0:
+      yield values
+  if len(bad)>0:
+    raise malformedError(filename, bad, columns)
+
+"""load a point cloud file as an array of shape (N,3). nprocs is the number
+of processes used to parse the file (None to choose automatically from the
+file size). Raises PointCloudError if there are malformed lines"""
+def loadPointCloud(filename, nprocs=None):
+  if nprocs is None:
+    nprocs = defaultProcesses(op.getsize(filename))
+  chunks, nlines = splitChunks(filename)
+  points  = n.empty((nlines, 3), dtype=n.float64)
+  jobs    = [(filename, offset, length, first) for offset, length, first, count in chunks]
+  pool    = None
+  if nprocs>1 and len(jobs)>1:
+    pool    = mp.Pool(min(nprocs, len(jobs)))
+    results = pool.imap(loadChunk, jobs)
+  else:
+    results = (loadChunk(job) for job in jobs)
+  row      = 0
+  bad      = []
+  columns  = set()
+  try:
+    for values, badlines, cols in results:
+      points[row:row+values.shape[0]] = values
+      row += values.shape[0]
+      bad.extend(badlines)
+      columns.update(cols)
+  finally:
+    if pool is not None:
+      pool.terminate()
+  if len(bad)>0:
+    raise malformedError(filename, bad, columns)
+  if row<nlines: #blank lines and comments
+    points.resize((row, 3), refcheck=False)
+  return points
+
+"""format of a point cloud file (one of formats, see the description of the
+module). Raises PointCloudError for binary files with an unknown format"""
+def detectFormat(filename):
+  with open(filename, 'rb') as f:
+    head = f.read(sniffbytes)
+  if head.startswith(NPYMAGIC):
+    return 'npy'
+  if head.startswith(b'ply'):
+    return 'ply'
+  ext = op.splitext(filename)[1].lower()
+  if ext in rawExtensions:
+    return rawExtensions[ext]
+  #control characters other than whitespace
+  codes = n.frombuffer(head, dtype=n.uint8)
+  if not ((codes<32) & (codes!=9) & (codes!=10) & (codes!=13)).any():
+    return 'text'
+  raise PointCloudError('Could not detect the format of the binary point cloud file %s (raw files must have one of the extensions %s)' %
+                        (filename, ', '.join(sorted(rawExtensions))))
+
+"""points of shape (N,3) from an array of shape (N,K) (or an error if K is not
+3). Integer coordinates are converted to float64"""
+def threeColumns(points, filename):
+  if points.ndim!=2:
+    raise PointCloudError('The array in point cloud file %s must have two dimensions, but it has %d' % (filename, points.ndim))
+  if points.shape[1]!=3:
+    raise PointCloudError('Point cloud must have 3 columns, but it has %d' % points.shape[1], columns=points.shape[1])
+  if points.dtype.kind in 'iu':
+    return points.astype(n.float64)
+  if points.dtype.kind!='f':
+    raise PointCloudError('Unsupported type of the coordinates in point cloud file %s: %s' % (filename, points.dtype))
+  return points
+
+"""memory-map a raw file of XYZ triplets with the type dtype"""
+def mapRaw(filename, dtype):
+  dtype = n.dtype(dtype)
+  size  = op.getsize(filename)
+  if size%(3*dtype.itemsize)!=0:
+    raise PointCloudError('The size of the raw point cloud file %s is not a multiple of the size of a point (%d bytes)' % (filename, 3*dtype.itemsize))
+  if size==0:
+    return n.empty((0, 3), dtype=dtype)
+  return n.memmap(filename, dtype=dtype, mode='r').reshape(-1, 3)
+
+"""parse the header of a binary PLY file. Returns the type of the records of
+the element vertex (a structured dtype), their number and their offset in
+the file"""
+def plyVertexLayout(filename):
+  with open(filename, 'rb') as f:
+    lines = []
+    while True:
+      line = f.readline()
+      if len(line)==0:
+        raise PointCloudError('The header of the PLY point cloud file %s is truncated' % filename)
+      line = line.strip().decode('ascii', 'replace')
+      if line=='end_header':
+        break
+      lines.append(line.split())
+    offset = f.tell()
+  order    = None
+  elements = [] #(name, count, properties as [(name, type)])
+  for words in lines:
+    if len(words)==0 or words[0] in ['ply', 'comment', 'obj_info']:
+      continue
+    if words[0]=='format':
+      if len(words)<2 or words[1] not in plyOrders:
+        raise PointCloudError('Unsupported format of the PLY point cloud file %s: %s (only binary PLY files are supported)' % (filename, ' '.join(words[1:])))
+      order = plyOrders[words[1]]
+    elif words[0]=='element' and len(words)==3:
+      elements.append((words[1], int(words[2]), []))
+    elif words[0]=='property' and len(elements)>0:
+      if words[1]=='list' or len(words)!=3 or words[1] not in plyTypes:
+        #lists have records of variable size: they are only allowed after the vertexes
+        elements[-1][2].append((words[-1], None))
+      else:
+        elements[-1][2].append((words[2], plyTypes[words[1]]))
+    else:
+      raise PointCloudError('Malformed line in the header of the PLY point cloud file %s: %s' % (filename, ' '.join(words)))
+  if order is None:
+    raise PointCloudError('The PLY point cloud file %s does not declare its format' % filename)
+  for name, count, props in elements:
+    if any(t is None for _, t in props):
+      if name=='vertex':
+        raise PointCloudError('The element vertex of the PLY point cloud file %s has properties which are lists or have unknown types' % filename)
+      raise PointCloudError('The element %s of the PLY point cloud file %s (before the element vertex) has records of variable size' % (name, filename))
+    dtype = n.dtype([(pname, order+t) for pname, t in props])
+    if name=='vertex':
+      names = dtype.names or ()
+      if not all(axis in names for axis in 'xyz'):
+        raise PointCloudError('The element vertex of the PLY point cloud file %s does not have the properties x, y and z' % filename)
+      return dtype, count, offset
+    offset += count*dtype.itemsize
+  raise PointCloudError('The PLY point cloud file %s does not have an element vertex' % filename)
+
+"""memory-map the coordinates of the vertexes of a binary PLY file. If x, y
+and z are consecutive properties with the same type, they are mapped as an
+array of shape (N,3) (with the stride of the records), otherwise they are
+copied"""
+def mapPLY(filename):
+  dtype, count, offset = plyVertexLayout(filename)
+  if offset+count*dtype.itemsize>op.getsize(filename):
+    raise PointCloudError('The PLY point cloud file %s is truncated' % filename)
+  fields = [dtype.fields[axis] for axis in 'xyz']
+  ftype  = fields[0][0]
+  if count==0:
+    return n.empty((0, 3), dtype=ftype)
+  records = n.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(count,))
+  if all(t==ftype and off==fields[0][1]+k*ftype.itemsize for k, (t, off) in enumerate(fields)):
+    return threeColumns(n.ndarray((count, 3), dtype=ftype, buffer=records, offset=fields[0][1],
+                                  strides=(dtype.itemsize, ftype.itemsize)), filename)
+  return n.column_stack([records[axis].astype(n.float64) for axis in 'xyz'])
+
+"""memory-map a binary point cloud file with the format fmt (see formats) as
+an array of shape (N,3)"""
+def mapPointCloud(filename, fmt):
+  if fmt=='npy':
+    return threeColumns(n.load(filename, mmap_mode='r'), filename)
+  if fmt=='ply':
+    return mapPLY(filename)
+  if fmt in rawTypes:
+    return mapRaw(filename, rawTypes[fmt])
+  raise PointCloudError('Unknown point cloud format: %s' % fmt)
+
+"""load a point cloud file with the format fmt (see formats, None to detect
+it) as an array of shape (N,3): text files are parsed (see loadPointCloud),
+and binary files are memory-mapped (see mapPointCloud)"""
+def openPointCloud(filename, fmt=None, nprocs=None):
+  if fmt is None:
+    fmt = detectFormat(filename)
+  if fmt=='text':
+    return loadPointCloud(filename, nprocs)
+  return mapPointCloud(filename, fmt)
@@ -0,0 +1,252 @@
+import os
+import os.path as op
+import sys
+import time
+import threading
+import subprocess as sub
+try:
+  import resource
+except ImportError:
+  #not available in Windows: only the times are recorded
+  resource = None
+
+"""Instrumentation of the stages of a run: each stage records its wall time,
+its CPU time (user+system), its peak RSS and the resource usage of the
+external programs run in it (CPU time and peak RSS of each one, as reported
+by wait4). Stages are opened with the context manager stage(), which does
+nothing if there is no active profiler, so the instrumented code does not
+need to know if it is being profiled. Stages can be nested.
+
+The profiler also controls the run: it reports the stages as they start (to
+show the progress of the run), and it can cancel it. A cancelled run stops
+at the beginning of the next stage, and the external program being run (if
+any) is killed. In both cases, the exception Cancelled is raised.
+
+The peak RSS of a stage is measured by resetting the high-water mark of the
+process at the beginning of the stage (writing to /proc/self/clear_refs, in
+Linux). If this is not possible, the high-water mark since the start of the
+process is reported instead, so a stage only shows its own peak if it is
+higher than the ones of the previous stages (see the field 'rssmode' of the
+trace). The high-water mark belongs to the whole process, so per-stage peaks
+are only valid for a single profiled run per process: if several runs are
+profiled at once (in different threads, as in the service and the GUI), none
+of them resets it anymore, and the peaks they report are high-water marks of
+the whole process (the mode of all of them is 'process')"""
+
+#the profiler of the current run in each thread (see active())
+state = threading.local()
+
+#profilers active in any thread of the process, and lock to update them
+running     = set()
+runninglock = threading.Lock()
+
+#interval to check if a run has been cancelled while an external program is running
+pollinterval = 0.1
+
+#multiplier of ru_maxrss to get bytes
+rssunit = 1 if sys.platform=='darwin' else 1024
+
+"""True if the high-water mark of the RSS of the process can be reset"""
+def canResetPeakRSS():
+  return os.access('/proc/self/clear_refs', os.W_OK)
+
+"""reset the high-water mark of the RSS of the process. Returns False if it is
+not possible"""
+def resetPeakRSS():
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+    return True
+  except (IOError, OSError):
+    return False
+
+"""peak RSS of the process (in bytes) since the last reset (or since the start
+of the process), None if it is not available"""
+def peakRSS():
+  try:
+    with open('/proc/self/status', 'r') as f:
+      for line in f:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1])*1024
+  except (IOError, OSError, ValueError):
+    pass
+  if resource is not None:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*rssunit
+  return None
+
+"""CPU time (user+system) of the process"""
+def cpuTime():
+  t = os.times()
+  return t[0]+t[1]
+
+"""the run has been cancelled"""
+class Cancelled(Exception):
+  pass
+
+"""profiler of the current run in this thread (None if there is none)"""
+def currentProfiler():
+  return getattr(state, 'profiler', None)
+
+"""stage being recorded"""
+class Stage(object):
+  def __init__(self, name, path, start):
+    self.name      = name
+    self.path      = path
+    self.start     = start
+    self.wall0     = time.time()
+    self.cpu0      = cpuTime()
+    self.peak      = None
+    self.children  = []
+
+  """record the peak RSS measured so far"""
+  def notePeak(self, peak):
+    if peak is not None:
+      self.peak = peak if self.peak is None else max(self.peak, peak)
+
+"""collects the records of the stages of a run. callback (if not None) is
+called with each record as soon as its stage is finished, and progress (if
+not None) with the name of each stage when it starts. cancel (if not None)
+is an object such as threading.Event: the run is cancelled when it is set"""
+class Profiler(object):
+  def __init__(self, callback=None, progress=None, cancel=None):
+    self.callback = callback
+    self.progress = progress
+    self.cancel   = cancel
+    self.records  = []
+    self.stack    = []
+    self.t0       = time.time()
+    self.rssmode  = 'stage' if canResetPeakRSS() else 'process'
+
+  """raise Cancelled if the run has been cancelled"""
+  def checkCancel(self):
+    if self.cancel is not None and self.cancel.is_set():
+      raise Cancelled('the run has been cancelled')
+
+  def begin(self, name):
+    self.checkCancel()
+    if len(self.stack)>0:
+      #the peak of the enclosing stage before it is reset for this one
+      self.stack[-1].notePeak(peakRSS())
+    with runninglock:
+      if self.rssmode=='stage':
+        resetPeakRSS()
+    path = '/'.join([s.name for s in self.stack]+[name])
+    self.stack.append(Stage(name, path, time.time()-self.t0))
+    if self.progress is not None:
+      self.progress(path)
+
+  def end(self):
+    st     = self.stack.pop()
+    st.notePeak(peakRSS())
+    if len(self.stack)>0:
+      self.stack[-1].notePeak(st.peak)
+    record = {'stage':         st.path,
+              'start':         st.start,
+              'wall':          time.time()-st.wall0,
+              'cpu':           cpuTime()-st.cpu0,
+              'peakrss':       st.peak,
+              'processes':     len(st.children),
+              'childcpu':      sum(c['cpu'] or 0 for c in st.children),
+              'childpeakrss':  max([c['peakrss'] for c in st.children] or [None]),
+              'children':      st.children}
+    self.records.append(record)
+    if self.callback is not None:
+      self.callback(record)
+
+  """record the resource usage of an external program run in the current stage"""
+  def child(self, command, wall, usage):
+    if len(self.stack)==0:
+      return
+    info = {'command': ' '.join(command), 'wall': wall, 'cpu': None, 'peakrss': None}
+    if usage is not None:
+      info['cpu']     = usage.ru_utime+usage.ru_stime
+      info['peakrss'] = usage.ru_maxrss*rssunit
+    #the CPU time of the programs is added to all the enclosing stages
+    for st in self.stack:
+      st.children.append(info)
+
+  """the trace of the run: the records of the stages (in the order in which
+  they finished, so nested stages come before the enclosing ones)"""
+  def trace(self):
+    return {'rssmode': self.rssmode,
+            'wall':    time.time()-self.t0,
+            'stages':  list(self.records)}
+
+"""context manager to make a profiler active during a run"""
+class active(object):
+  def __init__(self, profiler):
+    self.profiler = profiler
+
+  def __enter__(self):
+    self.previous  = currentProfiler()
+    state.profiler = self.profiler
+    with runninglock:
+      running.add(self.profiler)
+      if len(running)>1:
+        #concurrent runs would reset the high-water mark of each other
+        for profiler in running:
+          profiler.rssmode = 'process'
+    return self.profiler
+
+  def __exit__(self, *exc):
+    state.profiler = self.previous
+    with runninglock:
+      running.discard(self.profiler)
+    return False
+
+"""context manager to record a stage in the active profiler (if any)"""
+class stage(object):
+  def __init__(self, name):
+    self.name     = name
+
+  def __enter__(self):
+    self.profiler = currentProfiler()
+    if self.profiler is not None:
+      self.profiler.begin(self.name)
+
+  def __exit__(self, *exc):
+    if self.profiler is not None:
+      self.profiler.end()
+    return False
+
+"""run a command (as subprocess.call), recording its resource usage in the
+active profiler (if any), and killing it if the run is cancelled. The command
+is polled (every pollinterval seconds) only if the run can be cancelled.
+Returns the exit code"""
+def call(command):
+  profiler = currentProfiler()
+  if profiler is None:
+    return sub.call(command)
+  blocking = profiler.cancel is None
+  t0   = time.time()
+  proc = sub.Popen(command)
+  usage = None
+  while True:
+    if hasattr(os, 'wait4'):
+      pid, status, usage = os.wait4(proc.pid, 0 if blocking else os.WNOHANG)
+      if pid!=0:
+        code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        proc.returncode = code
+        break
+    else:
+      code = proc.wait() if blocking else proc.poll()
+      if code is not None:
+        break
+    if profiler.cancel is not None and profiler.cancel.is_set():
+      proc.kill()
+      proc.wait()
+      raise Cancelled('the run has been cancelled while running %s' % op.basename(command[0]))
+    time.sleep(pollinterval)
+  profiler.child(command, time.time()-t0, usage)
+  return code
+
+"""decorator to record each call of a function as a stage"""
+def profiled(name):
+  def decorator(fun):
+    def wrapper(*args, **kwargs):
+      with stage(name):
+        return fun(*args, **kwargs)
+    wrapper.__name__ = fun.__name__
+    wrapper.__doc__  = fun.__doc__
+    return wrapper
+  return decorator
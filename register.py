@@ -0,0 +1,103 @@
+import numpy as n
+from scipy.spatial import cKDTree
+
+"""Registration of a point cloud to a mesh with the point-to-plane variant of
+the ICP (iterative closest point) algorithm. The surface of the mesh is
+sampled (with probability proportional to the area of the triangles) and the
+samples are indexed in a KD-tree. The point cloud is randomly subsampled,
+with increasing numbers of points in each level (coarse to fine), so the
+cost does not depend on the size of the point cloud. In each iteration, the
+samples closest to the points are found, the pairs farther than a multiple of
+the median distance are rejected as outliers, and the linearized
+point-to-plane problem is solved by least squares. Each level stops when the
+update of the transformation becomes negligible"""
+
+#samples of the surface of the mesh
+surfacesamples = 200000
+#points of the point cloud used in each level
+levels         = [2000, 10000, 50000]
+#maximum number of iterations in each level
+maxiterations  = 30
+#convergence threshold for the updates (in radians, and relative to the size of the mesh)
+tolerance      = 1e-6
+#pairs farther than this multiple of the median distance are rejected
+rejection      = 3.0
+
+"""random samples of the surface of a mesh, with their normals"""
+def sampleSurface(verts, triangles, nsamples, rnd):
+  a, b, c = verts[triangles[:,0]], verts[triangles[:,1]], verts[triangles[:,2]]
+  normals = n.cross(b-a, c-a)
+  areas   = n.sqrt((normals*normals).sum(axis=1))
+  keep    = areas>0
+  a, b, c, normals, areas = a[keep], b[keep], c[keep], normals[keep], areas[keep]
+  normals = normals/areas[:,n.newaxis]
+  cum     = n.cumsum(areas)
+  tris    = n.minimum(n.searchsorted(cum, rnd.uniform(0, cum[-1], nsamples)), areas.size-1)
+  #uniform barycentric coordinates
+  r1      = n.sqrt(rnd.uniform(0, 1, nsamples))[:,n.newaxis]
+  r2      = rnd.uniform(0, 1, nsamples)[:,n.newaxis]
+  samples = (1-r1)*a[tris]+r1*(1-r2)*b[tris]+r1*r2*c[tris]
+  return samples, normals[tris]
+
+"""rotation matrix for the rotation vector w (axis times angle)"""
+def rotationMatrix(w):
+  angle = n.sqrt((w*w).sum())
+  if angle==0:
+    return n.eye(3)
+  k     = w/angle
+  K     = n.array([[0, -k[2], k[1]], [k[2], 0, -k[0]], [-k[1], k[0], 0]])
+  return n.eye(3)+n.sin(angle)*K+(1-n.cos(angle))*K.dot(K)
+
+"""apply the 4x4 transformation T to the points"""
+def transformPoints(T, points):
+  return n.dot(points, T[:3,:3].T)+T[:3,3]
+
+"""solve the linearized point-to-plane problem for the pairs (p, q) with
+normals nq: the rotation vector w and the translation t minimizing the sum of
+((R(w)p+t-q).nq)^2, for small w. Returns the 4x4 transformation"""
+def pointToPlaneStep(p, q, nq):
+  A     = n.column_stack((n.cross(p, nq), nq))
+  b     = -((p-q)*nq).sum(axis=1)
+  #lstsq returns the minimum norm solution if some degrees of freedom are not
+  #constrained (for example, translations along a plane)
+  x     = n.linalg.lstsq(A, b, rcond=1e-10)[0]
+  T     = n.eye(4)
+  T[:3,:3] = rotationMatrix(x[:3])
+  T[:3,3]  = x[3:]
+  return T, x
+
+"""register the points to the mesh (verts, triangles). Returns the 4x4
+transformation (to apply to the points), the RMS point-to-plane residual of
+the inlier pairs in the last iteration, the fraction of inliers and the
+total number of iterations"""
+def icp(points, verts, triangles, initial=None, seed=0):
+  rnd     = n.random.RandomState(seed)
+  samples, normals = sampleSurface(verts, triangles, surfacesamples, rnd)
+  tree    = cKDTree(samples)
+  size    = float(n.sqrt(((verts.max(axis=0)-verts.min(axis=0))**2).sum()))
+  T       = n.eye(4) if initial is None else n.array(initial, dtype=n.float64)
+  total   = 0
+  rms     = n.nan
+  inliers = 0.0
+  for npoints in levels:
+    #sampling with replacement is O(npoints), whatever the size of the point cloud
+    subset  = n.asarray(points[n.sort(rnd.randint(0, points.shape[0], min(npoints, points.shape[0])))], dtype=n.float64)
+    subset  = subset[n.isfinite(subset).all(axis=1)]
+    if subset.shape[0]<6:
+      break
+    for iteration in xrange(maxiterations):
+      total  += 1
+      p       = transformPoints(T, subset)
+      dist, nearest = tree.query(p)
+      keep    = dist<=rejection*max(n.median(dist), 1e-12*size)
+      p, q, nq = p[keep], samples[nearest[keep]], normals[nearest[keep]]
+      if p.shape[0]<6:
+        break
+      step, x = pointToPlaneStep(p, q, nq)
+      T       = n.dot(step, T)
+      residual = ((transformPoints(step, p)-q)*nq).sum(axis=1)
+      rms     = float(n.sqrt((residual*residual).mean()))
+      inliers = float(keep.mean())
+      if n.abs(x[:3]).max()<tolerance and n.abs(x[3:]).max()<tolerance*size:
+        break
+  return T, rms, inliers, total
@@ -0,0 +1,320 @@
+import os
+import os.path as op
+import json
+import time
+import threading
+import traceback
+import collections
+import multiprocessing as mp
+import BaseHTTPServer
+import SocketServer
+import meshdiff
+import deviation
+import cache
+from meshdiff import RetVal
+
+"""Service mode: a long-running process which runs the jobs sent to it through
+an HTTP interface on localhost, so the jobs do not pay for starting Python,
+importing numpy and scipy and loading the STL input mesh. The recently used
+STL input meshes are kept in memory, with the data derived from them (the
+cleaned meshes and the index of the triangles for the deviations), which is
+built the first time a job needs it, and passed to the jobs already loaded.
+Meshes are kept by path, size and modification time, so a changed file is
+loaded again.
+
+Jobs are sent as POST requests to /difference or /deviation, with a JSON
+object {"args": [...], "opts": {...}}: args are the string arguments of
+meshdiff.safeDoDifference() (from pcin to zsub, and optionally the
+decimation; useXY and useZ are booleans), and opts the optional settings,
+which override the ones given when the service was started (the settings
+which are not JSON values cannot be given, see localOptions). The response
+is a JSON object with the fields of the returned RetVal (ok, val, argnum,
+errcode), the seconds waiting for a worker ('queued') and running the job
+('seconds'), the messages of the service about the STL input mesh
+('report') and the profile of the run if the option 'profile' is set.
+GET /status returns the state of the service, and POST /shutdown stops it.
+
+The jobs run in threads of the service, at most 'workers' at once (the mesh
+engine runs in other processes, and most numpy operations do not hold the
+interpreter lock). Jobs beyond 'maxqueue' waiting ones are rejected (with
+error code 117), so clients can retry later instead of piling up requests.
+The service only listens on localhost: there is no authentication, and the
+jobs can read and write any file the service can"""
+
+#settings of the service
+defaultSettings = {
+  'host':       '127.0.0.1',
+  'port':       8765,
+  'workers':    None, #jobs running at once (None for one per CPU)
+  'maxqueue':   64,   #jobs waiting for a worker (more are rejected)
+  'references': 4,    #STL input meshes kept in memory
+  'verbose':    False, #log the requests to stderr
+  }
+
+#optional settings which cannot be sent by the clients: they are not JSON
+#values, or they are set by the service
+localOptions = ['points', 'upperface', 'reference', 'refcleaned', 'refindex', 'monitor', 'progress', 'cancel', 'workdir']
+
+#functions running the jobs, by path
+jobFunctions = {'difference': meshdiff.safeDoDifference,
+                'deviation':  meshdiff.safeDoDeviation}
+
+"""STL input mesh kept in memory, and the data derived from it (built the
+first time it is needed). The lock serializes the jobs building its data"""
+class Reference(object):
+  def __init__(self, key):
+    self.key     = key
+    self.mesh    = None
+    self.cleaned = {} #cleaned meshes, by tolerance
+    self.index   = None
+    self.lock    = threading.Lock()
+    self.jobs    = 0
+
+  """load the mesh (if it is not loaded yet). Messages are appended to the
+  list report"""
+  def load(self, fileSTL, opts, report):
+    if self.mesh is not None:
+      report.append('STL input mesh kept in memory by the service')
+      return RetVal(True, self.mesh)
+    try:
+      workdir = meshdiff.makeScratchDir(opts['scratchdir'])
+    except (IOError, OSError) as e:
+      return RetVal(False, 'Could not create a directory for the intermediate files: '+str(e), -1, 97)
+    try:
+      ret = meshdiff.loadReferenceMesh(fileSTL, op.join(workdir, meshdiff.specialFiles['stl'][0]), opts['refcache'], report)
+    finally:
+      meshdiff.removeEmptyDir(workdir)
+    if ret.ok:
+      self.mesh = ret.val
+      report.append('STL input mesh loaded by the service')
+    return ret
+
+  """the mesh cleaned with the tolerance in opts (see meshdiff.cleanInputMesh)"""
+  def cleanedMesh(self, opts, report):
+    tolerance = opts['cleantolerance']
+    if tolerance not in self.cleaned:
+      ret = meshdiff.cleanInputMesh(self.mesh, 'STL input mesh', 1, opts, report, opts['refcache'])
+      if not ret.ok:
+        return ret
+      self.cleaned[tolerance] = ret.val
+    return RetVal(True, self.cleaned[tolerance])
+
+  """the index of the triangles of the mesh for the deviations"""
+  def triangleIndex(self, opts, report):
+    if self.index is None:
+      if opts['refcache']:
+        arrays, msg = cache.derivedCached('deviation-index', self.mesh, lambda v, t: deviation.TriangleIndex(v, t).state())
+        self.index  = deviation.TriangleIndex.fromState(arrays)
+        report.append(msg)
+      else:
+        self.index  = deviation.TriangleIndex(*self.mesh)
+    return self.index
+
+"""STL input meshes kept in memory (at most capacity, the least recently used
+ones are dropped first)"""
+class ReferenceCache(object):
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.entries  = collections.OrderedDict()
+    self.lock     = threading.Lock()
+    self.hits     = 0
+    self.misses   = 0
+
+  """the entry of the STL input file (a new one if it is not kept)"""
+  def entry(self, fileSTL):
+    st  = os.stat(fileSTL)
+    key = (op.abspath(fileSTL), st.st_size, st.st_mtime)
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is None:
+        entry = Reference(key)
+        self.misses += 1
+      else:
+        self.hits   += 1
+      #the most recently used entries are at the end
+      self.entries[key] = entry
+      while len(self.entries)>self.capacity:
+        self.entries.popitem(last=False)
+    return entry
+
+  """drop an entry which could not be loaded"""
+  def forget(self, entry):
+    with self.lock:
+      if self.entries.get(entry.key) is entry:
+        del self.entries[entry.key]
+
+  def status(self):
+    with self.lock:
+      return {'hits':    self.hits,
+              'misses':  self.misses,
+              'meshes':  [{'stlin':     key[0],
+                           'triangles': None if e.mesh is None else int(e.mesh[1].shape[0]),
+                           'cleaned':   len(e.cleaned),
+                           'index':     e.index is not None,
+                           'jobs':      e.jobs} for key, e in self.entries.iteritems()]}
+
+"""the service: runs the jobs with at most settings['workers'] at once"""
+class Service(object):
+  def __init__(self, settings=None, opts=None):
+    self.settings = dict(defaultSettings)
+    self.settings.update(settings or {})
+    workers = self.settings['workers']
+    if workers is None:
+      try:
+        workers = mp.cpu_count()
+      except NotImplementedError:
+        workers = 1
+    self.workers    = max(1, workers)
+    self.opts       = dict(opts or {})
+    self.references = ReferenceCache(self.settings['references'])
+    self.slots      = threading.Semaphore(self.workers)
+    self.lock       = threading.Lock()
+    self.waiting    = 0
+    self.running    = 0
+    self.done       = 0
+    self.failed     = 0
+    self.t0         = time.time()
+
+  """run a job sent by a client (see the description of the module). Returns
+  the response as a dictionary and the HTTP status code"""
+  def submit(self, kind, request):
+    t0  = time.time()
+    ret = self.parseRequest(kind, request)
+    if not ret.ok:
+      return reply(ret, t0, t0), 400
+    function, strargs, opts = ret.val
+    with self.lock:
+      if self.waiting>=self.settings['maxqueue']:
+        return reply(RetVal(False, 'The service is busy: %d jobs are waiting' % self.waiting, -1, 117), t0, t0), 503
+      self.waiting += 1
+    with self.slots:
+      t1 = time.time()
+      with self.lock:
+        self.waiting -= 1
+        self.running += 1
+      report = []
+      try:
+        ret = self.runJob(kind, function, strargs, opts, report)
+      except:
+        ret = RetVal(False, 'Unexpected exception: '+traceback.format_exc(), -1, 1)
+      with self.lock:
+        self.running -= 1
+        self.done    += 1
+        self.failed  += not ret.ok
+    return reply(ret, t0, t1, report), 200
+
+  """check the request of a job. Returns the function to run it, the string
+  arguments and the optional settings"""
+  def parseRequest(self, kind, request):
+    if kind not in jobFunctions:
+      return RetVal(False, 'Unknown kind of job: '+str(kind), -1, 116)
+    if not isinstance(request, dict) or not isinstance(request.get('args'), list) or not isinstance(request.get('opts', {}), dict):
+      return RetVal(False, 'The request must be a JSON object with a list "args" and (optionally) an object "opts"', -1, 116)
+    strargs = [x.encode('utf-8') if isinstance(x, unicode) else x for x in request['args']]
+    if len(strargs) not in [12, 14]:
+      return RetVal(False, 'The job must have 12 or 14 arguments (from pcin to zsub, and optionally the decimation), but it has %d' % len(strargs), -1, 116)
+    opts = dict((str(k), v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in request.get('opts', {}).iteritems())
+    local = sorted(k for k in opts if k in localOptions)
+    if len(local)>0:
+      return RetVal(False, 'These optional settings cannot be sent to the service: '+', '.join(local), -1, 116)
+    function = jobFunctions[kind]
+    if kind=='difference' and dict(self.opts, **opts).get('tilesize') is not None:
+      import tiled
+      function = tiled.safeDoTiledDifference
+    return RetVal(True, (function, strargs, dict(self.opts, **opts)))
+
+  """run a job, with the STL input mesh (and its derived data) kept in memory"""
+  def runJob(self, kind, function, strargs, opts, report):
+    fileSTL = strargs[1]
+    full    = meshdiff.completeOptions(opts)
+    if op.isfile(fileSTL) and meshdiff.checkOptions(full).ok:
+      #otherwise, the job fails with the same error without the service
+      entry = self.references.entry(fileSTL)
+      with entry.lock:
+        entry.jobs += 1
+        ret = entry.load(fileSTL, full, report)
+        if not ret.ok:
+          self.references.forget(entry)
+          return ret
+        opts = dict(opts, reference=entry.mesh)
+        if kind=='deviation':
+          opts['refindex'] = entry.triangleIndex(full, report)
+        elif full['clean']:
+          ret = entry.cleanedMesh(full, report)
+          if not ret.ok:
+            return ret
+          opts.update(reference=ret.val, refcleaned=True)
+    return function(strargs, opts)
+
+  def status(self):
+    with self.lock:
+      return {'workers':    self.workers,
+              'running':    self.running,
+              'waiting':    self.waiting,
+              'done':       self.done,
+              'failed':     self.failed,
+              'uptime':     time.time()-self.t0,
+              'references': self.references.status()}
+
+"""response to a job: the fields of its result ret, the timings (t0: when the
+request was received, t1: when the job started) and the messages of the
+service"""
+def reply(ret, t0, t1, report=()):
+  return {'ok':      bool(ret.ok),
+          'val':     ret.val,
+          'argnum':  ret.argnum,
+          'errcode': ret.errcode,
+          'profile': ret.profile,
+          'queued':  t1-t0,
+          'seconds': time.time()-t1,
+          'report':  list(report)}
+
+"""handler of the HTTP requests (see the description of the module)"""
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path=='/status':
+      self.respond(200, self.server.service.status())
+    else:
+      self.respond(404, reply(RetVal(False, 'Unknown path: '+self.path, -1, 116), time.time(), time.time()))
+
+  def do_POST(self):
+    kind = self.path.strip('/')
+    try:
+      length  = int(self.headers.getheader('content-length', 0))
+      request = json.loads(self.rfile.read(length)) if length>0 else {}
+    except ValueError:
+      now = time.time()
+      return self.respond(400, reply(RetVal(False, 'The request is not valid JSON', -1, 116), now, now))
+    if kind=='shutdown':
+      self.respond(200, {'ok': True})
+      #shutdown() waits for serve_forever() to finish, so it cannot be called from its thread
+      threading.Thread(target=self.server.shutdown).start()
+      return
+    response, code = self.server.service.submit(kind, request)
+    self.respond(code, response)
+
+  def respond(self, code, obj):
+    body = json.dumps(obj)
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, fmt, *args):
+    if self.server.service.settings['verbose']:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+"""HTTP server running each request in its own thread"""
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads      = True
+  allow_reuse_address = True
+
+  def __init__(self, service):
+    self.service = service
+    BaseHTTPServer.HTTPServer.__init__(self, (service.settings['host'], service.settings['port']), Handler)
+
+"""create the server of the service (settings: see defaultSettings; opts: the
+default optional settings of the jobs). Call serve_forever() to run it"""
+def makeServer(settings=None, opts=None):
+  return Server(Service(settings, opts))
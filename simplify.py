@@ -0,0 +1,197 @@
+import numpy as n
+
+"""Simplification of the upper face of the mesh of a topography, with quadric
+error edge collapses (Garland and Heckbert). Topographies are usually much
+denser than the tolerance we care about, and the cost of the mesh engine
+grows with the number of triangles.
+
+Each vertex has a quadric: the sum of the squared distances to the planes of
+the triangles around it. Collapsing an edge (u, v) removes the vertex u (its
+triangles are joined to v, which is not moved, so the remaining vertexes are
+points of the topography), and the quadric of u is added to the one of v.
+The error of the collapse is the quadric of u plus v evaluated at v: the
+square root of this error bounds the distance from v to each of the planes
+of the original triangles around the vertexes merged in it.
+
+The collapses are done in rounds, with vectorized operations: in each round,
+the best collapse of each vertex is found, and the collapses whose removed
+vertexes are not neighbours of the removed vertex of a better collapse (and
+that are the best collapse into their vertex v) are done at once: as they do
+not share any triangle, they do not interfere.
+The upper face is a height field, so a collapse is valid if all the
+triangles it changes keep their orientation in the XY plane (otherwise, the
+face would fold over itself). The vertexes in the border of the face are
+never removed, so the ribbon and the base of the mesh built from it are not
+changed, and the mesh stays closed"""
+
+#maximum number of rounds of collapses
+maxrounds      = 200
+#minimum ratio of twice the area (in the XY plane) of the triangles changed by
+#a collapse to their longest edge squared, to avoid creating slivers
+minaspect      = 1e-4
+#candidate collapses of each vertex checked in each round (in order of error),
+#until a valid one is found
+maxattempts    = 3
+#collapses whose validity is checked at once (to bound the memory used)
+chunksize      = 1000000
+
+"""quadrics (as the 10 coefficients of the symmetric 4x4 matrix) of the planes
+of the triangles"""
+def planeQuadrics(points, triangles):
+  a, b, c = points[triangles[:,0]], points[triangles[:,1]], points[triangles[:,2]]
+  normals = n.cross(b-a, c-a)
+  norms   = n.sqrt((normals*normals).sum(axis=1))
+  norms[norms==0] = 1
+  normals = normals/norms[:,n.newaxis]
+  p       = n.column_stack((normals, -(normals*a).sum(axis=1)))
+  idx     = [(i, j) for i in xrange(4) for j in xrange(i, 4)]
+  return n.column_stack([p[:,i]*p[:,j] for i, j in idx])
+
+"""evaluate the quadrics q at the points"""
+def quadricError(q, points):
+  x, y, z = points[:,0], points[:,1], points[:,2]
+  err = (q[:,0]*x*x + 2*q[:,1]*x*y + 2*q[:,2]*x*z + 2*q[:,3]*x +
+         q[:,4]*y*y + 2*q[:,5]*y*z + 2*q[:,6]*y +
+         q[:,7]*z*z + 2*q[:,8]*z +
+         q[:,9])
+  return n.maximum(err, 0)
+
+"""twice the signed area of the triangles (given as coordinates (M,3,3)) in
+the XY plane"""
+def orientationXY(corners):
+  a, b, c = corners[:,0], corners[:,1], corners[:,2]
+  return (b[:,0]-a[:,0])*(c[:,1]-a[:,1])-(b[:,1]-a[:,1])*(c[:,0]-a[:,0])
+
+"""incidences of the vertexes in the triangles, grouped by vertex: the
+triangle and corner of each incidence, and the start and number of the
+incidences of each vertex"""
+def incidences(triangles, nverts):
+  flat    = triangles.ravel()
+  order   = n.argsort(flat)
+  counts  = n.bincount(flat, minlength=nverts)
+  starts  = n.concatenate(([0], n.cumsum(counts)[:-1]))
+  return order//3, order%3, starts, counts
+
+"""minimum of the values of the triangles around each vertex (fill for
+vertexes without triangles)"""
+def vertexMinimum(values, inc, nverts, fill):
+  tri, corner, starts, counts = inc
+  result  = n.empty(nverts, dtype=values.dtype)
+  result.fill(fill)
+  used    = counts>0
+  if used.any():
+    result[used] = n.minimum.reduceat(values[tri], starts[used])
+  return result
+
+"""mask of the valid collapses (u[i] into v[i]): the triangles around u[i] which
+do not contain v[i] must keep their orientation (sign) in the XY plane, and
+not become slivers (see minaspect)"""
+def validCollapses(points, triangles, sign, inc, u, v):
+  tri, corner, starts, counts = inc
+  valid   = n.ones(u.size, dtype=bool)
+  for c0 in xrange(0, u.size, chunksize):
+    cu, cv  = u[c0:c0+chunksize], v[c0:c0+chunksize]
+    deg     = counts[cu]
+    rep     = n.repeat(n.arange(cu.size), deg)
+    offsets = n.cumsum(deg)-deg
+    pos     = starts[cu][rep]+n.arange(rep.size)-offsets[rep]
+    t, c    = tri[pos], corner[pos]
+    tv      = triangles[t]
+    target  = cv[rep]
+    keep    = ~(tv==target[:,n.newaxis]).any(axis=1)
+    tv      = tv[keep]
+    tv[n.arange(tv.shape[0]), c[keep]] = target[keep]
+    corners = points[tv]
+    longest = n.maximum(n.maximum(((corners[:,1,0:2]-corners[:,0,0:2])**2).sum(axis=1),
+                                  ((corners[:,2,0:2]-corners[:,1,0:2])**2).sum(axis=1)),
+                                  ((corners[:,0,0:2]-corners[:,2,0:2])**2).sum(axis=1))
+    bad     = orientationXY(corners)*sign[t[keep]]<=minaspect*longest
+    valid[c0:c0+chunksize] = n.bincount(rep[keep], weights=bad, minlength=cu.size)==0
+  return valid
+
+"""simplify the surface (points, triangles) with quadric error edge collapses
+(see the description of the module), without removing the locked vertexes
+(a mask), until no more collapses have an error not higher than maxerror (if
+it is not None) or the number of triangles is not higher than maxfaces (if it
+is not None). Returns the new points and triangles, the new index of each
+vertex (only meaningful for the remaining ones, such as the locked vertexes),
+and the maximum error of the remaining vertexes (as a
+distance, see the description of the module)"""
+def simplify(points, triangles, locked, maxerror=None, maxfaces=None):
+  nverts    = points.shape[0]
+  #centered coordinates, to avoid cancellation errors in the quadrics
+  center    = points.mean(axis=0)
+  pts       = n.asarray(points, dtype=n.float64)-center
+  tris      = n.asarray(triangles, dtype=n.int64)
+  planes    = planeQuadrics(pts, tris)
+  quadrics  = n.column_stack([n.bincount(tris.ravel(), weights=n.repeat(planes[:,k], 3), minlength=nverts) for k in xrange(10)])
+  planes    = None
+  sign      = n.sign(orientationXY(pts[tris]))
+  locked    = locked.copy()
+  #the vertexes of degenerate triangles (in the XY plane) are not touched
+  locked[tris[sign==0].ravel()] = True
+  limit     = n.inf if maxerror is None else maxerror*maxerror
+  for r in xrange(maxrounds):
+    if maxfaces is not None and tris.shape[0]<=maxfaces:
+      break
+    #candidate collapses: directed edges whose first vertex is not locked
+    edges   = n.concatenate((tris[:,[0,1]], tris[:,[1,2]], tris[:,[2,0]]))
+    edges   = n.concatenate((edges, edges[:,::-1]))
+    edges   = edges[~locked[edges[:,0]]]
+    keys    = n.unique(edges[:,0]*nverts+edges[:,1])
+    u, v    = keys//nverts, keys%nverts
+    cost    = quadricError(quadrics[u]+quadrics[v], pts[v])
+    sel     = cost<=limit
+    u, v, cost = u[sel], v[sel], cost[sel]
+    if u.size==0:
+      break
+    #best valid collapse of each vertex (checking only the best candidates)
+    order   = n.argsort(cost, kind='mergesort')
+    u, v, cost = u[order], v[order], cost[order]
+    inc     = incidences(tris, nverts)
+    pending = n.ones(u.size, dtype=bool)
+    chosen  = []
+    for attempt in xrange(maxattempts):
+      idx   = n.flatnonzero(pending)
+      if idx.size==0:
+        break
+      _, first = n.unique(u[idx], return_index=True)
+      first = idx[first]
+      good  = first[validCollapses(pts, tris, sign, inc, u[first], v[first])]
+      chosen.append(good)
+      pending[first] = False
+      found = n.zeros(nverts, dtype=bool)
+      found[u[good]] = True
+      pending &= ~found[u]
+    best    = n.sort(n.concatenate(chosen))
+    u, v, cost = u[best], v[best], cost[best]
+    if u.size==0:
+      break
+    #rank of the collapses (by their errors)
+    rank    = n.empty(nverts, dtype=n.int64)
+    rank.fill(u.size)
+    rank[u] = n.arange(u.size)
+    #a collapse is done if no neighbour of its vertex has a better one, and
+    #only the best one into each vertex (so its error is the one computed)
+    around  = vertexMinimum(rank[tris].min(axis=1), inc, nverts, u.size)
+    done    = n.flatnonzero(around[u]==n.arange(u.size))
+    _, best = n.unique(v[done], return_index=True)
+    done    = n.sort(done[best])
+    u, v    = u[done], v[done]
+    if maxfaces is not None:
+      #each collapse removes two triangles: do only the best ones if there are too many
+      count = max(1, (tris.shape[0]-maxfaces+1)//2)
+      u, v  = u[:count], v[:count]
+    for k in xrange(10):
+      quadrics[:,k] += n.bincount(v, weights=quadrics[u,k], minlength=nverts)
+    remap   = n.arange(nverts)
+    remap[u] = v
+    tris    = remap[tris]
+    keep    = (tris[:,0]!=tris[:,1]) & (tris[:,1]!=tris[:,2]) & (tris[:,2]!=tris[:,0])
+    tris, sign = tris[keep], sign[keep]
+  #remove the unused vertexes
+  used      = n.zeros(nverts, dtype=bool)
+  used[tris] = True
+  remap     = n.cumsum(used)-1
+  error     = float(n.sqrt(quadricError(quadrics[used], pts[used]).max())) if used.any() else 0.0
+  return points[used], remap[tris].astype(triangles.dtype), remap, error
@@ -0,0 +1,291 @@
+import os
+import os.path as op
+import time
+import traceback
+import numpy as n
+import meshdiff
+import gridmesh
+import pointcloud
+from meshdiff import RetVal
+
+"""Streaming mode: mesh the topography of a line scanner as it is acquired.
+The point cloud is read from a stream (a pipe, or a file which is still
+being written) as a text file in the usual format, split in scan lines, and
+each line is joined to the previous one with a strip of triangles as soon as
+it arrives (see ScanLineMesher), so the upper face of the mesh is ready when
+the stream ends. Then, the difference is computed as with doDifference(),
+with the upper face already built (see the option 'upperface').
+
+The scan lines are blocks of a fixed number of samples (if it is given, as
+in gridmesh.scanLineIds()), or runs of points with the same slow coordinate
+(points with non-finite XY coordinates belong to the current line). The
+points of each line are filtered and sorted along the line as in
+meshdiff.createUpperFaceFromScanLines(), so the mesh is the same as the one
+built from the whole file in the mode 'grid'. Registration and decimation
+need the whole point cloud, so they cannot be used"""
+
+#optional settings of doStreamDifference(), in addition to the ones of doDifference()
+defaultOptions = {
+  'fast':        None,  #fast axis of the scan lines (0 for X, 1 for Y, None to detect it)
+  'follow':      False, #the stream is a growing file: wait for more data at its end (see idletimeout)
+  }
+
+#seconds between reads of a growing file when there is no new data
+pollinterval  = 0.2
+#seconds without new data for a growing file to be considered finished
+idletimeout   = 10.0
+#initial capacity (in points) of the buffer of points of ScanLineMesher
+initialpoints = 1<<16
+
+"""builds the upper face of the mesh of a point cloud one scan line at a time:
+each line is joined to the previous one with a strip of triangles (see
+gridmesh.joinLines()) when it is added, and the border and the base are
+built at the end (see upperFace()). fast is the fast axis, and zlimits the Z
+limits (points outside them are dropped). If tolerance is not None, the
+points are stored in single precision (compact storage, see
+meshdiff.compactPointCloud()) as long as their rounding error is not higher
+than tolerance, which is checked as the lines arrive: if a line exceeds it,
+the points are stored in double precision from then on"""
+class ScanLineMesher(object):
+  def __init__(self, fast, zlimits=(), tolerance=None):
+    self.fast     = fast
+    self.zlimits  = zlimits
+    self.tolerance = tolerance
+    self.maxabs   = 0.0
+    self.points   = n.empty((initialpoints, 3), dtype=n.float64 if tolerance is None else n.float32)
+    self.itype    = meshdiff.indexType(self.points)
+    self.npoints  = 0
+    self.received = 0
+    self.starts   = []
+    self.counts   = []
+    self.strips   = []
+
+  """add a scan line (points in acquisition order). Lines with less than two
+  valid points are dropped. Returns the number of triangles added"""
+  def addLine(self, points):
+    points = n.asarray(points)
+    self.received += points.shape[0]
+    mask   = n.isfinite(points).all(axis=1)
+    if len(self.zlimits)==2:
+      mask &= n.logical_and(points[:,2]<self.zlimits[1], points[:,2]>self.zlimits[0])
+    line   = points[mask]
+    count  = line.shape[0]
+    if count<2:
+      return 0
+    line   = line[n.argsort(line[:,self.fast], kind='mergesort')]
+    start  = self.npoints
+    dtype  = self.points.dtype
+    if dtype==n.float32:
+      self.maxabs = max(self.maxabs, float(n.abs(line).max()))
+      if meshdiff.roundingError(self.maxabs)>self.tolerance:
+        dtype = n.float64
+    if start+count>self.points.shape[0] or dtype!=self.points.dtype:
+      #the buffer grows geometrically, so the points are copied O(1) times on
+      #average (and once more if they are switched to double precision)
+      grown  = n.empty((max(2*self.points.shape[0], start+count), 3), dtype=dtype)
+      grown[:start] = self.points[:start]
+      self.points   = grown
+      self.itype    = meshdiff.indexType(self.points)
+    self.points[start:start+count] = line
+    self.npoints  = start+count
+    added  = 0
+    if len(self.starts)>0:
+      prev, pcount = self.starts[-1], self.counts[-1]
+      members = n.arange(prev, start+count, dtype=self.itype)
+      strip   = gridmesh.joinLines(members, n.array([0, pcount]), n.array([pcount, count]), self.points[:,self.fast])
+      strip   = gridmesh.orientCCW(self.points[:,0:2], strip)
+      self.strips.append(strip)
+      added   = strip.shape[0]
+    self.starts.append(start)
+    self.counts.append(count)
+    return added
+
+  """message about the precision of the points (if tolerance is not None)"""
+  def compactMessage(self):
+    error = meshdiff.roundingError(self.maxabs)
+    if self.points.dtype==n.float32:
+      return 'compact mode: the point cloud has been stored in single precision (rounding error up to %g, the tolerance is %g)' % (error, self.tolerance)
+    return 'compact mode: the point cloud has been stored in double precision from a scan line whose rounding error would be up to %g (the tolerance is %g)' % (error, self.tolerance)
+
+  """the upper face of the mesh: the used points, the triangles, the ordered
+  border and the triangles of the base (as returned by
+  meshdiff.createUpperFaceFromScanLines())"""
+  def upperFace(self):
+    if len(self.starts)<2:
+      return RetVal(False, 'Error trying to generate a mesh from the point cloud: less than two scan lines have valid points', -1, 34)
+    points  = self.points[:self.npoints]
+    starts  = n.array(self.starts)
+    counts  = n.array(self.counts)
+    lineids = n.repeat(n.arange(starts.size), counts)
+    tU      = n.concatenate(self.strips)
+    ordered, tBorder = gridmesh.scanLinesBorder(points[:,0:2], lineids, starts, counts, points[:,self.fast], self.itype)
+    return RetVal(True, (points, tU, ordered, tBorder))
+
+"""chunks of whole lines of text read from the file descriptor fd as they are
+written. If follow is True, the end of the file is not the end of the stream
+until no data is written for idletimeout seconds (for growing files; pipes
+end when the writer closes them)"""
+def readChunks(fd, follow=False):
+  pending = b''
+  last    = time.time()
+  while True:
+    data  = os.read(fd, pointcloud.chunkbytes)
+    if len(data)==0:
+      if follow and time.time()-last<idletimeout:
+        time.sleep(pollinterval)
+        continue
+      break
+    last  = time.time()
+    data  = pending+data
+    cut   = data.rfind(b'\n')+1
+    pending = data[cut:]
+    if cut>0:
+      yield data[:cut]
+  if len(pending)>0:
+    yield pending
+
+"""blocks of points parsed from the chunks of text of the stream (see
+readChunks()). Raises PointCloudError if there are malformed lines"""
+def iterPointBlocks(fd, name, follow=False):
+  firstline = 1
+  for data in readChunks(fd, follow):
+    values, bad, columns = pointcloud.parseChunk(data, firstline)
+    if len(bad)>0:
+      raise pointcloud.malformedError(name, bad, columns)
+    firstline += data.count(b'\n')
+    yield values
+
+"""fast axis of points in acquisition order: the only coordinate which changes
+between the first consecutive points with different XY coordinates (None if
+there are no such points, or both coordinates change)"""
+def detectFast(points):
+  xy    = points[n.isfinite(points[:,0:2]).all(axis=1),0:2]
+  moves = xy[1:]!=xy[:-1]
+  first = n.flatnonzero(moves.any(axis=1))
+  if first.size==0 or moves[first[0]].all():
+    return None
+  return int(n.argmax(moves[first[0]]))
+
+"""split the blocks of points (in acquisition order) in scan lines (see the
+description of the module), detecting the fast axis if it is None. Yields
+tuples (points of the line, fast axis) when the next line starts, and the
+last one at the end of the blocks"""
+def iterScanLines(blocks, fast=None, samples=None):
+  pending = n.empty((0, 3))
+  for block in blocks:
+    pts = n.concatenate((pending, block)) if pending.shape[0]>0 else block
+    if fast is None:
+      if samples is not None:
+        if pts.shape[0]<samples:
+          pending = pts
+          continue
+        first = pts[:samples,0:2]
+        first = first[n.isfinite(first).all(axis=1)]
+        fast  = int(n.argmax(first.max(axis=0)-first.min(axis=0))) if first.shape[0]>1 else 0
+      else:
+        fast  = detectFast(pts)
+        if fast is None:
+          pending = pts
+          continue
+    if samples is not None:
+      full  = pts.shape[0]//samples*samples
+      for start in xrange(0, full, samples):
+        yield pts[start:start+samples], fast
+      pending = pts[full:]
+    else:
+      slow   = pts[:,1-fast]
+      finite = n.flatnonzero(n.isfinite(slow))
+      breaks = finite[1:][slow[finite[1:]]!=slow[finite[:-1]]]
+      prev   = 0
+      for b in breaks:
+        yield pts[prev:b], fast
+        prev = b
+      pending = pts[prev:]
+  if pending.shape[0]>0:
+    yield pending, 0 if fast is None else fast
+
+"""mesh the point cloud read from the file descriptor fd (name is used in
+the messages) one scan line at a time (see the description of the module).
+tolerance is the one of the compact mode (None to store the points in double
+precision, see ScanLineMesher). Returns the upper face of the mesh (see
+ScanLineMesher.upperFace()) and a message"""
+def meshStream(fd, name, zlimits, fast=None, samples=None, follow=False, tolerance=None):
+  mesher = None
+  nlines = 0
+  for line, lfast in iterScanLines(iterPointBlocks(fd, name, follow), fast, samples):
+    if mesher is None:
+      mesher = ScanLineMesher(lfast, zlimits, tolerance)
+    mesher.addLine(line)
+    nlines += 1
+  if mesher is None:
+    return RetVal(False, 'Incorrect or empty point cloud file '+name, -1, 13)
+  ret = mesher.upperFace()
+  if not ret.ok:
+    return ret
+  msg = 'point cloud streamed: %d points in %d scan lines, %d valid points meshed as they were read' % (mesher.received, nlines, mesher.npoints)
+  if tolerance is not None:
+    msg = '%s\n%s' % (msg, mesher.compactMessage())
+  return RetVal(True, (ret.val, msg))
+
+"""Same as meshdiff.safeDoDifference(), but the point cloud is read as a
+stream (see the description of the module): the first string argument is
+the file with the stream, or - for the standard input. The number of samples
+per line is taken from the option 'gridsamples'"""
+def safeDoStreamDifference(strargs, opts=None):
+  arguments = meshdiff.sanitizeStrArguments(*strargs, pcstream=True)
+  if not arguments.ok:
+    return arguments
+  filePC, fileSTL, fileResult, useCube, limits, zsub, argopts = arguments.val
+  opts = dict(defaultOptions, **dict(opts or {}, **argopts))
+  try:
+    return doStreamDifference(filePC, fileSTL, fileResult, useCube, limits, zsub, opts)
+  except:
+    return RetVal(False, 'Unexpected exception: '+traceback.format_exc(), -1, 1)
+
+"""mesh the point cloud from the stream filePC (- for the standard input), and
+compute the difference as doDifference() (the arguments are the same). In
+compact mode without the option 'compacttolerance', the STL input mesh is
+loaded before reading the stream, to know the tolerance (see
+meshdiff.compactTolerance())"""
+def doStreamDifference(filePC, fileSTL, fileResult, useCube, limits, zsub, opts):
+  fast, follow = opts.get('fast'), opts.get('follow', False)
+  opts = dict((k, v) for k, v in opts.iteritems() if k not in defaultOptions)
+  full = meshdiff.completeOptions(opts)
+  #checked as if the upper face was already given, before reading the stream
+  ret  = meshdiff.checkOptions(dict(full, upperface=True))
+  if not ret.ok:
+    return ret
+  report    = []
+  tolerance = None
+  if full['compact']:
+    if full['compacttolerance'] is None and full['reference'] is None:
+      try:
+        workdir = meshdiff.makeScratchDir(full['scratchdir'])
+      except (IOError, OSError) as e:
+        return RetVal(False, 'Could not create a directory for the intermediate files: '+str(e), -1, 97)
+      ret = meshdiff.loadReferenceMesh(fileSTL, op.join(workdir, meshdiff.specialFiles['stl'][0]), full['refcache'], report)
+      meshdiff.removeEmptyDir(workdir)
+      if not ret.ok:
+        return ret
+      opts = dict(opts, reference=ret.val)
+      full = dict(full, reference=ret.val)
+    tolerance = meshdiff.compactTolerance(full, full['reference'])
+  try:
+    if filePC=='-':
+      ret = meshStream(0, 'standard input', limits[2], fast, full['gridsamples'], follow, tolerance)
+    else:
+      with open(filePC, 'rb') as f:
+        ret = meshStream(f.fileno(), filePC, limits[2], fast, full['gridsamples'], follow, tolerance)
+  except pointcloud.PointCloudError as e:
+    if e.columns is not None:
+      return RetVal(False, str(e), 0, 14)
+    return RetVal(False, 'Could not read point cloud file %s: %s' % (filePC, str(e)), -1, 12)
+  except (IOError, OSError) as e:
+    return RetVal(False, 'Could not read point cloud file %s: %s' % (filePC, str(e)), -1, 12)
+  if not ret.ok:
+    return ret
+  upper, msg = ret.val
+  ret  = meshdiff.doDifference(filePC, fileSTL, fileResult, useCube, limits, zsub, dict(opts, upperface=upper))
+  if ret.ok:
+    ret = ret._replace(val='\n'.join([ret.val]+report+[msg]))
+  return ret
@@ -0,0 +1,547 @@
+import os
+import os.path as op
+import shutil
+import time
+import traceback
+import multiprocessing as mp
+import numpy as n
+from scipy.spatial import cKDTree
+import meshdiff
+import meshio
+import pointcloud
+import cache
+import clean
+import register
+import profiling
+from meshdiff import RetVal
+
+"""Tiled mode: intersect a point cloud and a STL model without having the
+whole point cloud (nor its mesh) in memory. The point cloud is streamed to a
+binary file in the directory of the intermediate files, and its points are
+distributed in square tiles in the XY plane. Each tile is expanded by an
+overlap, so the triangulation of its points is the same as the one of the
+whole point cloud near the sides of the tile. Then, each tile is processed
+as a normal run of doDifference() with XY limits (the mesh of the tile is
+cropped to the tile, see crop.py), and the results are joined in the output
+STL file. The base of the mesh is at the same height in all tiles.
+
+The results of the tiles are closed solids sharing their sides: the
+coincident walls of neighbouring tiles are removed and their outlines are
+joined (see stitchTiles), so the output is a single solid, with the same
+volume as the result without tiles (if the overlap is large enough). If the
+sides of two neighbours do not match, their walls are kept (and reported):
+then, the output is an assembly of several closed solids"""
+
+#optional settings of doTiledDifference(), in addition to the ones of doDifference()
+defaultOptions = {
+  'tilesize':    None, #side of the tiles
+  'tileoverlap': None, #expansion of the tiles (None for 5% of the side of the tiles)
+  'jobs':        None, #processes for the tiles (None for one per CPU)
+  }
+
+#points processed at once when streaming the point cloud
+blockpoints = 1<<20
+
+#tiles with fewer points than this cannot be meshed, so they are skipped
+minpoints   = 3
+
+#STL input mesh shared by all tiles in a worker process
+sharedReference = None
+
+#tolerance to find the walls of the tiles and to join them (see stitchTiles),
+#relative to the largest coordinate of each tile (STL files have single
+#precision coordinates, with a relative precision of about 6e-8)
+seamtolerance = 1e-6
+
+"""fill missing optional settings with their default values"""
+def completeOptions(opts):
+  full = dict(defaultOptions)
+  if opts is not None:
+    full.update(opts)
+  return meshdiff.completeOptions(full)
+
+"""Same as meshdiff.safeDoDifference(), but for doTiledDifference()"""
+def safeDoTiledDifference(strargs, opts=None):
+  return meshdiff.safeCall(doTiledDifference, strargs, opts)
+
+"""copy the point cloud file to the binary file raw (as float64 XYZ triplets),
+one chunk at a time. Returns the points as a memory map"""
+def streamPointCloud(filePC, raw):
+  with open(raw, 'wb') as f:
+    for values in pointcloud.iterPointCloud(filePC):
+      n.ascontiguousarray(values, dtype=n.float64).tofile(f)
+  if op.getsize(raw)==0:
+    return n.zeros((0, 3))
+  return n.memmap(raw, dtype=n.float64, mode='r').reshape(-1, 3)
+
+"""read the point cloud as a memory map (if it is not already loaded), using
+the sidecar file of the point cloud cache if it is enabled. Binary point
+cloud files are mapped directly (see pointcloud.py)"""
+def mapPointCloud(filePC, opts, workdir):
+  if opts['points'] is not None:
+    return RetVal(True, opts['points'])
+  raw = op.join(workdir, 'pc.raw')
+  try:
+    fmt = opts['pcformat'] or pointcloud.detectFormat(filePC)
+    if fmt!='text':
+      pc = pointcloud.mapPointCloud(filePC, fmt)
+    elif opts['pccache']:
+      pc, hit = cache.loadPointCloudCached(filePC, lambda f: streamPointCloud(f, raw), opts['pccachehash'])
+    else:
+      pc = streamPointCloud(filePC, raw)
+  except pointcloud.PointCloudError as e:
+    if e.columns is not None:
+      return RetVal(False, str(e), 0, 14)
+    return RetVal(False, 'Could not read point cloud file %s: %s' % (filePC, str(e)), -1, 12)
+  except:
+    return RetVal(False, 'Could not read point cloud file '+filePC, -1, 12)
+  if pc.size==0:
+    return RetVal(False, 'Incorrect or empty point cloud file '+filePC, -1, 13)
+  return RetVal(True, pc)
+
+"""iterate over the points in blocks of blockpoints, transformed by the 4x4
+transformation (if it is not None). Only the points which are finite and
+within the Z limits are yielded"""
+def validBlocks(pc, zlimits, transform):
+  for start in xrange(0, pc.shape[0], blockpoints):
+    block = n.asarray(pc[start:start+blockpoints], dtype=n.float64)
+    if transform is not None:
+      block = register.transformPoints(transform, block)
+    mask  = n.isfinite(block).all(axis=1)
+    if len(zlimits)==2:
+      mask &= (block[:,2]>zlimits[0]) & (block[:,2]<zlimits[1])
+    yield block[mask]
+
+"""bounding box of the valid points (see validBlocks), as a (2,3) array, or
+None if there are no valid points"""
+def validBounds(pc, zlimits, transform):
+  lo = n.full(3,  n.inf)
+  hi = n.full(3, -n.inf)
+  for block in validBlocks(pc, zlimits, transform):
+    if block.shape[0]>0:
+      lo = n.minimum(lo, block.min(axis=0))
+      hi = n.maximum(hi, block.max(axis=0))
+  if not (lo<=hi).all():
+    return None
+  return n.array([lo, hi])
+
+"""distribute the valid points in the tiles of a grid (origin, side and
+number of tiles (nx, ny)), each one expanded by overlap. Points near the
+sides go to several tiles. The points of each tile are appended to a binary
+file (named by tilefile(index)), in their original order. Returns the number
+of points in each tile"""
+def binPoints(pc, zlimits, transform, origin, side, shape, overlap, tilefile):
+  nx, ny = shape
+  counts = n.zeros(nx*ny, dtype=n.int64)
+  for block in validBlocks(pc, zlimits, transform):
+    if block.shape[0]==0:
+      continue
+    ranges = []
+    for axis, size in [(0, nx), (1, ny)]:
+      rel  = block[:,axis]-origin[axis]
+      lo   = n.clip(n.floor((rel-overlap)/side), 0, size-1).astype(n.int64)
+      hi   = n.clip(n.floor((rel+overlap)/side), 0, size-1).astype(n.int64)
+      ranges.append((lo, hi))
+    (x0, x1), (y0, y1) = ranges
+    #the overlap is smaller than the tiles, so a point is in at most 2x2 tiles
+    keys = [y0*nx+x0]
+    idxs = [n.arange(block.shape[0])]
+    for ix, iy, extra in [(x1, y0, x1!=x0), (x0, y1, y1!=y0), (x1, y1, (x1!=x0) & (y1!=y0))]:
+      sel = n.nonzero(extra)[0]
+      keys.append(iy[sel]*nx+ix[sel])
+      idxs.append(sel)
+    keys  = n.concatenate(keys)
+    idxs  = n.concatenate(idxs)
+    order = n.lexsort((idxs, keys))
+    keys  = keys[order]
+    idxs  = idxs[order]
+    cuts  = n.concatenate(([0], n.nonzero(n.diff(keys))[0]+1, [keys.size]))
+    for a, b in zip(cuts[:-1], cuts[1:]):
+      with open(tilefile(keys[a]), 'ab') as f:
+        block[idxs[a:b]].tofile(f)
+      counts[keys[a]] += b-a
+  return counts
+
+"""initializer of the worker processes"""
+def initWorker(reference):
+  global sharedReference
+  sharedReference = reference
+
+"""worker function: run doDifference() for a tile, returning its RetVal"""
+def runTile(args):
+  filePC, fileSTL, tilePC, tileResult, limits, zsub, opts = args
+  try:
+    points = n.fromfile(tilePC, dtype=n.float64).reshape(-1, 3)
+    opts   = dict(opts, points=points, reference=sharedReference)
+    return meshdiff.doDifference(filePC, fileSTL, tileResult, True, limits, zsub, opts)
+  except:
+    return RetVal(False, 'Unexpected exception: '+traceback.format_exc(), -1, 1)
+
+"""read the binary STL file of a tile, without the triangles with repeated
+vertexes (vertexes which are very close in the result of the tile may be the
+same in single precision, and these triangles would hide the edges of the
+outlines of the walls, see wallOutline)"""
+def readTile(filename):
+  verts, triangles = meshio.readSTL(filename)
+  t0, t1, t2 = triangles[:,0], triangles[:,1], triangles[:,2]
+  return verts, triangles[(t0!=t1) & (t1!=t2) & (t2!=t0)]
+
+"""mask of the triangles with all their vertexes on the plane where the
+coordinate axis has the value value (up to tolerance)"""
+def planeTriangles(verts, triangles, axis, value, tolerance):
+  onplane = n.abs(verts[:,axis]-value)<=tolerance
+  return onplane[triangles].all(axis=1)
+
+"""edges of the border of a set of triangles (the ones used by only one of
+them), as a (M,2) array of vertex indexes, oriented as in their triangles"""
+def borderEdges(triangles):
+  edges = n.concatenate((triangles[:,[0,1]], triangles[:,[1,2]], triangles[:,[2,0]]))
+  first, inverse = clean.groupRows(n.sort(edges, axis=1))
+  return edges[n.bincount(inverse)[inverse]==1]
+
+"""outline of the wall of a tile on one of its sides (axis and value of the
+plane of the side): the border of its triangles on the plane. Returns the
+vertexes of the outline (indexes in verts) and its edges (as indexes in the
+vertexes of the outline)"""
+def wallOutline(verts, triangles, axis, value, tolerance):
+  edges = borderEdges(triangles[planeTriangles(verts, triangles, axis, value, tolerance)])
+  ids   = n.unique(edges)
+  return ids, n.searchsorted(ids, edges)
+
+"""position of points on the edges (segments between the rows of a and b):
+for each point, the index of an edge which contains it (not at its ends, up
+to tolerance), or -1 if there is none"""
+def pointsOnEdges(points, a, b, tolerance):
+  found = n.full(points.shape[0], -1, dtype=n.int64)
+  if a.shape[0]==0:
+    return found
+  d     = b-a
+  dd    = n.maximum((d*d).sum(axis=1), tolerance*tolerance)
+  for k in xrange(points.shape[0]):
+    t    = ((points[k]-a)*d).sum(axis=1)/dd
+    dist = points[k]-(a+t[:,n.newaxis]*d)
+    near = ((dist*dist).sum(axis=1)<=tolerance*tolerance) & (t*n.sqrt(dd)>tolerance) & ((1-t)*n.sqrt(dd)>tolerance)
+    hits = n.flatnonzero(near)
+    if hits.size>0:
+      found[k] = hits[0]
+  return found
+
+"""sets of equivalent items (vertexes of several tiles at the same position)"""
+class Clusters(object):
+  def __init__(self):
+    self.parent = {}
+
+  def find(self, item):
+    root = item
+    while self.parent.get(root, root)!=root:
+      root = self.parent[root]
+    while item!=root:
+      item, self.parent[item] = self.parent[item], root
+    return root
+
+  """merge the sets of a and b: the lowest item of the set is its root"""
+  def union(self, a, b):
+    a, b = self.find(a), self.find(b)
+    if a!=b:
+      self.parent[max(a, b)] = min(a, b)
+
+"""match the outlines of the walls of two neighbouring tiles on their common
+side (each one given as (key, vertex indexes, coordinates, edges), see
+wallOutline). Each vertex of an outline must be at the position of a vertex
+of the other one (then they are merged in clusters), or on one of its edges
+(then it is inserted in the edge: the insertions are appended to the list
+inserts as (key of the tile of the edge, vertex indexes of the ends of the
+edge, (key, index) of the vertex)). Returns False if the outlines do not
+match: the walls cannot be removed"""
+def matchOutlines(first, second, tolerance, clusters, inserts):
+  pairs = []
+  found = []
+  for (key, ids, coords, edges), (okey, oids, ocoords, oedges) in [(first, second), (second, first)]:
+    ids, oids = ids.tolist(), oids.tolist()
+    if ocoords.shape[0]==0:
+      return False
+    dist, nearest = cKDTree(ocoords).query(coords)
+    same  = dist<=tolerance
+    pairs.extend(((key, ids[i]), (okey, oids[j])) for i, j in zip(n.flatnonzero(same), nearest[same]))
+    loose = n.flatnonzero(~same)
+    onedge = pointsOnEdges(coords[loose], ocoords[oedges[:,0]], ocoords[oedges[:,1]], tolerance)
+    if (onedge<0).any():
+      return False
+    found.extend((okey, (oids[oedges[e,0]], oids[oedges[e,1]]), (key, ids[i])) for i, e in zip(loose, onedge))
+  for a, b in pairs:
+    clusters.union(a, b)
+  inserts.extend(found)
+  return True
+
+"""split the triangles of a mesh at the vertexes inserted in their edges.
+insertions is a dictionary of lists of new vertexes (indexes in verts) by
+edge (pair of vertex indexes, in any order). Returns the new triangles"""
+def splitEdges(verts, triangles, insertions):
+  if len(insertions)==0:
+    return triangles
+  ends     = set(v for edge in insertions for v in edge)
+  touched  = n.flatnonzero(n.in1d(triangles, list(ends)).reshape(-1, 3).sum(axis=1)>=2)
+  tris     = [list(t) for t in triangles[touched]]
+  byedge   = {}
+  for k, t in enumerate(tris):
+    for i in xrange(3):
+      byedge[(t[i], t[(i+1)%3])] = k
+  for (a, b), new in insertions.iteritems():
+    for p, q in [(a, b), (b, a)]:
+      if (p, q) not in byedge:
+        continue
+      k = byedge.pop((p, q))
+      t = tris[k]
+      r = t[(t.index(p)+2)%3]
+      d = verts[q]-verts[p]
+      chain = [p]+sorted(new, key=lambda v: float(n.dot(verts[v]-verts[p], d)))+[q]
+      #fan from the opposite vertex: the first triangle replaces the old one
+      for i in xrange(len(chain)-1):
+        tri = [chain[i], chain[i+1], r]
+        if i==0:
+          tris[k] = tri
+          idx = k
+        else:
+          tris.append(tri)
+          idx = len(tris)-1
+        byedge[(chain[i], chain[i+1])] = idx
+        byedge[(chain[i+1], r)] = idx
+        byedge[(r, chain[i])] = idx
+  keep = n.ones(triangles.shape[0], dtype=bool)
+  keep[touched] = False
+  return n.concatenate((triangles[keep], n.array(tris, dtype=triangles.dtype).reshape(-1, 3)))
+
+"""write the binary STL files of the tiles to fileResult as a single solid.
+tiles is a list of (key, STL file, XY limits) and shape the number of tiles
+(nx, ny) of the grid. The result of each tile is a closed solid, so it has
+a wall on each side of the tile: where two tiles are neighbours, their walls
+are coincident. These walls are removed, and the outlines left by them are
+joined: the vertexes of each outline at the position of a vertex of the other
+one are merged, and the rest are inserted in the edges of the other outline
+(the walls of each tile are triangulated in their own way). If the outlines
+of a pair of neighbours do not match (up to seamtolerance), their walls are
+kept. The tiles are read twice (to match the outlines, and to write them),
+one at a time. Returns the number of triangles written, the number of pairs
+of neighbours which have been joined, and the number of them which have not"""
+def stitchTiles(tiles, shape, fileResult):
+  nx, ny = shape
+  boxes  = dict((key, box) for key, filename, box in tiles)
+  files  = dict((key, filename) for key, filename, box in tiles)
+  #sides of the tiles: (axis, 0 for min or 1 for max, offset of the key of the neighbour)
+  sides  = [(0, 0, -1), (0, 1, 1), (1, 0, -nx), (1, 1, nx)]
+  def neighbour(key, side):
+    axis, end, offset = sides[side]
+    pos = key%nx if axis==0 else key//nx
+    if pos+(1 if end else -1) not in xrange(shape[axis]):
+      return None
+    return key+offset if key+offset in boxes else None
+  #first pass: outlines of the walls on the sides with neighbours
+  outlines   = {}
+  tolerances = {}
+  positions  = {}
+  for key in sorted(files):
+    verts, triangles = readTile(files[key])
+    tolerances[key]  = seamtolerance*max(1.0, float(n.abs(verts).max()) if verts.size>0 else 1.0)
+    for side in xrange(4):
+      if neighbour(key, side) is None:
+        continue
+      axis, end, offset = sides[side]
+      ids, edges = wallOutline(verts, triangles, axis, boxes[key][axis][end], tolerances[key])
+      outlines[(key, side)] = (key, ids, verts[ids], edges)
+      positions.update(((key, v), verts[v]) for v in ids.tolist())
+  #match the outlines of each pair of neighbours
+  clusters = Clusters()
+  inserts  = []
+  joined   = set()
+  nkept    = 0
+  for (key, side), outline in sorted(outlines.iteritems()):
+    other = neighbour(key, side)
+    if other<key:
+      continue
+    if matchOutlines(outline, outlines[(other, side^1)], max(tolerances[key], tolerances[other]), clusters, inserts):
+      joined.update([(key, side), (other, side^1)])
+    else:
+      nkept += 1
+  #second pass: remove the joined walls, move the merged vertexes to the
+  #position of the root of their clusters and split the edges
+  total = 0
+  with open(fileResult, 'wb') as f:
+    meshio.writeSTLHeader(f, 0)
+    for key in sorted(files):
+      verts, triangles = readTile(files[key])
+      walls = [side for side in xrange(4) if (key, side) in joined]
+      if len(walls)>0:
+        keep = n.ones(triangles.shape[0], dtype=bool)
+        for side in walls:
+          axis, end, offset = sides[side]
+          keep &= ~planeTriangles(verts, triangles, axis, boxes[key][axis][end], tolerances[key])
+        triangles = triangles[keep]
+        for side in walls:
+          for v in outlines[(key, side)][1].tolist():
+            verts[v] = positions[clusters.find((key, v))]
+        insertions = {}
+        extra      = []
+        for okey, edge, vertex in inserts:
+          if okey==key:
+            insertions.setdefault(edge, []).append(verts.shape[0]+len(extra))
+            extra.append(positions[clusters.find(vertex)])
+        if len(extra)>0:
+          verts = n.concatenate((verts, n.array(extra)))
+        triangles = splitEdges(verts, triangles, insertions)
+      meshio.writeSTLRecords(f, verts, triangles)
+      total += triangles.shape[0]
+    f.seek(0)
+    meshio.writeSTLHeader(f, total)
+  return total, len(joined)//2, nkept
+
+"""Intersect a point cloud and a STL model within a given box, in tiles of
+side opts['tilesize'] (see the description of the module). The arguments are
+the same as in meshdiff.doDifference()"""
+def doTiledDifference(filePC, fileSTL, fileResult, useCube, limits, zsub, opts=None):
+  opts = completeOptions(opts)
+  return meshdiff.runProfiled(opts, 'tiled difference', doTiledDifferenceUnprofiled, filePC, fileSTL, fileResult, useCube, limits, zsub, opts)
+
+"""body of doTiledDifference()"""
+def doTiledDifferenceUnprofiled(filePC, fileSTL, fileResult, useCube, limits, zsub, opts):
+  ret  = meshdiff.checklimits(useCube, limits, zsub)
+  if not ret.ok: return ret
+  ret  = meshdiff.checkOptions(opts)
+  if not ret.ok: return ret
+  side    = opts['tilesize']
+  overlap = opts['tileoverlap']
+  if overlap is None and side is not None:
+    overlap = 0.05*side
+  if side is None or not side>0 or not 0<=overlap<side:
+    return RetVal(False, 'The size of the tiles must be higher than 0, and the overlap must be lower than it', -1, 103)
+  try:
+    workdir = meshdiff.makeScratchDir(opts['scratchdir'])
+  except (IOError, OSError) as e:
+    return RetVal(False, 'Could not create a directory for the intermediate files: '+str(e), -1, 97)
+  ok = False
+  try:
+    ret = doTiledDifferenceInDir(filePC, fileSTL, fileResult, useCube, limits, zsub, opts, side, overlap, workdir)
+    ok  = ret.ok
+  finally:
+    if ok or not meshdiff.DEBUG:
+      shutil.rmtree(workdir, ignore_errors=True)
+  if not ok and op.isdir(workdir):
+    ret = ret._replace(val='%s\n(intermediate files have been kept in %s)' % (ret.val, workdir))
+  return ret
+
+"""body of doTiledDifference(), writing the intermediate files to workdir"""
+def doTiledDifferenceInDir(filePC, fileSTL, fileResult, useCube, limits, zsub, opts, side, overlap, workdir):
+  report = []
+  with profiling.stage('stream point cloud'):
+    ret  = mapPointCloud(filePC, opts, workdir)
+  if not ret.ok: return ret
+  pc     = ret.val
+  reference = opts['reference']
+  if reference is None:
+    ret  = meshdiff.loadReferenceMesh(fileSTL, op.join(workdir, 'stl.off'), opts['refcache'], report)
+    if not ret.ok: return ret
+    reference = ret.val
+  #the STL model is cleaned only once for all tiles
+  if opts['clean'] and not opts['refcleaned']:
+    ret  = meshdiff.cleanInputMesh(reference, 'STL input mesh', 1, opts, report, opts['refcache'])
+    if not ret.ok: return ret
+    reference = ret.val
+  transform = None
+  if opts['register']:
+    #the transformation is computed with a subset of the points, so the points are not transformed here
+    try:
+      with profiling.stage('register'):
+        transform, rms, inliers, iterations = register.icp(pc, *reference)
+    except:
+      return RetVal(False, 'Unexpected error while aligning the point cloud to the STL model: '+traceback.format_exc(), -1, 102)
+    rows = '\n'.join('  '+' '.join('%12.8g' % x for x in row) for row in transform)
+    report.append('point cloud aligned to the STL model in %d iterations (RMS residual %g, %.1f%% inliers), transformation:\n%s' % (iterations, rms, inliers*100, rows))
+  with profiling.stage('bounds'):
+    bounds = validBounds(pc, limits[2], transform)
+  if bounds is None:
+    return RetVal(False, 'There are no valid points within the Z limits in the point cloud', 0, 104)
+  #same base for all tiles: zsub below the lowest point (as without tiles)
+  zbase  = bounds[0,2]-zsub
+  if len(limits[2])==2:
+    zbase  = max(zbase, limits[2][0])
+    zlims  = list(limits[2])
+  else:
+    zlims  = [zbase, bounds[1,2]+zsub]
+  if useCube:
+    xy   = n.array([limits[0], limits[1]], dtype=n.float64)
+  else:
+    xy   = bounds[:,0:2].T
+  origin = xy[:,0]
+  shape  = [max(1, int(n.ceil((xy[i,1]-xy[i,0])/side))) for i in xrange(2)]
+  tilefile = lambda key: op.join(workdir, 'tile%d.raw' % key)
+  with profiling.stage('bin points'):
+    counts = binPoints(pc, limits[2], transform, origin, side, shape, overlap, tilefile)
+  pc     = None
+  #options for the tiles: the points have already been registered and filtered
+  #(the callbacks cannot be passed to other processes, so only tiles run in this one are profiled)
+  tileopts = dict(opts, register=False, crop=True, zbase=zbase, gridsamples=None, scratchdir=workdir, workdir=None,
+                  profile=False, monitor=None, progress=None, cancel=None, refcleaned=True,
+                  reference=None, refindex=None, points=None)
+  for key in defaultOptions:
+    tileopts.pop(key, None)
+  tiles  = []
+  for key in xrange(shape[0]*shape[1]):
+    if counts[key]<minpoints:
+      continue
+    iy, ix = divmod(key, shape[0])
+    #the last tiles end at the limits, not at a multiple of the side
+    x0 = origin[0]+ix*side
+    x1 = xy[0,1] if ix==shape[0]-1 else x0+side
+    y0 = origin[1]+iy*side
+    y1 = xy[1,1] if iy==shape[1]-1 else y0+side
+    tiles.append((key, (filePC, fileSTL, tilefile(key), op.join(workdir, 'tile%d.stl' % key),
+                        [[x0, x1], [y0, y1], zlims], zsub, tileopts)))
+  nprocs = opts['jobs']
+  if nprocs is None:
+    try:
+      nprocs = mp.cpu_count()
+    except NotImplementedError:
+      nprocs = 1
+  nprocs = max(1, min(nprocs, len(tiles)))
+  pool   = None
+  t0     = time.time()
+  if nprocs>1:
+    pool    = mp.Pool(nprocs, initWorker, (reference,))
+    results = pool.imap(runTile, [args for key, args in tiles])
+  else:
+    initWorker(reference)
+    results = (runTile(args) for key, args in tiles)
+  try:
+    with profiling.stage('tiles'):
+      results = list(results)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+    initWorker(None)
+  done   = []
+  empty  = shape[0]*shape[1]-len(tiles)
+  failed = []
+  for (key, args), ret in zip(tiles, results):
+    if ret.ok:
+      done.append((key, args[3], args[4][0:2]))
+    elif ret.errcode==90:
+      #no triangles within the tile
+      empty += 1
+    else:
+      failed.append('  tile %d (X %g..%g, Y %g..%g): %s' % ((key,)+tuple(args[4][0])+tuple(args[4][1])+(str(ret.val).replace('\n', '\n    '),)))
+  if len(failed)>0:
+    return RetVal(False, '%d of %d tiles failed:\n%s' % (len(failed), len(tiles), '\n'.join(failed)), -1, 105)
+  if len(done)==0:
+    return RetVal(False, 'There are no valid points within the limits in the point cloud', 0, 104)
+  try:
+    with profiling.stage('stitch tiles'):
+      ntriangles, njoined, nkept = stitchTiles(done, shape, fileResult)
+  except:
+    meshdiff.removefile(fileResult)
+    return RetVal(False, 'Could not write the output file %s: %s' % (fileResult, traceback.format_exc()), 2, 106)
+  report.append('%d tiles of %gx%g (overlap %g): %d processed in %.2f s with %d processes, %d empty; %d triangles' %
+                (shape[0]*shape[1], side, side, overlap, len(done), time.time()-t0, nprocs, empty, ntriangles))
+  report.append('%d pairs of neighbouring tiles joined' % njoined)
+  if nkept>0:
+    report.append('WARNING: the sides of %d pairs of neighbouring tiles did not match, so they have been kept as internal walls (the output is an assembly of several closed solids)' % nkept)
+  return RetVal(True, '\n'.join(['output file has been written: '+fileResult]+report), -1, 0)
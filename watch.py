@@ -0,0 +1,268 @@
+import os
+import os.path as op
+import csv
+import json
+import time
+import fnmatch
+import traceback
+import multiprocessing as mp
+import meshdiff
+import service
+import cache
+from meshdiff import RetVal
+
+"""Watch mode: monitor a directory where a scanner drops point cloud files,
+and compute the difference of each new file as soon as it is complete. A
+file is complete when its size and modification time have not changed for
+'settle' seconds (scanners usually write their files in several steps).
+
+Each file is matched to its STL input file and limits with a rules file: a
+CSV file with a rule in each row: file name pattern (as in fnmatch, such as
+*.txt or station1-*.npy), STL input file and (optionally) the limits, in the
+same order as in the command line: [[xmin, xmax, ymin, ymax], zmin, zmax].
+The first rule matching the name of a file is used. Relative paths are
+relative to the directory of the rules file. Empty lines and lines starting
+with # are ignored. The rules file is read again when it changes.
+
+The output STL file of each point cloud file is written to the output
+directory, with the same name and the extension .stl, and the result is
+logged next to it (with the extension .log). The processed files are
+recorded (with their sizes and modification times) in a state file in the
+output directory (see statefile), so they are skipped after a restart,
+unless they have changed. Files matching no rule are also recorded, but
+they are processed again when the rules file is read again (or after a
+restart), as the new rules may match them. Jobs run in a pool of processes, which keep the
+recently used STL input meshes in memory (see service.py)"""
+
+#state file in the output directory, with the processed files
+statefile = '.meshdiff-watch.json'
+
+#default settings of watch()
+defaultSettings = {
+  'jobs':     None, #jobs running at once (None for one per CPU)
+  'poll':     2.0,  #seconds between scans of the directory
+  'settle':   2.0,  #seconds without changes for a file to be complete
+  'once':     False, #stop when all complete files have been processed
+  }
+
+"""parse the rules file. Returns a list of rules, each one a tuple (pattern,
+STL input file, [useXY, useZ, xmin, xmax, ymin, ymax, zmin, zmax]) with the
+string arguments for safeDoDifference()"""
+def readRules(filename):
+  base  = op.dirname(op.abspath(filename))
+  rules = []
+  try:
+    with open(filename, 'rb') as f:
+      for num, row in enumerate(csv.reader(f), 1):
+        row = [x.strip() for x in row]
+        if len(row)==0 or row==[''] or row[0].startswith('#'):
+          continue
+        if len(row) not in [2, 4, 8]:
+          return RetVal(False, 'Error in rules file %s, line %d: expected 2, 4 or 8 fields, but there are %d' % (filename, num, len(row)), -1, 118)
+        lims  = row[2:]
+        usez  = len(lims)>=2
+        usexy = len(lims)==6
+        lims  = ['']*(6-len(lims))+lims
+        rules.append((row[0], op.join(base, row[1]), [usexy, usez]+lims))
+  except (IOError, OSError, csv.Error) as e:
+    return RetVal(False, 'Could not read rules file %s: %s' % (filename, str(e)), -1, 118)
+  if len(rules)==0:
+    return RetVal(False, 'The rules file %s does not contain any rule' % filename, -1, 118)
+  return RetVal(True, rules)
+
+"""the first rule matching the file name (None if there is none)"""
+def matchRule(rules, name):
+  for rule in rules:
+    if fnmatch.fnmatch(name, rule[0]):
+      return rule
+  return None
+
+"""read the state file of the output directory: a dictionary of records of the
+processed files, by file name"""
+def loadState(outdir):
+  try:
+    with open(op.join(outdir, statefile), 'r') as f:
+      return json.load(f)
+  except (IOError, OSError, ValueError):
+    return {}
+
+"""write the state file of the output directory (replacing it at once, so it
+is not corrupted if the process is stopped while writing it)"""
+def saveState(outdir, state):
+  path = op.join(outdir, statefile)
+  tmp  = '%s.%d.tmp' % (path, os.getpid())
+  with open(tmp, 'w') as f:
+    json.dump(state, f, indent=1)
+  cache.replaceFile(tmp, path)
+
+#error code of the files matching no rule
+unmatchedcode = 119
+
+"""remove the records of the files matching no rule from the state, so they
+are processed again with new rules (the state file does not have to be
+written again: they are also removed when it is loaded)"""
+def forgetUnmatched(state):
+  for name in [name for name, record in state.iteritems() if record['errcode']==unmatchedcode]:
+    del state[name]
+
+"""write the log of a processed file (see runJob)"""
+def writeLog(filename, record):
+  with open(filename, 'w') as f:
+    f.write('pcin:    %s\n' % record['pcin'])
+    f.write('stlin:   %s\n' % record['stlin'])
+    f.write('stlout:  %s\n' % record['stlout'])
+    f.write('result:  %s (error code %s)\n' % ('OK' if record['ok'] else 'FAILED', record['errcode']))
+    f.write('finished: %s (%.2f s)\n\n' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['finished'])), record['seconds']))
+    f.write('%s\n' % record['message'])
+
+#service of the worker process, which keeps the STL input meshes in memory
+workerService = None
+
+"""initializer of the worker processes"""
+def initWorker(opts):
+  global workerService
+  workerService = service.Service({'workers': 1}, opts)
+
+"""worker function: run a job (a dictionary with the point cloud file, the
+rule and the output file), returning its result as a dictionary"""
+def runJob(job):
+  t0     = time.time()
+  report = []
+  try:
+    strargs = [job['pcin'], job['stlin'], job['stlout']]+job['args']+job['extraargs']
+    ret     = workerService.runJob('difference', meshdiff.safeDoDifference, strargs, workerService.opts, report)
+  except:
+    ret     = RetVal(False, 'Unexpected exception: '+traceback.format_exc(), -1, 1)
+  message = '\n'.join([str(ret.val)]+report)
+  return {'pcin':     job['pcin'],
+          'stlin':    job['stlin'],
+          'stlout':   job['stlout'],
+          'ok':       bool(ret.ok),
+          'message':  message,
+          'argnum':   ret.argnum,
+          'errcode':  ret.errcode,
+          'seconds':  time.time()-t0}
+
+"""watch the directory (see the description of the module) with the rules
+file rules, writing the results to outdir. opts and extraargs (the string
+arguments after the limits: zsub and, optionally, the decimation) are passed
+to safeDoDifference() for all files. settings: see defaultSettings. The
+directory is watched until stop (an object such as threading.Event) is set,
+or (with the setting 'once') until all complete files have been processed.
+log is called with a line for each event. Returns a RetVal"""
+def watch(directory, rules, outdir, opts=None, extraargs=('0.1',), settings=None, stop=None, log=None):
+  settings = dict(defaultSettings, **(settings or {}))
+  log      = log or (lambda line: None)
+  if not op.isdir(directory):
+    return RetVal(False, 'The watched directory does not exist: '+directory, -1, 118)
+  if not op.isdir(outdir):
+    try:
+      os.makedirs(outdir)
+    except OSError as e:
+      return RetVal(False, 'Could not create the output directory %s: %s' % (outdir, str(e)), -1, 118)
+  ret = readRules(rules)
+  if not ret.ok:
+    return ret
+  ruleset   = ret.val
+  rulestamp = op.getmtime(rules)
+  nprocs    = settings['jobs']
+  if nprocs is None:
+    try:
+      nprocs = mp.cpu_count()
+    except NotImplementedError:
+      nprocs = 1
+  state   = loadState(outdir)
+  forgetUnmatched(state)
+  seen    = {} #file name -> ((size, mtime), time since it has not changed)
+  running = {} #file name -> (job, stamp, pending result)
+  pool    = None
+  if nprocs>1:
+    pool  = mp.Pool(nprocs, initWorker, (opts or {},))
+  else:
+    initWorker(opts or {})
+  log('watching %s (rules: %s, output: %s, %d processes)' % (directory, rules, outdir, nprocs))
+  try:
+    while stop is None or not stop.is_set():
+      #the rules file is read again if it changes
+      try:
+        if op.getmtime(rules)!=rulestamp:
+          rulestamp = op.getmtime(rules)
+          ret = readRules(rules)
+          if ret.ok:
+            ruleset = ret.val
+            log('rules file %s read again' % rules)
+            forgetUnmatched(state)
+          else:
+            log('%s (the previous rules are kept)' % ret.val)
+      except OSError:
+        pass
+      now   = time.time()
+      names = sorted(os.listdir(directory))
+      for name in names:
+        path = op.join(directory, name)
+        if name.startswith('.') or name in running or not op.isfile(path):
+          continue
+        try:
+          stamp = (op.getsize(path), op.getmtime(path))
+        except OSError:
+          continue
+        record = state.get(name)
+        if record is not None and (record['size'], record['mtime'])==stamp:
+          continue
+        if name not in seen or seen[name][0]!=stamp:
+          seen[name] = (stamp, now)
+          continue
+        if now-seen[name][1]<settings['settle']:
+          continue
+        del seen[name]
+        rule = matchRule(ruleset, name)
+        if rule is None:
+          finish(outdir, state, name, stamp, {'pcin': path, 'stlin': None, 'stlout': None, 'ok': False,
+                 'message': 'No rule of %s matches the file %s' % (rules, name), 'argnum': 0, 'errcode': unmatchedcode, 'seconds': 0.0}, log)
+          continue
+        job = {'pcin':      path,
+               'stlin':     rule[1],
+               'stlout':    op.join(outdir, op.splitext(name)[0]+'.stl'),
+               'args':      rule[2],
+               'extraargs': list(extraargs)}
+        log('processing %s (rule %s)' % (name, rule[0]))
+        if pool is not None:
+          running[name] = (job, stamp, pool.apply_async(runJob, (job,)))
+        else:
+          finish(outdir, state, name, stamp, runJob(job), log)
+      for name in sorted(running):
+        job, stamp, result = running[name]
+        if result.ready():
+          del running[name]
+          try:
+            record = result.get()
+          except:
+            record = {'pcin': job['pcin'], 'stlin': job['stlin'], 'stlout': job['stlout'], 'ok': False,
+                      'message': 'Unexpected exception: '+traceback.format_exc(), 'argnum': -1, 'errcode': 1, 'seconds': 0.0}
+          finish(outdir, state, name, stamp, record, log)
+      #files being written are in seen until they are complete
+      if settings['once'] and len(running)==0 and len(seen)==0:
+        break
+      time.sleep(settings['poll'])
+  except KeyboardInterrupt:
+    log('stopped')
+  finally:
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+  return RetVal(True, state)
+
+"""record the result of a processed file: write its log and update the state"""
+def finish(outdir, state, name, stamp, record, log):
+  record = dict(record, size=stamp[0], mtime=stamp[1], finished=time.time())
+  logfile = op.join(outdir, op.splitext(name)[0]+'.log')
+  try:
+    writeLog(logfile, record)
+  except (IOError, OSError) as e:
+    log('could not write the log file %s: %s' % (logfile, str(e)))
+  state[name] = record
+  try:
+    saveState(outdir, state)
+  except (IOError, OSError) as e:
+    log('could not write the state file in %s: %s' % (outdir, str(e)))
+  log('%s (%.2f s): %s' % ('OK    ' if record['ok'] else 'FAILED', record['seconds'], name))